@@ -4,10 +4,13 @@ import argparse
 import hashlib
 import json
 import logging
+import os
 import pystache
 import re
 import sys
 import textwrap
+import threading
+import time
 import xml.etree.ElementTree as ET
 
 logging.basicConfig(level=logging.WARN)
@@ -37,11 +40,28 @@ class ScanningMethod():
 class ValidOutputs():
     standard = 'standard'
     json = 'json'
+    ndjson = 'ndjson'
 
 class Verb():
     head = 'head'
     get = 'get'
 
+class Engine():
+    thread = 'thread'
+    async = 'async'
+
+class FingerprintMode():
+    full = 'full'
+    adaptive = 'adaptive'
+
+class StatsFormat():
+    json = 'json'
+    prometheus = 'prometheus'
+
+class ProfileMode():
+    cprofile = 'cprofile'
+    sampling = 'sampling'
+
 def validate_url(url, out):
     """
         Checks if a URL is valid and calls fatal() if not. It also returns a
@@ -92,12 +112,26 @@ def scan_http_status(scanning_method):
 
     raise RuntimeError("Unexpected argument to common.scan_method")
 
-def template(template_file, variables={}):
-    variables.update(colors)
-    f = open('common/template/' + template_file, 'r')
-    template = f.read()
+_templates = {}
+
+def template(template_file, variables=None):
+    """
+        Renders common/template/<template_file>. Templates are read and parsed
+        on first use only, and kept in memory afterwards.
+        @param variables a dict of variables for the template. It is not
+            modified.
+    """
+    parsed = _templates.get(template_file)
+    if parsed is None:
+        with open('common/template/' + template_file, 'r') as f:
+            contents = f.read().decode(pystache.defaults.STRING_ENCODING,
+                    pystache.defaults.DECODE_ERRORS)
+
+        # Parsing twice in a race is harmless.
+        parsed = _templates[template_file] = pystache.parse(contents)
 
-    return pystache.render(template, variables)
+    # Later contexts take precedence, as colors did when merged in.
+    return pystache.Renderer().render(parsed, variables or {}, colors)
 
 class StandardOutput():
 
@@ -109,6 +143,15 @@ class StandardOutput():
         """
         print(msg)
 
+    def event(self, event, host, **fields):
+        """
+            For progress events during the scan of a host, e.g.
+            'host_started'. Only used by streaming outputs.
+            @param host the host as supplied by the user.
+            @param fields the details of the event.
+        """
+        pass
+
     def result(self, result, functionality):
         """
             For the final result of the scan.
@@ -134,6 +177,34 @@ class StandardOutput():
 
             self.echo(template(template_str, template_params))
 
+    def delta(self, delta, functionality):
+        """
+            For the result of a scan against a baseline.
+            @param delta as returned by common.baseline.delta_get
+        """
+        changes = []
+        for enumerate in delta:
+            if enumerate == 'host':
+                continue
+
+            change = {'Noun': enumerate.capitalize()}
+            for key in ['added', 'removed']:
+                change[key] = [self._find_label(find) for find in
+                        delta[enumerate][key]]
+                change['any_' + key] = len(change[key]) > 0
+
+            changes.append(change)
+
+        self.echo(template('delta.tpl', {'host': delta['host'], 'changes':
+            changes, 'unchanged': len(changes) == 0}))
+
+    def _find_label(self, find):
+        if isinstance(find, dict):
+            label = find.get('name', find.get('description'))
+            return {'label': label, 'url': find.get('url')}
+        else:
+            return {'label': find, 'url': None}
+
     def warn(self, msg):
         """
             For things that have gone seriously wrong but don't merit a program
@@ -159,7 +230,123 @@ class JsonOutput(StandardOutput):
         pass
 
     def result(self, result, functionality=None):
+        """
+            Outputs one JSON object per line, and flushes it so that results
+            can be consumed while the scan is still running.
+        """
         print(json.dumps(result))
+        sys.stdout.flush()
+
+    def delta(self, delta, functionality=None):
+        print(json.dumps(delta))
+        sys.stdout.flush()
+
+class NdjsonOutput(StandardOutput):
+    """
+        Outputs one JSON record per line for every event, as it happens. All
+        records have 'type', 'host' and 'time' keys. Types are:
+            - host_started
+            - scanning_method: 'method' and 'url'.
+            - phase_finished: 'phase' (e.g. 'plugins') and 'elapsed', and
+              'cached' or 'baseline' if the result of a previous scan was
+              reused.
+            - plugin, theme: the keys of the find, e.g. 'name' and 'url'. Output
+              as soon as the find is found when the plugins or themes are
+              enumerated by this process, or else with the result.
+            - version: 'candidates', a list of possible versions.
+            - interesting_url: 'url' and 'description'.
+            - with --baseline, only changes are output instead:
+              plugin_added, plugin_removed, theme_added, ... with the keys of
+              the find, and version_added, version_removed with 'version'.
+
+            - host_finished: 'elapsed', if the host was started in this
+              process.
+    """
+
+    errors_display = False
+
+    # record type for the finds of each kind of enumeration.
+    find_types = {
+        'plugins': 'plugin',
+        'themes': 'theme',
+        'interesting urls': 'interesting_url',
+    }
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+        self.started = {}
+        # host -> enumerates whose finds were output as they were found.
+        self.streamed = {}
+
+    def echo(self, msg):
+        pass
+
+    def record(self, record_type, host, **fields):
+        fields['type'] = record_type
+        fields['host'] = host
+        fields['time'] = time.time()
+        line = json.dumps(fields)
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+    def event(self, event, host, **fields):
+        if event == 'host_started':
+            with self.lock:
+                self.started[host] = time.time()
+
+        for enumerate in self.find_types:
+            if event == self.find_types[enumerate]:
+                with self.lock:
+                    self.streamed.setdefault(host, set()).add(enumerate)
+
+        self.record(event, host, **fields)
+
+    def result(self, result, functionality=None):
+        host = result.get('host')
+        with self.lock:
+            streamed = self.streamed.pop(host, set())
+
+        # In a fixed order, as results are dicts.
+        for enumerate in sorted(result):
+            if enumerate == 'host' or enumerate in streamed:
+                continue
+
+            finds = result[enumerate]['finds']
+            if enumerate == 'version':
+                self.record('version', host, candidates=finds)
+            elif enumerate in self.find_types:
+                for find in finds:
+                    self.record(self.find_types[enumerate], host, **find)
+            else:
+                self.record(enumerate, host, finds=finds)
+
+        self._host_finished(host)
+
+    def delta(self, delta, functionality=None):
+        host = delta.get('host')
+        for enumerate in sorted(delta):
+            if enumerate == 'host':
+                continue
+
+            find_type = self.find_types.get(enumerate, enumerate)
+            for key in ['added', 'removed']:
+                record_type = '%s_%s' % (find_type, key)
+                for find in delta[enumerate][key]:
+                    if isinstance(find, dict):
+                        self.record(record_type, host, **find)
+                    else:
+                        self.record(record_type, host, version=find)
+
+        self._host_finished(host)
+
+    def _host_finished(self, host):
+        with self.lock:
+            started = self.started.pop(host, None)
+
+        elapsed = time.time() - started if started else None
+        self.record('host_finished', host, elapsed=elapsed)
 
 def is_string(var):
     return isinstance(var, basestring)
@@ -169,6 +356,26 @@ def dict_combine(x, y):
     z.update(y)
     return z
 
+def cache_dir(*subdirs):
+    """
+        Returns the directory used to store compiled and cached data, creating
+        it if it doesn't exist. The location can be set with the
+        DROOPESCAN_CACHE environment variable.
+        @param subdirs path components to append, e.g. 'wordlists'
+    """
+    base = os.environ.get('DROOPESCAN_CACHE')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache', 'droopescan')
+
+    path = os.path.join(base, *subdirs)
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+    return path
+
 def file_len(fname):
     with open(fname) as f:
         for i, l in enumerate(f):
@@ -380,14 +587,32 @@ class VersionsFile():
 
         return False
 
-    def update(self, sums):
+    def sizes_missing(self):
+        """
+            @return the versions which have files without a recorded size,
+                e.g. because they were added before sizes were recorded.
+        """
+        versions = set()
+        for version in self.root.findall('./files/file/version'):
+            if 'size' not in version.attrib:
+                versions.add(version.attrib['nb'])
+
+        return sorted(versions)
+
+    def update(self, sums, sizes=None):
         """
             Update self.et with the sums as returned by VersionsX.sums_get
+            @param sizes optionally, the file sizes as returned by
+                VersionsX.sizes_get, which are recorded alongside the sums,
+                and for versions already present which have the same hash but
+                no size yet.
         """
+        sizes = sizes or {}
         for version in sums:
             hashes = sums[version]
             for filename in hashes:
                 hsh = hashes[filename]
+                size = sizes.get(version, {}).get(filename)
                 file_xpath = './files/file[@url="%s"]' % filename
                 try:
                     file_add = self.root.findall(file_xpath)[0]
@@ -402,6 +627,15 @@ class VersionsFile():
                             'nb': version
                     }
 
+                    if size is not None:
+                        new_ver.attrib['size'] = str(size)
+                elif size is not None:
+                    for ver in file_add.findall('./version'):
+                        if ver.attrib['nb'] == version and \
+                                ver.attrib['md5'] == hsh and \
+                                'size' not in ver.attrib:
+                            ver.attrib['size'] = str(size)
+
     def indent(self, elem, level=0):
         # @see http://effbot.org/zone/element-lib.htm#prettyprint
         i = "\n" + level*"  "
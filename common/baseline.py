@@ -0,0 +1,97 @@
+"""
+    Baselines, for monitoring hosts for changes. A baseline is the output of a
+    previous scan with --output json, one result per line, against which the
+    results of a new scan are compared.
+"""
+import hashlib
+import json
+import time
+
+def baseline_load(filename):
+    """
+        @param filename the output of a scan with JsonOutput.
+        @return a dict of host to its result. Lines which aren't results are
+            ignored, including the deltas output by a scan with --baseline.
+    """
+    baseline = {}
+    with open(filename) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                host = result['host']
+            except (ValueError, KeyError, TypeError):
+                continue
+
+            if is_result(result):
+                baseline[host] = result
+
+    return baseline
+
+def is_result(record):
+    """
+        @param record a JSON object with a 'host' key.
+        @return whether record is the result of a full scan, which has the
+            finds of at least one kind of enumeration, rather than a delta.
+    """
+    enumerates = [enumerate for enumerate in record if enumerate != 'host']
+    return len(enumerates) > 0 and all([isinstance(record[enumerate], dict)
+        and 'finds' in record[enumerate] for enumerate in enumerates])
+
+def find_key(find):
+    """
+        @return what identifies a find: the name of a plugin or theme, the URL
+            of an interesting URL, or the version number.
+    """
+    if isinstance(find, dict):
+        return find.get('name', find.get('url'))
+    else:
+        return find
+
+def delta_get(previous, result):
+    """
+        Compares the result of a scan with the result of a previous scan.
+        @param previous the result in the baseline, or None if the host is
+            not in it.
+        @param result as returned by BasePluginInternal.url_scan, with a
+            'host' key.
+        @return a dict with the host, and {'added': [...], 'removed': [...]}
+            for each kind of enumeration whose finds changed.
+    """
+    delta = {'host': result['host']}
+    for enumerate in result:
+        if enumerate == 'host':
+            continue
+
+        finds = result[enumerate]['finds']
+        previous_finds = []
+        if previous and enumerate in previous:
+            previous_finds = previous[enumerate]['finds']
+
+        keys = set([find_key(find) for find in finds])
+        previous_keys = set([find_key(find) for find in previous_finds])
+        added = [find for find in finds if find_key(find) not in previous_keys]
+        removed = [find for find in previous_finds if find_key(find) not in
+                keys]
+
+        if added or removed:
+            delta[enumerate] = {'added': added, 'removed': removed}
+
+    return delta
+
+def full_scan_due(host, days, now=None):
+    """
+        Spreads full scans of hosts evenly over a number of days, so that each
+        host is fully scanned once every days days.
+        @param host the host as supplied.
+        @param days the number of days between two full scans of a host.
+        @return whether host is due a full scan today.
+    """
+    if days <= 1:
+        return True
+
+    if now is None:
+        now = time.time()
+
+    day = int(now // 86400)
+    digest = hashlib.md5(host.encode('utf-8')).hexdigest()
+    return int(digest, 16) % days == day % days
@@ -0,0 +1,218 @@
+"""
+    Mock CMS sites, for benchmarking scans without network access. Every
+    MockSite listens on its own port on 127.0.0.1, so that each is a separate
+    host to the scheduler, and serves the files and folders that a scanning
+    plugin such as plugins.drupal.Drupal looks for.
+"""
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from common.fingerprint import fingerprint_get
+from SocketServer import ThreadingMixIn
+import common
+import math
+import re
+import socket
+import threading
+import time
+
+class SiteBehaviour():
+    # Folders respond with 403 Forbidden.
+    forbidden = 'forbidden'
+    # Folders respond with 404 Not Found.
+    not_found = 'not_found'
+    # Folders respond with 200 OK, as with directory listings.
+    ok = 'ok'
+    # Every URL responds with the same 200 OK page.
+    fake_200 = 'fake_200'
+    # Every URL redirects to the same path on another site.
+    redirect = 'redirect'
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Responses are sent in one write once handled, as web servers do.
+    # Unbuffered, every header is a separate packet, which on keep-alive
+    # connections stalls on delayed ACKs.
+    wbufsize = -1
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        site = self.server.site
+        site.request_record()
+        if site.latency:
+            time.sleep(site.latency)
+
+        status, location, body = site.response_get(self.path)
+        self.send_response(status)
+        if location:
+            self.send_header('Location', location)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def handle(self):
+        try:
+            BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            # Scanners may close connections early.
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """
+        Keeps track of open connections, so that those kept alive by
+        scanners can be closed when the site is stopped.
+    """
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    def connections_close(self):
+        with self.connections_lock:
+            connections = list(self.connections)
+
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+class MockSite():
+    """
+        A site running the CMS scanned by a plugin, with some of the
+        plugins and themes in the plugin's wordlists installed.
+    """
+
+    def __init__(self, plugin, behaviour=SiteBehaviour.forbidden,
+            plugins=(), themes=(), latency=0, file_size=2048,
+            redirect_to=None):
+        """
+            @param plugin the class of the plugin scanning this site, e.g.
+                plugins.drupal.Drupal.
+            @param behaviour a SiteBehaviour.
+            @param plugins names of the installed plugins.
+            @param themes names of the installed themes.
+            @param latency seconds to wait before responding to each request.
+            @param file_size size in bytes of every file served.
+            @param redirect_to the URL of the site to redirect to, for
+                SiteBehaviour.redirect.
+        """
+        self.behaviour = behaviour
+        self.latency = latency
+        self.redirect_to = redirect_to
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.server = None
+
+        self.folders = set([self._path(plugin.folder_url)])
+        self.files = set()
+        regular_file_url = plugin.regular_file_url
+        if not common.is_string(regular_file_url):
+            regular_file_url = regular_file_url[0]
+        self.files.add(self._path(regular_file_url))
+
+        for base_urls, names in [(plugin.plugins_base_url, plugins),
+                (plugin.themes_base_url, themes)]:
+            if not base_urls:
+                continue
+            if common.is_string(base_urls):
+                base_urls = [base_urls]
+
+            # Installed in the default location only.
+            base_url = base_urls[0]
+            self.folders.add(self._path(base_url[:base_url.rindex('%s')] % ''))
+            for name in names:
+                folder = self._path(base_url % ('', name))
+                self.folders.add(folder)
+                self.files.add(folder + plugin.module_readme_file)
+
+        for path, description in plugin.interesting_urls:
+            self.files.add(self._path(path))
+
+        if plugin.versions_file:
+            for file_url in fingerprint_get(plugin.versions_file).files_get():
+                self.files.add(self._path(file_url))
+
+        self.file_body = ('/* %s */\n' % plugin.__name__).ljust(file_size, 'x')
+        self.not_found_body = '<html><body>Page not found.</body></html>'
+
+    def _path(self, path):
+        return re.sub('/+', '/', '/' + path)
+
+    def response_get(self, path):
+        """
+            @return (status code, Location header or None, body) for path.
+        """
+        path = self._path(path.split('?')[0])
+        if self.behaviour == SiteBehaviour.redirect:
+            return 301, self.redirect_to.rstrip('/') + path, ''
+        elif self.behaviour == SiteBehaviour.fake_200:
+            return 200, None, self.not_found_body
+        elif path in self.files:
+            return 200, None, self.file_body
+        elif path in self.folders:
+            if self.behaviour == SiteBehaviour.forbidden:
+                return 403, None, ''
+            elif self.behaviour == SiteBehaviour.ok:
+                return 200, None, '<html><body>Index of %s</body></html>' % path
+
+        return 404, None, self.not_found_body
+
+    def request_record(self):
+        with self.lock:
+            self.requests += 1
+
+    def start(self):
+        self.server = MockServer(('127.0.0.1', 0), MockHandler)
+        self.server.site = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.connections_close()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/' % self.server.server_port
+
+def percentile(values, pct):
+    """
+        @param values a list of numbers.
+        @param pct e.g. 50 for the median.
+        @return the nearest-rank percentile of values, or None if values is
+            empty.
+    """
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
@@ -0,0 +1,162 @@
+"""
+    Index of what every scanning plugin can do, as shown by the stats command.
+    Computing it reads every wordlist, runs git for every wordlist and parses
+    every versions file, so it is kept in a JSON file which is only rebuilt
+    when one of those files changes or scanning plugins are added or removed.
+"""
+from common import cache_dir
+import hashlib
+import json
+import os
+import threading
+
+INDEX_VERSION = 1
+
+def index_path():
+    return os.path.join(cache_dir('capabilities'), 'index.json')
+
+def sources_get(plugin):
+    """
+        @param plugin a class extending BasePlugin.
+        @return the files its capabilities are computed from.
+    """
+    sources = []
+    if plugin.can_enumerate_plugins:
+        sources.append(plugin.plugins_file)
+    if plugin.can_enumerate_themes:
+        sources.append(plugin.themes_file)
+    if plugin.can_enumerate_version:
+        sources.append(plugin.versions_file)
+
+    return sources
+
+def source_state(filename):
+    """
+        @return the size, mtime and md5 of filename, which tell whether it
+            changed.
+    """
+    stat = os.stat(filename)
+    with open(filename, 'rb') as f:
+        md5 = hashlib.md5(f.read()).hexdigest()
+
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': md5}
+
+def index_build(labels, plugins):
+    """
+        @param labels the labels of the scanning plugins.
+        @param plugins the classes of the scanning plugins.
+        @return a new index.
+    """
+    # Imports every plugin's dependencies, which only building needs.
+    from common.plugins_util import Plugin
+
+    index = {'version': INDEX_VERSION, 'labels': sorted(labels),
+            'plugins': [], 'sources': {}}
+    for plugin in plugins:
+        index['plugins'].append(Plugin(plugin).as_dict())
+        for filename in sources_get(plugin):
+            index['sources'][filename] = source_state(filename)
+
+    return index
+
+def index_check(index, labels):
+    """
+        Checks whether index is still current. Files whose size or mtime
+        changed are hashed, and only count as changed if their hash did; their
+        new size and mtime are then stored in index.
+        @return (whether index is current, whether index was updated).
+    """
+    if index.get('version') != INDEX_VERSION or \
+            index.get('labels') != sorted(labels):
+        return False, False
+
+    updated = False
+    for filename, state in index['sources'].items():
+        try:
+            stat = os.stat(filename)
+            if stat.st_size == state['size'] and \
+                    stat.st_mtime == state['mtime']:
+                continue
+
+            new_state = source_state(filename)
+        except OSError:
+            return False, False
+
+        if new_state['md5'] != state['md5']:
+            return False, False
+
+        index['sources'][filename] = new_state
+        updated = True
+
+    return True, updated
+
+def index_write(filename, index):
+    """
+        Writes index under a temporary name and then renames it, so that
+        concurrent readers never see a partially written file.
+    """
+    tmp_filename = '%s.%s.%s.tmp' % (filename, os.getpid(),
+            threading.current_thread().ident)
+    with open(tmp_filename, 'w') as f:
+        json.dump(index, f)
+
+    os.rename(tmp_filename, filename)
+
+def capabilities_get(labels, plugins_load, filename=None):
+    """
+        @param labels the labels of the enabled scanning plugins.
+        @param plugins_load a function which loads the scanning plugins with
+            labels and returns their classes. Only called if the index needs
+            to be rebuilt.
+        @param filename the index file. Defaults to index_path().
+        @return a list of dicts with the capabilities of every plugin, as
+            returned by common.plugins_util.Plugin.as_dict
+    """
+    filename = filename or index_path()
+    try:
+        with open(filename) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        index = {}
+
+    current, updated = index_check(index, labels)
+    if not current:
+        index = index_build(labels, plugins_load(labels))
+
+    if not current or updated:
+        index_write(filename, index)
+
+    return index['plugins']
+
+def time_ago(timestamp, now):
+    """
+        Formats a time relative to now, as git does for '%cr'.
+        @param timestamp seconds since the epoch.
+        @return e.g. '3 days ago'.
+    """
+    seconds = int(now - timestamp)
+    units = [
+        (90, 1, 'second'),
+        (90 * 60, 60, 'minute'),
+        (36 * 3600, 3600, 'hour'),
+        (14 * 86400, 86400, 'day'),
+        (70 * 86400, 7 * 86400, 'week'),
+        (365 * 86400, 30 * 86400, 'month'),
+    ]
+
+    if seconds < 0:
+        return 'in the future'
+
+    for limit, length, unit in units:
+        if seconds < limit:
+            return plural(int(round(float(seconds) / length)), unit) + ' ago'
+
+    years = seconds // (365 * 86400)
+    months = int(round(float(seconds % (365 * 86400)) / (30 * 86400)))
+    if months == 0 or months == 12:
+        return plural(years + months // 12, 'year') + ' ago'
+    else:
+        return '%s, %s ago' % (plural(years, 'year'), plural(months, 'month'))
+
+def plural(count, unit):
+    return '%s %s%s' % (count, unit, '' if count == 1 else 's')
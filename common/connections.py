@@ -0,0 +1,44 @@
+"""
+    Persistent connections for requests.Session. Every host gets its own pool
+    of keep-alive connections, sized to the number of requests the scheduler
+    sends it at once, so that each host's requests are spread over a few
+    connections which are reused for the whole scan instead of being opened
+    and discarded as pools churn.
+"""
+from requests.adapters import HTTPAdapter
+
+class PooledAdapter(HTTPAdapter):
+    """
+        A requests adapter which keeps up to pool_connections hosts' pools,
+        of up to pool_maxsize connections each. Requests wait for a free
+        connection rather than opening extra ones which would be discarded
+        straight away. How many connections were opened and reused is
+        recorded in metrics when pools are disposed of, i.e. when a host's
+        pool is evicted or the adapter is closed.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=True,
+            metrics=None):
+        """
+            @param pool_connections the number of hosts whose pools are kept.
+                Should be at least the number of hosts scanned at once.
+            @param pool_maxsize the number of connections kept per host.
+                Should be the most requests sent to a single host at once.
+            @param pool_block whether requests wait for a free connection
+                once a host has pool_maxsize connections in use.
+            @param metrics a common.metrics.Metrics, or None.
+        """
+        self.metrics = metrics
+        HTTPAdapter.__init__(self, pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize, pool_block=pool_block)
+
+    def init_poolmanager(self, connections, maxsize, block=False):
+        HTTPAdapter.init_poolmanager(self, connections, maxsize, block=block)
+        self.poolmanager.pools.dispose_func = self._pool_dispose
+
+    def _pool_dispose(self, pool):
+        if self.metrics:
+            self.metrics.connections_record(pool.num_connections,
+                    pool.num_requests)
+
+        pool.close()
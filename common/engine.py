@@ -0,0 +1,618 @@
+"""
+    HTTP engines used when enumerating plugins and themes. All engines expose
+    the same interface: submit() returns a future which resolves to the status
+    code of the response, and close() waits for outstanding work.
+"""
+from concurrent.futures import Future
+from common import base_url
+from common.scheduler import RETRY_EXCEPTIONS, RETRY_STATUSES, retry_delay
+from requests.exceptions import ConnectionError, Timeout
+from urlparse import urlsplit
+import errno
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+
+POLLIN = getattr(select, 'POLLIN', 1)
+POLLOUT = getattr(select, 'POLLOUT', 4)
+
+class ThreadEngine():
+    """
+        Performs requests through a requests.Session on the threads of a
+        common.scheduler.Scheduler. Supports everything requests does (proxies,
+        .netrc, etc.)
+    """
+
+    def __init__(self, session, scheduler):
+        self.session = session
+        self.scheduler = scheduler
+
+    def submit(self, verb, url, timeout=15):
+        requests_verb = getattr(self.session, verb)
+        return self.scheduler.submit(base_url(url), self._status_get,
+                requests_verb, url, timeout)
+
+    def _status_get(self, requests_verb, url, timeout=15):
+        """
+            Performs a request and returns only its status code, so that the
+            response (and its body) can be released straight away.
+        """
+        r = requests_verb(url, timeout=timeout)
+        return r.status_code
+
+    def close(self):
+        # The scheduler is shared, and is shut down by its owner.
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+class AsyncEngine():
+    """
+        Performs requests from a single event loop thread using non-blocking
+        sockets, which allows for a large number of concurrent requests at a
+        fraction of the cost of one thread per request.
+
+        Only the status line and headers are used. Connections are kept alive
+        and reused for later requests to the same host, unless the response
+        has a body larger than max_drain, which would have to be read first,
+        or no length. Proxy environment variables and .netrc files are not
+        honoured by this engine. Requests take their slots from a
+        common.scheduler.Scheduler, so they share its global and per-host
+        limits and its HostControllers with the rest of the scan, and are
+        retried as its tasks are.
+    """
+
+    recv_size = 8192
+    max_header_size = 65536
+    # Largest response body read and discarded to reuse its connection.
+    max_drain = 65536
+
+    def __init__(self, scheduler, headers=None):
+        """
+            @param scheduler the common.scheduler.Scheduler whose limits are
+                shared. Its retries and metrics are used for this engine's
+                requests.
+            @param headers a dict of headers sent with every request, such as
+                the User-Agent.
+        """
+        self.scheduler = scheduler
+        self.headers = dict(headers) if headers else {}
+        self.metrics = scheduler.metrics
+        self.retries = scheduler.retries
+
+        self.lock = threading.Lock()
+        # Requests which were given a slot, for the event loop to start.
+        self.started = []
+        # Requests submitted whose future isn't resolved yet.
+        self.pending = 0
+        self.closed = False
+        self.addresses = {}
+        # (https, address) -> [(socket, requests sent over it)], only used by
+        # the event loop thread.
+        self.idle = {}
+        self.wake_r, self.wake_w = os.pipe()
+        self.thread = None
+
+        self.ssl_context = None
+        if hasattr(ssl, 'SSLContext'):
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+
+    def submit(self, verb, url, timeout=15):
+        future = Future()
+        try:
+            request = _AsyncRequest(self, future, verb, url, timeout)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop)
+                self.thread.daemon = True
+                self.thread.start()
+
+            self.pending += 1
+
+        self.scheduler.acquire(base_url(url), self._start, request)
+        return future
+
+    def _start(self, host, request):
+        with self.lock:
+            self.started.append((host, request))
+
+        os.write(self.wake_w, 'x')
+
+    def _retry(self, host, request):
+        self.scheduler.acquire(host, self._start, request, first=True)
+
+    def address_get(self, host, port):
+        """
+            Resolves host on the caller's thread, so that DNS lookups do not
+            block the event loop. Results are cached for the lifetime of the
+            engine.
+        """
+        key = (host, port)
+        if key not in self.addresses:
+            try:
+                info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            except socket.gaierror as e:
+                raise ConnectionError(e)
+
+            self.addresses[key] = info[0]
+
+        return self.addresses[key]
+
+    def connection_get(self, key):
+        """
+            @return an idle (socket, requests sent over it) to key, or None.
+        """
+        connections = self.idle.get(key)
+        if connections:
+            return connections.pop()
+
+    def connection_put(self, key, sock, requests):
+        """
+            Keeps a connection, which has no request in flight, for the next
+            request to key. At most as many connections as requests which
+            can be sent to a single host at once are kept.
+        """
+        connections = self.idle.setdefault(key, [])
+        if len(connections) < self.scheduler.queue.host_max_running:
+            connections.append((sock, requests))
+        else:
+            self.connection_close(sock, requests)
+
+    def connection_close(self, sock, requests):
+        if self.metrics:
+            self.metrics.connections_record(1, requests)
+
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            thread = self.thread
+
+        os.write(self.wake_w, 'x')
+        if thread:
+            thread.join()
+
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def _loop(self):
+        poller = _Poller()
+        poller.register(self.wake_r, POLLIN)
+        active = {}
+        while True:
+            with self.lock:
+                started, self.started = self.started, []
+
+            for host, request in started:
+                request.start()
+                if request.finished:
+                    self._done(host, request)
+                else:
+                    active[request.sock.fileno()] = (host, request)
+                    poller.register(request.sock.fileno(), request.events)
+
+            with self.lock:
+                if self.closed and not self.pending:
+                    break
+
+            now = time.time()
+            wait = None
+            for host, request in active.values():
+                remaining = max(request.deadline - now, 0)
+                if wait is None or remaining < wait:
+                    wait = remaining
+
+            for fd, event in poller.poll(wait):
+                if fd == self.wake_r:
+                    os.read(self.wake_r, 4096)
+                    continue
+
+                host, request = active[fd]
+                events_before = request.events
+                request.handle(event)
+                if request.finished:
+                    poller.unregister(fd)
+                    del active[fd]
+                    self._done(host, request)
+                elif request.sock.fileno() != fd:
+                    # Reconnected, as a reused connection had been closed.
+                    poller.unregister(fd)
+                    del active[fd]
+                    active[request.sock.fileno()] = (host, request)
+                    poller.register(request.sock.fileno(), request.events)
+                elif request.events != events_before:
+                    poller.modify(fd, request.events)
+
+            now = time.time()
+            for fd, (host, request) in active.items():
+                if request.deadline <= now:
+                    poller.unregister(fd)
+                    del active[fd]
+                    request.fail(Timeout('Request to %s timed out.' %
+                        request.url))
+                    self._done(host, request)
+
+        for connections in self.idle.values():
+            for sock, requests in connections:
+                self.connection_close(sock, requests)
+
+        self.idle = {}
+
+    def _done(self, host, request):
+        """
+            Called from the event loop once request has finished, whether
+            successfully or not. Either resolves its future or retries it.
+        """
+        timed_out = isinstance(request.exception, Timeout)
+        retryable = isinstance(request.exception, RETRY_EXCEPTIONS)
+        controller = self.scheduler.controller_get(host)
+        if not request.exception:
+            controller.record(request.latency, request.status_code)
+        elif retryable:
+            controller.record(timed_out=timed_out, failed=not timed_out)
+
+        self.scheduler.release(host)
+
+        if self.metrics:
+            if timed_out:
+                self.metrics.request_record('timeout')
+            elif request.exception:
+                self.metrics.request_record(
+                        request.exception.__class__.__name__)
+            else:
+                self.metrics.request_record(request.status_code,
+                        request.latency)
+
+        can_retry = request.attempt < self.retries and not self.closed
+        if can_retry and (retryable or
+                request.status_code in RETRY_STATUSES):
+            if self.metrics:
+                self.metrics.retry_record()
+
+            retry = _AsyncRequest(self, request.future, request.verb,
+                    request.url, request.timeout, request.attempt + 1)
+            timer = threading.Timer(retry_delay(retry.attempt), self._retry,
+                    (host, retry))
+            timer.daemon = True
+            timer.start()
+        else:
+            with self.lock:
+                self.pending -= 1
+
+            if request.exception:
+                request.future.set_exception(request.exception)
+            else:
+                request.future.set_result(request.status_code)
+
+class _Poller():
+    """
+        Thin wrapper around select.poll, which falls back to select.select on
+        platforms that do not support poll.
+    """
+
+    def __init__(self):
+        if hasattr(select, 'poll'):
+            self.poll_obj = select.poll()
+        else:
+            self.poll_obj = None
+            self.fds = {}
+
+    def register(self, fd, events):
+        if self.poll_obj:
+            self.poll_obj.register(fd, events)
+        else:
+            self.fds[fd] = events
+
+    def modify(self, fd, events):
+        if self.poll_obj:
+            self.poll_obj.modify(fd, events)
+        else:
+            self.fds[fd] = events
+
+    def unregister(self, fd):
+        if self.poll_obj:
+            self.poll_obj.unregister(fd)
+        else:
+            del self.fds[fd]
+
+    def poll(self, timeout):
+        if self.poll_obj:
+            return self.poll_obj.poll(None if timeout is None else timeout * 1000)
+
+        readers = [fd for fd in self.fds if self.fds[fd] & POLLIN]
+        writers = [fd for fd in self.fds if self.fds[fd] & POLLOUT]
+        r, w, x = select.select(readers, writers, [], timeout)
+        return [(fd, POLLIN) for fd in r] + \
+                [(fd, POLLOUT) for fd in w]
+
+class _AsyncRequest():
+    """
+        State machine for a single request: connect, optionally perform a TLS
+        handshake, send the request, read the response headers and, if the
+        connection can be reused, the response body.
+    """
+
+    def __init__(self, engine, future, verb, url, timeout, attempt=0):
+        self.engine = engine
+        self.future = future
+        self.verb = verb
+        self.url = url
+        self.timeout = timeout
+        self.attempt = attempt
+
+        self.finished = False
+        self.status_code = None
+        self.exception = None
+        self.latency = None
+
+        split = urlsplit(url)
+        self.https = split.scheme == 'https'
+        self.host = split.hostname
+        port = split.port or (443 if self.https else 80)
+        self.family, _, _, _, self.address = engine.address_get(self.host, port)
+        self.key = (self.https, self.address)
+
+        path = split.path or '/'
+        if split.query:
+            path += '?' + split.query
+
+        host_header = split.netloc.split('@')[-1]
+        headers = dict(engine.headers)
+        headers['Host'] = host_header
+        headers.setdefault('Accept', '*/*')
+
+        lines = ['%s %s HTTP/1.1' % (verb.upper(), path)]
+        for name in headers:
+            lines.append('%s: %s' % (name, headers[name]))
+
+        self.request = '\r\n'.join(lines) + '\r\n\r\n'
+
+    def start(self):
+        self.started = time.time()
+        self.deadline = self.started + self.timeout
+        connection = self.engine.connection_get(self.key)
+        if connection:
+            self.sock, self.requests = connection
+            self.reused = True
+            self._sending()
+        else:
+            self._connect()
+
+    def _connect(self):
+        self.sock = None
+        self.requests = 0
+        self.reused = False
+        try:
+            self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+            self.sock.setblocking(0)
+            err = self.sock.connect_ex(self.address)
+        except socket.error as e:
+            self.fail(ConnectionError('Connection to %s failed: %s' %
+                (self.url, e)))
+            return
+
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.fail(ConnectionError('Connection to %s failed: %s' %
+                (self.url, os.strerror(err))))
+            return
+
+        self.state = 'connecting'
+        self.events = POLLOUT
+
+    def _reconnect(self):
+        """
+            Connects again if the request was sent over a reused connection
+            which the server closed while it was idle.
+            @return whether the request is being retried on a new connection.
+        """
+        if not self.reused or self.in_buffer:
+            return False
+
+        self.engine.connection_close(self.sock, self.requests)
+        self._connect()
+        return True
+
+    def handle(self, event):
+        try:
+            if self.state == 'connecting':
+                self._connected()
+            elif self.state == 'handshake':
+                self._handshake()
+            elif self.state == 'sending':
+                self._send()
+            elif self.state == 'reading':
+                self._read()
+            elif self.state == 'draining':
+                self._drain()
+        except (socket.error, ssl.SSLError) as e:
+            if not self._reconnect():
+                self.fail(ConnectionError('Connection to %s failed: %s' %
+                    (self.url, e)))
+        except Exception as e:
+            self.fail(e)
+
+    def _connected(self):
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            raise socket.error(err, os.strerror(err))
+
+        if self.https:
+            context = self.engine.ssl_context
+            if context:
+                self.sock = context.wrap_socket(self.sock,
+                        server_hostname=self.host,
+                        do_handshake_on_connect=False)
+            else:
+                self.sock = ssl.wrap_socket(self.sock,
+                        do_handshake_on_connect=False)
+
+            self.state = 'handshake'
+            self._handshake()
+        else:
+            self._sending()
+            self._send()
+
+    def _handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.events = POLLIN
+                return
+            elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.events = POLLOUT
+                return
+            raise
+
+        self._sending()
+        self._send()
+
+    def _sending(self):
+        self.out_buffer = self.request
+        self.in_buffer = ''
+        self.state = 'sending'
+        self.events = POLLOUT
+
+    def _send(self):
+        try:
+            sent = self.sock.send(self.out_buffer)
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+
+        self.out_buffer = self.out_buffer[sent:]
+        if self.out_buffer:
+            self.events = POLLOUT
+        else:
+            self.state = 'reading'
+            self.events = POLLIN
+
+    def _recv(self):
+        """
+            @return the data received, '' if the connection was closed, or
+                None if there is nothing to read yet.
+        """
+        try:
+            return self.sock.recv(self.engine.recv_size)
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return None
+            raise
+
+    def _read(self):
+        data = self._recv()
+        if data is None:
+            return
+
+        if not data and self._reconnect():
+            return
+
+        self.in_buffer += data
+        head, separator, body = self.in_buffer.partition('\r\n\r\n')
+        headers_complete = separator != ''
+        if not data or headers_complete or \
+                len(self.in_buffer) > self.engine.max_header_size:
+            lines = head.split('\r\n')
+            try:
+                status_code = int(lines[0].split(' ')[1])
+            except (IndexError, ValueError):
+                self.fail(ConnectionError('Invalid response from %s.' %
+                    self.url))
+                return
+
+            self.status_code = status_code
+            self.latency = time.time() - self.started
+            self.requests += 1
+
+            length = None
+            if data and headers_complete:
+                length = self._body_length(lines)
+
+            if length is None:
+                self._close()
+            else:
+                self.remaining = length - len(body)
+                self.state = 'draining'
+                self._drained()
+
+    def _body_length(self, lines):
+        """
+            @param lines the status line and headers of the response.
+            @return the length of the response body, or None if the
+                connection can't be reused.
+        """
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        keep_alive = lines[0].startswith('HTTP/1.1')
+        if 'connection' in headers:
+            keep_alive = headers['connection'] == 'keep-alive'
+
+        if not keep_alive:
+            return None
+        elif self.verb == 'head' or self.status_code in (204, 304) or \
+                100 <= self.status_code < 200:
+            return 0
+        elif 'transfer-encoding' in headers:
+            return None
+
+        length = headers.get('content-length', '')
+        if length.isdigit() and int(length) <= self.engine.max_drain:
+            return int(length)
+        else:
+            return None
+
+    def _drain(self):
+        data = self._recv()
+        if data is None:
+            return
+
+        if not data:
+            self._close()
+        else:
+            self.remaining -= len(data)
+            self._drained()
+
+    def _drained(self):
+        if self.remaining == 0:
+            self.finished = True
+            self.engine.connection_put(self.key, self.sock, self.requests)
+        elif self.remaining < 0:
+            # More data than announced, the connection can't be trusted.
+            self._close()
+
+    def fail(self, exception):
+        self._close()
+        self.exception = exception
+
+    def _close(self):
+        self.finished = True
+        if self.sock is not None:
+            self.engine.connection_close(self.sock, self.requests)
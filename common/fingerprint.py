@@ -0,0 +1,205 @@
+"""
+    Compiled fingerprint databases. A versions.xml file is parsed once into a
+    FingerprintIndex, which maps (file url, md5) to the versions that file had
+    that hash in, so that identifying a version costs one dictionary lookup
+    per file. Indexes are cached on disk and reused for as long as the XML
+    file is unchanged.
+"""
+from common import cache_dir, VersionsFile
+import cPickle as pickle
+import hashlib
+import os
+import threading
+
+_indexes = {}
+_lock = threading.Lock()
+
+def fingerprint_get(xml_file):
+    """
+        Returns the FingerprintIndex for xml_file. Indexes are loaded once per
+        process, from the disk cache if it is current.
+        @param xml_file path to a versions.xml file.
+        @return a FingerprintIndex.
+    """
+    path = os.path.abspath(xml_file)
+    with _lock:
+        if path not in _indexes:
+            _indexes[path] = FingerprintIndex.load(path)
+
+        return _indexes[path]
+
+def compiled_path(xml_file):
+    key = hashlib.md5(os.path.abspath(xml_file)).hexdigest()
+    return os.path.join(cache_dir('fingerprints'), key + '.pickle')
+
+class FingerprintIndex():
+    """
+        Read-only version of the queries in common.VersionsFile which are
+        needed to identify a version.
+    """
+    # Increase when the attributes of this class change, so that stale
+    # caches are discarded.
+    format_version = 3
+
+    source_size = None
+    source_mtime = None
+
+    def __init__(self, vf):
+        """
+            @param vf a common.VersionsFile.
+        """
+        self.files = vf.files_get()
+        self.hashes = {}
+        # file url -> md5 -> versions, used to narrow down candidates.
+        self.file_versions = {}
+        # file url -> size -> md5s, for files with a size for every version.
+        self.file_sizes = {}
+        versions = set()
+        for file in vf.root.iter('file'):
+            url = file.attrib['url']
+            per_hash = {}
+            per_size = {}
+            for version in file.findall('version'):
+                nb = version.attrib['nb']
+                md5 = version.attrib['md5']
+                self.hashes[(url, md5)] = self.hashes.get((url, md5), ()) + \
+                        (nb,)
+                per_hash.setdefault(md5, set()).add(nb)
+                versions.add(nb)
+
+                if per_size is not None and 'size' in version.attrib:
+                    size = int(version.attrib['size'])
+                    per_size.setdefault(size, set()).add(md5)
+                else:
+                    per_size = None
+
+            self.file_versions[url] = dict((md5, frozenset(per_hash[md5]))
+                    for md5 in per_hash)
+            if per_size:
+                self.file_sizes[url] = dict((size, sorted(per_size[size]))
+                        for size in per_size)
+
+        self.versions = frozenset(versions)
+
+        self.changelog_url = None
+        self.changelog_hashes = {}
+        if vf.has_changelog():
+            self.changelog_url = vf.changelog_get()
+            versions = vf.root.findall(vf.changelog_xpath + '/version')
+            for version in reversed(versions):
+                # The first match wins, as in VersionsFile.changelog_identify.
+                self.changelog_hashes[version.attrib['md5']] = \
+                        version.attrib['nb']
+
+    @classmethod
+    def load(cls, xml_file):
+        """
+            Loads the index for xml_file from the disk cache, building and
+            caching it if necessary.
+        """
+        stat = os.stat(xml_file)
+        filename = compiled_path(xml_file)
+        try:
+            with open(filename, 'rb') as f:
+                index = pickle.load(f)
+
+            if index.format_version == cls.format_version and \
+                    index.source_size == stat.st_size and \
+                    index.source_mtime == stat.st_mtime:
+                return index
+        except Exception:
+            # Missing, corrupt or stale caches are rebuilt.
+            pass
+
+        index = cls(VersionsFile(xml_file))
+        index.source_size = stat.st_size
+        index.source_mtime = stat.st_mtime
+
+        tmp_filename = '%s.%s.%s.tmp' % (filename, os.getpid(),
+                threading.current_thread().ident)
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, filename)
+
+        return index
+
+    def files_get(self):
+        return list(self.files)
+
+    def has_changelog(self):
+        return self.changelog_url is not None
+
+    def changelog_get(self):
+        return self.changelog_url
+
+    def changelog_identify(self, ch_hash):
+        return self.changelog_hashes.get(ch_hash, False)
+
+    def versions_with(self, file_url, file_hash):
+        """
+            @return the versions in which file_url has the md5 file_hash.
+        """
+        return self.file_versions.get(file_url, {}).get(file_hash, frozenset())
+
+    def has_sizes(self, file_url):
+        """
+            @return whether the size of file_url is known for every version.
+        """
+        return file_url in self.file_sizes
+
+    def hashes_with_size(self, file_url, size):
+        """
+            @return the md5s file_url has when it is size bytes long.
+        """
+        return self.file_sizes[file_url].get(size, [])
+
+    def file_next(self, candidates, fetched, must_split=True):
+        """
+            Chooses the file whose hash best narrows down candidates, that is,
+            the one which leaves the fewest candidates on average.
+            @param candidates a set of versions the target may be running.
+            @param fetched files which were already requested.
+            @param must_split if False, a file which can't tell the
+                candidates apart may be returned, as long as it has a known
+                hash for one of them.
+            @return a file url, or None if no file is worth requesting.
+        """
+        best = None
+        best_score = None
+        for file_url in self.files:
+            if file_url in fetched:
+                continue
+
+            buckets = [len(nbs & candidates) for nbs in
+                    self.file_versions[file_url].values()]
+            present = sum(buckets)
+            if present == 0:
+                continue
+
+            # Candidates without this file end up in a bucket of their own.
+            buckets.append(max(len(candidates) - present, 0))
+            if must_split and max(buckets) == len(candidates):
+                continue
+
+            score = sum([b * b for b in buckets])
+            if best_score is None or score < best_score:
+                best, best_score = file_url, score
+
+        return best
+
+    def version_get(self, url_hash):
+        """
+            Same as VersionsFile.version_get.
+            @param url_hash a dict of file url to the md5 of its contents.
+            @return the versions which match the most files, sorted.
+        """
+        matches = {}
+        for url in url_hash:
+            for version_nb in self.hashes.get((url, url_hash[url]), ()):
+                matches[version_nb] = matches.get(version_nb, 0) + 1
+
+        if len(matches) == 0:
+            return []
+
+        highest_nb = max(matches.values())
+        return sorted([nb for nb in matches if matches[nb] == highest_nb])
@@ -0,0 +1,98 @@
+"""
+    Scan journal, which allows long scans to be resumed. The journal is an
+    append-only file with one JSON object per line, recording the result of
+    every phase of every host as soon as it completes.
+"""
+import json
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class Journal():
+    """
+        Records the phases completed for each host. Phases are
+        'scanning_method', the names of the enabled functionality (e.g.
+        'plugins', 'version') and 'done', which is recorded once the results
+        for the host have been output. Only 'done' is kept for hosts which
+        are done, so that memory doesn't grow with the results of every host.
+
+        A journal can be written to by processes forked after it was opened,
+        as every entry is appended under an exclusive lock on the file.
+    """
+
+    def __init__(self, filename, resume=False):
+        """
+            @param filename the file the journal is kept in.
+            @param resume if True, entries already in filename are loaded and
+                new ones are appended. Otherwise the file is truncated.
+        """
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.done = set()
+        if resume:
+            self._load(filename)
+            self.f = open(filename, 'a')
+        else:
+            self.f = open(filename, 'w')
+
+    def _load(self, filename):
+        try:
+            f = open(filename)
+        except IOError:
+            return
+
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    host, phase = entry['host'], entry['phase']
+                except (ValueError, KeyError, TypeError):
+                    # The last line may be incomplete if the scan was killed.
+                    continue
+
+                self._set(host, phase, entry.get('result'))
+
+    def _set(self, host, phase, result):
+        if phase == 'done':
+            self.phases.pop(host, None)
+            self.done.add(host)
+        elif host not in self.done:
+            self.phases.setdefault(host, {})[phase] = result
+
+    def get(self, host, phase):
+        """
+            @return the result recorded for phase of host, or None.
+        """
+        with self.lock:
+            return self.phases.get(host, {}).get(phase)
+
+    def has(self, host, phase):
+        with self.lock:
+            if host in self.done:
+                return phase == 'done'
+
+            return phase in self.phases.get(host, {})
+
+    def record(self, host, phase, result=None):
+        """
+            Appends an entry to the journal and flushes it to disk.
+            @param result a JSON serializable object.
+        """
+        line = json.dumps({'host': host, 'phase': phase, 'result': result})
+        with self.lock:
+            self._set(host, phase, result)
+            if fcntl:
+                fcntl.flock(self.f, fcntl.LOCK_EX)
+            try:
+                self.f.write(line + '\n')
+                self.f.flush()
+            finally:
+                if fcntl:
+                    fcntl.flock(self.f, fcntl.LOCK_UN)
+
+    def close(self):
+        with self.lock:
+            self.f.close()
@@ -0,0 +1,198 @@
+"""
+    Scan metrics: time spent per phase, requests by status code, bytes,
+    latency and retries, and connections opened and reused. Metrics can be
+    reported as JSON or in the Prometheus text format.
+"""
+
+import json
+import threading
+
+# Upper bounds, in seconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics():
+    """
+        Thread-safe counters for a scan.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.statuses = {}
+        self.retries = 0
+        self.bytes = 0
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def phase_record(self, phase, elapsed):
+        """
+            @param phase e.g. 'scanning_method', 'plugins' or 'version'.
+            @param elapsed wall time spent in the phase, in seconds.
+        """
+        with self.lock:
+            count, seconds = self.phases.get(phase, (0, 0.0))
+            self.phases[phase] = (count + 1, seconds + elapsed)
+
+    def request_record(self, status, latency=None, nb_bytes=0):
+        """
+            @param status the status code of the response, or a description
+                of the error, such as 'timeout'.
+            @param latency seconds until the response headers were received.
+            @param nb_bytes size of the response body.
+        """
+        status = str(status)
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.bytes += nb_bytes
+            if latency is not None:
+                self.latency_sum += latency
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    if latency <= bound:
+                        break
+                else:
+                    i = len(LATENCY_BUCKETS)
+
+                self.latency_counts[i] += 1
+
+    def retry_record(self):
+        with self.lock:
+            self.retries += 1
+
+    def connections_record(self, opened, requests):
+        """
+            @param opened the number of connections opened to a host.
+            @param requests the number of requests sent over them.
+        """
+        with self.lock:
+            self.connections_opened += opened
+            self.connections_reused += max(0, requests - opened)
+
+    def response_hook(self, r, *args, **kwargs):
+        """
+            requests response hook, which records every response received
+            through a session, including redirects.
+        """
+        nb_bytes = 0
+        length = r.headers.get('content-length')
+        if r.request.method != 'HEAD' and length and length.isdigit():
+            nb_bytes = int(length)
+
+        self.request_record(r.status_code, r.elapsed.total_seconds(), nb_bytes)
+
+    def report(self):
+        """
+            @return a JSON serializable dict with every metric.
+        """
+        with self.lock:
+            phases = {}
+            for phase in self.phases:
+                count, seconds = self.phases[phase]
+                phases[phase] = {'count': count, 'seconds': seconds}
+
+            return {
+                'phases': phases,
+                'requests': {
+                    'total': sum(self.statuses.values()),
+                    'by_status': dict(self.statuses),
+                    'retries': self.retries,
+                    'bytes': self.bytes,
+                    'latency': {
+                        'buckets': list(LATENCY_BUCKETS),
+                        'counts': list(self.latency_counts),
+                        'sum': self.latency_sum,
+                    },
+                },
+                'connections': {
+                    'opened': self.connections_opened,
+                    'reused': self.connections_reused,
+                },
+            }
+
+    def merge(self, report):
+        """
+            Adds the metrics in report, as returned by report(), e.g. from
+            another process.
+        """
+        requests = report['requests']
+        with self.lock:
+            for phase in report['phases']:
+                count, seconds = self.phases.get(phase, (0, 0.0))
+                self.phases[phase] = (count + report['phases'][phase]['count'],
+                        seconds + report['phases'][phase]['seconds'])
+
+            for status in requests['by_status']:
+                self.statuses[status] = self.statuses.get(status, 0) + \
+                        requests['by_status'][status]
+
+            self.retries += requests['retries']
+            self.bytes += requests['bytes']
+            self.latency_sum += requests['latency']['sum']
+            for i, count in enumerate(requests['latency']['counts']):
+                self.latency_counts[i] += count
+
+            self.connections_opened += report['connections']['opened']
+            self.connections_reused += report['connections']['reused']
+
+    def json(self, elapsed=None):
+        report = self.report()
+        report['elapsed'] = elapsed
+        return json.dumps(report, indent=4, sort_keys=True)
+
+    def prometheus(self, elapsed=None):
+        """
+            @return the metrics in the Prometheus text exposition format.
+        """
+        report = self.report()
+        requests = report['requests']
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP droopescan_%s %s' % (name, help_text))
+            lines.append('# TYPE droopescan_%s %s' % (name, metric_type))
+            for suffix, labels, value in samples:
+                label_str = ','.join(['%s="%s"' % (k, v) for k, v in labels])
+                if label_str:
+                    label_str = '{%s}' % label_str
+                lines.append('droopescan_%s%s%s %s' % (name, suffix, label_str,
+                    value))
+
+        if elapsed is not None:
+            metric('scan_seconds', 'gauge', 'Wall time of the scan.',
+                    [('', [], elapsed)])
+
+        phases = sorted(report['phases'].items())
+        metric('phase_seconds_total', 'counter', 'Wall time spent per phase.',
+                [('', [('phase', p)], v['seconds']) for p, v in phases])
+        metric('phase_runs_total', 'counter', 'Number of times each phase ran.',
+                [('', [('phase', p)], v['count']) for p, v in phases])
+        metric('requests_total', 'counter', 'Responses by status code, and '
+                'failed requests by error.', [('', [('status', s)], n) for s, n
+                    in sorted(requests['by_status'].items())])
+        metric('retries_total', 'counter', 'Requests retried.',
+                [('', [], requests['retries'])])
+        metric('response_bytes_total', 'counter', 'Size of the response '
+                'bodies, according to Content-Length.',
+                [('', [], requests['bytes'])])
+
+        latency = requests['latency']
+        samples = []
+        cumulative = 0
+        bounds = [str(b) for b in latency['buckets']] + ['+Inf']
+        for bound, count in zip(bounds, latency['counts']):
+            cumulative += count
+            samples.append(('_bucket', [('le', bound)], cumulative))
+        samples.append(('_sum', [], latency['sum']))
+        samples.append(('_count', [], cumulative))
+        metric('request_latency_seconds', 'histogram', 'Time until response '
+                'headers were received.', samples)
+
+        connections = report['connections']
+        metric('connections_opened_total', 'counter', 'Connections opened.',
+                [('', [], connections['opened'])])
+        metric('connections_reused_total', 'counter', 'Requests sent over a '
+                'connection which was already open.',
+                [('', [], connections['reused'])])
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,88 @@
+"""
+    Lazy loading of plugins. Every plugin in plugins.d declares the command
+    which runs it, e.g. 'scan drupal', and the commands whose plugins it
+    needs, e.g. 'release' needs every plugin under 'scan'. Only the plugins
+    needed by the command being run are imported, so that short commands
+    don't pay for importing every other plugin and its dependencies.
+"""
+from cement.ext.ext_plugin import CementPluginHandler
+
+class LazyPluginHandler(CementPluginHandler):
+    """
+        Loads the enabled plugins needed by the command in the application's
+        argv. Plugins which don't declare a command are always loaded, and
+        if argv names no known command, e.g. for the top level help, every
+        enabled plugin is.
+    """
+
+    class Meta:
+        label = 'lazy'
+
+    def get_enabled_plugins(self):
+        enabled = CementPluginHandler.get_enabled_plugins(self)
+        return plugins_needed(enabled, self._plugin_configs,
+                self.app._meta.argv)
+
+    def plugins_under(self, command):
+        """
+            @param command e.g. 'scan'.
+            @return the enabled plugins whose commands are under command,
+                whether they were loaded or not, e.g. every scanning plugin.
+        """
+        words = command.split()
+        plugins = []
+        for plugin in CementPluginHandler.get_enabled_plugins(self):
+            plugin_command = self._plugin_configs.get(plugin, {}).get('command')
+            if not plugin_command:
+                continue
+
+            plugin_command = plugin_command.split()
+            if len(plugin_command) > len(words) and \
+                    command_matches(plugin_command, words):
+                plugins.append(plugin)
+
+        return plugins
+
+def command_matches(command, words):
+    """
+        @param command a command, as a list of words, e.g. ['scan', 'drupal'].
+        @param words the words of the command being run.
+        @return whether the command is being run, or is under the command
+            being run, as 'scan drupal' is for 'droopescan scan --help'.
+    """
+    length = min(len(command), len(words))
+    return length > 0 and command[:length] == words[:length]
+
+def plugins_needed(enabled, configs, argv):
+    """
+        @param enabled the names of the enabled plugins.
+        @param configs plugin name -> its plugins.d settings. The 'command'
+            and 'requires' settings are space separated words, and several
+            commands may be required, separated by commas.
+        @param argv the command line arguments, without the program name.
+        @return the plugins in enabled to load, in the same order.
+    """
+    # Subcommands come before any option which takes a value.
+    words = [arg for arg in argv if not arg.startswith('-')]
+    commands = {}
+    for plugin in enabled:
+        command = configs.get(plugin, {}).get('command')
+        if command:
+            commands[plugin] = command.split()
+
+    needed = set([plugin for plugin in enabled if plugin not in commands or
+        command_matches(commands[plugin], words)])
+    if not any([plugin in commands for plugin in needed]):
+        return list(enabled)
+
+    for plugin in list(needed):
+        requires = configs.get(plugin, {}).get('requires')
+        if not requires:
+            continue
+
+        for required in requires.split(','):
+            required = required.split()
+            needed.update([p for p in commands if command_matches(commands[p],
+                required)])
+
+    return [plugin for plugin in enabled if plugin in needed]
@@ -1,5 +1,6 @@
 from cement.core import handler
-from common import file_len, VersionsFile
+from common import VersionsFile
+from common.wordlist import wordlist_get
 from plugins import BasePlugin
 import subprocess
 
@@ -32,6 +33,12 @@ class Plugin(object):
     version_can_enumerate = False
     version_highest = None
 
+    # attributes returned by as_dict.
+    fields = ['name', 'plugins_can_enumerate', 'plugins_wordlist_size',
+            'plugins_mtime', 'themes_can_enumerate', 'themes_wordlist_size',
+            'themes_mtime', 'interesting_can_enumerate', 'interesting_url_size',
+            'version_can_enumerate', 'version_highest']
+
     def __init__(self, plugin=None):
         """
             @param plugin as returned by handler.list('controller'). Must
@@ -43,7 +50,7 @@ class Plugin(object):
 
             if plugin.can_enumerate_plugins:
                 self.plugins_can_enumerate = True
-                self.plugins_wordlist_size = file_len(plugin.plugins_file)
+                self.plugins_wordlist_size = len(wordlist_get(plugin.plugins_file))
                 # this can fail due to git not being installed on the system or
                 # this not being a git repository.
                 try:
@@ -53,7 +60,7 @@ class Plugin(object):
 
             if plugin.can_enumerate_themes:
                 self.themes_can_enumerate = True
-                self.themes_wordlist_size = file_len(plugin.themes_file)
+                self.themes_wordlist_size = len(wordlist_get(plugin.themes_file))
                 try:
                     self.themes_mtime = self.file_mtime(plugin.themes_file)
                 except:
@@ -70,12 +77,19 @@ class Plugin(object):
                 self.version_highest = versions_file.highest_version()
 
     def file_mtime(self, file_path):
-        out = subprocess.check_output(['git', 'log', '-1', '--format=%cr',
+        """
+            @return the time of the last commit to file_path, in seconds since
+                the epoch.
+        """
+        out = subprocess.check_output(['git', 'log', '-1', '--format=%ct',
             file_path]).strip()
 
-        return out
-
-
-
-
+        return int(out)
 
+    def as_dict(self):
+        """
+            @return the capabilities as a JSON serializable dict, as stored in
+                the common.capabilities index.
+        """
+        return dict([(field, getattr(self, field, None)) for field in
+            self.fields])
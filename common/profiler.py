@@ -0,0 +1,236 @@
+"""
+    Profiling of scans, by phase. Work is attributed to the phase (e.g.
+    'scanning_method', 'plugins', 'version' or 'output') in which it was
+    started, including requests and hashing done by scheduler threads on behalf
+    of that phase.
+
+    Two modes are supported:
+        - cprofile: deterministic profiling with cProfile, in every thread. The
+          profile is written in the pstats format.
+        - sampling: the stacks of the threads working on a phase are sampled
+          every few milliseconds, which is cheaper and measures wall time,
+          including time spent waiting on the network. The profile is written
+          as collapsed stacks, one "phase;frame;...;frame count" per line, as
+          read by flame graph tools.
+"""
+from common import ProfileMode
+from contextlib import contextmanager
+from cStringIO import StringIO
+import cProfile
+import marshal
+import os
+import pstats
+import sys
+import thread
+import threading
+
+class Profiler():
+    """
+        Collects a profile per phase. A Profiler with mode None does nothing,
+        so that callers don't need to check whether profiling is enabled.
+    """
+
+    def __init__(self, mode=None, interval=0.005):
+        """
+            @param mode a common.ProfileMode, or None.
+            @param interval seconds between samples, in sampling mode.
+        """
+        self.mode = mode
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # thread ident -> current phase, read by the sampling thread.
+        self.thread_phases = {}
+        # phase -> pstats.Stats, and the stats of all phases, in cprofile mode.
+        self.stats = {}
+        self.merged = None
+        # phase -> collapsed stack -> samples, in sampling mode.
+        self.samples = {}
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    def __nonzero__(self):
+        return self.mode is not None
+
+    def start(self):
+        if self.mode == ProfileMode.sampling:
+            self.sampler = threading.Thread(target=self._sample)
+            self.sampler.daemon = True
+            self.sampler.start()
+
+    def stop(self):
+        if self.sampler:
+            self.stopped.set()
+            self.sampler.join()
+            self.sampler = None
+
+    @contextmanager
+    def phase(self, name):
+        """
+            Attributes the work done by the current thread in this block to
+            phase name. Phases may be nested.
+        """
+        if not self:
+            yield
+            return
+
+        ident = thread.get_ident()
+        stack = self._stack_get()
+        profile = None
+        if self.mode == ProfileMode.cprofile:
+            if stack and stack[-1][1]:
+                stack[-1][1].disable()
+            profile = cProfile.Profile()
+
+        stack.append((name, profile))
+        self.thread_phases[ident] = name
+        if profile:
+            profile.enable()
+
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                self._stats_add(name, profile)
+
+            stack.pop()
+            if stack:
+                self.thread_phases[ident] = stack[-1][0]
+                if stack[-1][1]:
+                    stack[-1][1].enable()
+            else:
+                del self.thread_phases[ident]
+
+    def phase_get(self):
+        """
+            @return the current phase of the current thread, or None.
+        """
+        stack = self._stack_get()
+        return stack[-1][0] if stack else None
+
+    def wrap(self, fn):
+        """
+            @return a function which runs fn in the phase of the current
+                thread, for fn to be ran in another thread.
+        """
+        name = self.phase_get()
+        if not self or name is None:
+            return fn
+
+        def wrapped(*args, **kwargs):
+            with self.phase(name):
+                return fn(*args, **kwargs)
+
+        return wrapped
+
+    def _stack_get(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def _stats_add(self, name, profile):
+        with self.lock:
+            if name in self.stats:
+                self.stats[name].add(profile)
+            else:
+                self.stats[name] = pstats.Stats(profile, stream=StringIO())
+
+            if self.merged:
+                self.merged.add(profile)
+            else:
+                self.merged = pstats.Stats(profile, stream=StringIO())
+
+    def _sample(self):
+        own_ident = thread.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                name = self.thread_phases.get(ident)
+                if ident == own_ident or name is None:
+                    continue
+
+                frames = []
+                while frame is not None:
+                    frames.append(frame_label(frame))
+                    frame = frame.f_back
+
+                frames.append(name)
+                stack = ';'.join(reversed(frames))
+                with self.lock:
+                    phase_samples = self.samples.setdefault(name, {})
+                    phase_samples[stack] = phase_samples.get(stack, 0) + 1
+
+    def dump(self, filename, top=10):
+        """
+            Writes the profile to filename, and a summary of the top functions
+            of every phase to filename + '.txt'.
+            @param top the number of functions listed per phase.
+        """
+        with self.lock:
+            if self.mode == ProfileMode.cprofile:
+                summary = self._cprofile_dump(filename, top)
+            else:
+                summary = self._sampling_dump(filename, top)
+
+        with open(filename + '.txt', 'w') as f:
+            f.write(summary)
+
+    def _cprofile_dump(self, filename, top):
+        if self.merged:
+            self.merged.dump_stats(filename)
+        else:
+            with open(filename, 'wb') as f:
+                marshal.dump({}, f)
+
+        summary = []
+        for name in sorted(self.stats):
+            stats = self.stats[name]
+            stats.stream = StringIO()
+            stats.sort_stats('tottime').print_stats(top)
+            summary.append('== %s ==\n%s' % (name, stats.stream.getvalue()))
+
+        return ''.join(summary)
+
+    def _sampling_dump(self, filename, top):
+        summary = []
+        with open(filename, 'w') as f:
+            for name in sorted(self.samples):
+                stacks = self.samples[name]
+                for stack in sorted(stacks):
+                    f.write('%s %s\n' % (stack, stacks[stack]))
+
+                summary.append(sampling_summary(name, stacks, top))
+
+        return '\n'.join(summary)
+
+def frame_label(frame):
+    code = frame.f_code
+    return '%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename),
+            code.co_firstlineno)
+
+def sampling_summary(name, stacks, top):
+    """
+        @param stacks a dict of collapsed stack to the number of samples.
+        @return a table of the functions in which most samples were taken
+            ('self'), and of those which were most often on the stack
+            ('total').
+    """
+    total = sum(stacks.values())
+    own = {}
+    cumulative = {}
+    for stack, count in stacks.items():
+        frames = stack.split(';')[1:]
+        own[frames[-1]] = own.get(frames[-1], 0) + count
+        for frame in set(frames):
+            cumulative[frame] = cumulative.get(frame, 0) + count
+
+    lines = ['== %s (%s samples) ==' % (name, total),
+            '  self%  total%  function']
+    hot = sorted(own, key=lambda frame: (-own[frame], frame))[:top]
+    for frame in hot:
+        lines.append('%6.1f%% %6.1f%%  %s' % (100.0 * own[frame] / total,
+            100.0 * cumulative[frame] / total, frame))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,101 @@
+"""
+    Cache of scan results shared across runs, so that hosts which are scanned
+    regularly can be rescanned incrementally. For every host and CMS, the
+    scanning method, the URL it was determined for, the hashes of the files
+    fetched to identify the version and the finds of the last scan are kept
+    in a SQLite database.
+"""
+from contextlib import contextmanager
+import json
+import sqlite3
+import time
+
+class ResultCache():
+    """
+        Entries expire ttl seconds after they were stored. Once there are more
+        than max_entries, the least recently used entries are evicted. Every
+        method opens its own connection, so that a ResultCache may be used
+        from several threads and processes at once.
+    """
+
+    def __init__(self, filename, ttl=2592000, max_entries=100000):
+        """
+            @param filename the SQLite database, which is created if needed.
+            @param ttl seconds after which an entry is no longer used.
+            @param max_entries maximum number of entries kept.
+        """
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS results (
+                host TEXT NOT NULL,
+                plugin TEXT NOT NULL,
+                stored REAL NOT NULL,
+                used REAL NOT NULL,
+                result TEXT NOT NULL,
+                PRIMARY KEY (host, plugin))""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS results_used ON
+                results (used)""")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def get(self, host, plugin):
+        """
+            @param host the URL of the host, as supplied.
+            @param plugin the label of the CMS plugin, e.g. 'drupal'.
+            @return the result stored for host, or None if there is none or it
+                has expired.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("""SELECT result FROM results WHERE host = ? AND
+                plugin = ? AND stored >= ?""", (host, plugin,
+                    now - self.ttl)).fetchone()
+            if row is None:
+                return None
+
+            conn.execute("""UPDATE results SET used = ? WHERE host = ? AND
+                plugin = ?""", (now, host, plugin))
+
+        return json.loads(row[0])
+
+    def put(self, host, plugin, result):
+        """
+            Stores the result for host, replacing any previous one, and
+            evicts expired and least recently used entries.
+            @param result a JSON serializable object.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("""INSERT OR REPLACE INTO results (host, plugin,
+                stored, used, result) VALUES (?, ?, ?, ?, ?)""", (host, plugin,
+                    now, now, json.dumps(result)))
+
+            conn.execute('DELETE FROM results WHERE stored < ?', (now -
+                self.ttl,))
+            conn.execute("""DELETE FROM results WHERE rowid IN (SELECT rowid
+                FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)""",
+                (self.max_entries,))
+
+    def count(self):
+        """
+            @return the number of entries, including expired ones which
+                haven't been evicted yet.
+        """
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
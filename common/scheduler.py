@@ -0,0 +1,382 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.exceptions import ConnectionError, Timeout
+import random
+import threading
+import time
+
+# Responses which are retried, as they usually mean the host is overloaded.
+RETRY_STATUSES = (429, 502, 503, 504)
+# Errors which are retried, as they are usually transient.
+RETRY_EXCEPTIONS = (ConnectionError, Timeout)
+
+def status_code_get(result):
+    """
+        @param result a requests.Response, a status code, or anything else.
+        @return the status code for result, or None if it doesn't have one.
+    """
+    status_code = getattr(result, 'status_code', result)
+    if isinstance(status_code, int) and not isinstance(status_code, bool):
+        return status_code
+    else:
+        return None
+
+def retry_delay(attempt, backoff=0.5, max_delay=30):
+    """
+        Exponential backoff with jitter, so that retries to the same host
+        don't all arrive at once.
+        @param attempt number of attempts made so far, starting at 1.
+        @return the number of seconds to wait before the next attempt.
+    """
+    delay = min(max_delay, backoff * (2 ** (attempt - 1)))
+    return delay * random.uniform(0.5, 1.5)
+
+class HostController():
+    """
+        Adjusts the number of concurrent requests to a single host (AIMD). The
+        limit grows by one for every window of healthy responses, and is
+        halved, at most once per window, on signs of trouble: 5xx or 429
+        responses, timeouts, failed connections, and responses much slower
+        than the fastest one seen for the host. Only the latency of requests
+        for a status is compared, as downloads take longer the larger the file.
+    """
+    # Latency is only considered a sign of trouble when above latency_factor
+    # times the best latency seen and above latency_min seconds.
+    latency_factor = 4
+    latency_min = 1.0
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = max(float(min_limit), max_limit / 2.0)
+        self.since_decrease = max_limit
+        self.best_latency = None
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.timeouts = 0
+        self.connection_errors = 0
+
+    def limit_get(self):
+        return int(self.limit)
+
+    def limit_start(self, limit):
+        """
+            Raises the limit the host starts with, up to max_limit, e.g. so
+            that a known number of independent requests are sent to it at
+            once. Has no effect once a request to the host has completed.
+        """
+        with self.lock:
+            if self.requests == 0:
+                self.limit = max(self.limit, min(float(self.max_limit),
+                    limit))
+
+    def record(self, latency=None, status_code=None, timed_out=False,
+            failed=False):
+        """
+            Updates the limit with the outcome of a request.
+            @param latency the time the request took, in seconds.
+            @param status_code the status code of the response, if any.
+            @param timed_out whether the request timed out.
+            @param failed whether the connection to the host failed.
+            @return True if the outcome was a sign of trouble.
+        """
+        with self.lock:
+            self.requests += 1
+            self.since_decrease += 1
+
+            trouble = False
+            if timed_out:
+                self.timeouts += 1
+                trouble = True
+            elif failed:
+                self.connection_errors += 1
+                trouble = True
+            elif status_code == 429:
+                self.throttled += 1
+                trouble = True
+            elif status_code >= 500:
+                self.errors += 1
+                trouble = True
+
+            if latency is not None and not timed_out and not failed:
+                if self.best_latency is None or latency < self.best_latency:
+                    self.best_latency = latency
+                elif latency > max(self.latency_min, self.best_latency *
+                        self.latency_factor):
+                    trouble = True
+
+            if trouble:
+                if self.since_decrease >= self.limit:
+                    self.limit = max(float(self.min_limit), self.limit / 2)
+                    self.since_decrease = 0
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+            return trouble
+
+class FairQueue():
+    """
+        Per-host FIFO queues which are served round-robin, while honouring a
+        global and a per-host limit on the number of running items. This class
+        is not thread-safe; callers are expected to hold a lock.
+    """
+
+    def __init__(self, max_running, host_max_running=None, adaptive=False):
+        """
+            @param max_running maximum number of items running at any given
+                time, across all hosts.
+            @param host_max_running maximum number of items running at any
+                given time for a single host. Defaults to max_running.
+            @param adaptive if True, the per-host limit is set by a
+                HostController for each host, up to host_max_running.
+        """
+        self.max_running = max_running
+        self.host_max_running = host_max_running or max_running
+        self.adaptive = adaptive
+        self.controllers = {}
+
+        self.queues = {}
+        self.queued = 0
+        self.ring = deque()
+        self.running = {}
+        self.running_total = 0
+
+    def push(self, host, item, first=False):
+        """
+            @param host the host the item belongs to, e.g. as returned by
+                common.base_url
+            @param first if True, the item is queued before any other item
+                for the same host.
+        """
+        if host not in self.queues:
+            self.queues[host] = deque()
+            self.ring.append(host)
+
+        if first:
+            self.queues[host].appendleft(item)
+        else:
+            self.queues[host].append(item)
+
+        self.queued += 1
+
+    def pop(self):
+        """
+            Gets the next item that can run, and marks it as running.
+            @return (host, item), or None if no item can run right now.
+        """
+        if self.running_total >= self.max_running:
+            return None
+
+        for _ in range(len(self.ring)):
+            host = self.ring[0]
+            self.ring.rotate(-1)
+            if self.running.get(host, 0) >= self.host_limit(host):
+                continue
+
+            queue = self.queues[host]
+            item = queue.popleft()
+            self.queued -= 1
+            if not queue:
+                # The host was just rotated to the end of the ring.
+                del self.queues[host]
+                self.ring.pop()
+
+            self.running[host] = self.running.get(host, 0) + 1
+            self.running_total += 1
+
+            return host, item
+
+        return None
+
+    def done(self, host):
+        """
+            Marks an item previously returned by pop() as finished.
+        """
+        self.running[host] -= 1
+        if self.running[host] == 0:
+            del self.running[host]
+
+        self.running_total -= 1
+
+    def host_limit(self, host):
+        if self.adaptive:
+            return self.controller_get(host).limit_get()
+        else:
+            return self.host_max_running
+
+    def controller_get(self, host):
+        if host not in self.controllers:
+            self.controllers[host] = HostController(self.host_max_running)
+
+        return self.controllers[host]
+
+    def __len__(self):
+        return self.queued
+
+class Scheduler():
+    """
+        Runs callables on a pool of threads which is shared by every host in
+        the scan. The number of concurrent tasks is limited both globally and
+        per host, and hosts with queued tasks are served round-robin so that a
+        single host can't starve the rest.
+
+        The number of requests in flight to each host adapts to how the host
+        responds (see HostController), and requests which raise one of
+        RETRY_EXCEPTIONS or get a response in RETRY_STATUSES are retried after
+        a delay.
+    """
+
+    def __init__(self, max_workers, host_max_workers=None, retries=2,
+            metrics=None, profiler=None):
+        """
+            @param max_workers number of threads, which is the maximum number
+                of requests in flight across all hosts.
+            @param host_max_workers maximum number of requests in flight for
+                any single host. Defaults to max_workers.
+            @param retries number of times a request is retried.
+            @param metrics a common.metrics.Metrics, in which retries and
+                failed requests are recorded.
+            @param profiler a common.profiler.Profiler. Tasks are profiled
+                as part of the phase they were submitted from.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.queue = FairQueue(max_workers, host_max_workers, adaptive=True)
+        self.lock = threading.Lock()
+        self.retries = retries
+        self.metrics = metrics
+        self.profiler = profiler
+        self.closed = False
+
+    def submit(self, host, fn, *args, **kwargs):
+        """
+            Schedules fn(*args, **kwargs) to be ran as soon as there is
+            capacity for host.
+            @param host the host the task will connect to, e.g. as returned by
+                common.base_url
+            @return a concurrent.futures.Future
+        """
+        if self.profiler:
+            fn = self.profiler.wrap(fn)
+
+        future = Future()
+        self.acquire(host, self._start, (future, fn, args, kwargs, 0))
+        return future
+
+    def acquire(self, host, start, item, first=False):
+        """
+            Queues item alongside the scheduler's own tasks, so that work which
+            isn't ran on its threads, such as the requests of a
+            common.engine.AsyncEngine, shares the same limits. Once there is
+            capacity for host, start(host, item) is called from whichever
+            thread dispatches it, and the slot it takes is held until
+            release(host) is called.
+            @param first if True, item is queued before any other item for
+                the same host.
+        """
+        with self.lock:
+            self.queue.push(host, (start, item), first=first)
+
+        self._dispatch()
+
+    def release(self, host):
+        """
+            Frees a slot taken by an item queued by acquire, and dispatches
+            whatever can now run.
+        """
+        with self.lock:
+            self.queue.done(host)
+
+        self._dispatch()
+
+    def controller_get(self, host):
+        """
+            @return the HostController which limits requests to host.
+        """
+        with self.lock:
+            return self.queue.controller_get(host)
+
+    def _dispatch(self):
+        while True:
+            with self.lock:
+                next_task = self.queue.pop()
+
+            if next_task is None:
+                break
+
+            host, (start, item) = next_task
+            start(host, item)
+
+    def _start(self, host, task):
+        self.executor.submit(self._run, host, task)
+
+    def _run(self, host, task):
+        future, fn, args, kwargs, attempt = task
+        retry = False
+        try:
+            if attempt > 0 or future.set_running_or_notify_cancel():
+                controller = self.controller_get(host)
+
+                start = time.time()
+                try:
+                    result = fn(*args, **kwargs)
+                except RETRY_EXCEPTIONS as e:
+                    timed_out = isinstance(e, Timeout)
+                    controller.record(timed_out=timed_out,
+                            failed=not timed_out)
+                    self._metrics_record('timeout' if timed_out else
+                            e.__class__.__name__)
+                    retry = attempt < self.retries
+                    if not retry:
+                        future.set_exception(e)
+                except BaseException as e:
+                    self._metrics_record(e.__class__.__name__)
+                    future.set_exception(e)
+                else:
+                    status_code = status_code_get(result)
+                    # Tasks without a status, e.g. file downloads, take as
+                    # long as their body is large rather than the host busy.
+                    latency = None
+                    if status_code is not None:
+                        latency = time.time() - start
+
+                    controller.record(latency, status_code)
+                    retry = status_code in RETRY_STATUSES and \
+                            attempt < self.retries
+                    if not retry:
+                        future.set_result(result)
+        finally:
+            if retry:
+                if self.metrics:
+                    self.metrics.retry_record()
+
+                task = (future, fn, args, kwargs, attempt + 1)
+                timer = threading.Timer(retry_delay(attempt + 1),
+                        self._retry, (host, task))
+                timer.daemon = True
+                timer.start()
+
+            self.release(host)
+
+    def _metrics_record(self, error):
+        # Responses are recorded by a session hook; only errors are here.
+        if self.metrics:
+            self.metrics.request_record(error)
+
+    def _retry(self, host, task):
+        with self.lock:
+            if self.closed:
+                task[0].set_exception(RuntimeError('Scheduler was shut down.'))
+                return
+
+            self.queue.push(host, (self._start, task), first=True)
+
+        self._dispatch()
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            self.closed = True
+
+        self.executor.shutdown(wait=wait)
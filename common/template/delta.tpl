@@ -0,0 +1,17 @@
+{{#unchanged}}
+[+] No changes to {{host}} since the baseline.
+{{/unchanged}}
+{{#changes}}
+{{#any_added}}
+{{green}}[+] {{Noun}} added to {{host}}:{{endc}}
+{{/any_added}}
+{{#added}}
+    {{label}} {{blue}}{{url}}{{endc}}
+{{/added}}
+{{#any_removed}}
+{{warn}}[+] {{Noun}} removed from {{host}}:{{endc}}
+{{/any_removed}}
+{{#removed}}
+    {{label}} {{blue}}{{url}}{{endc}}
+{{/removed}}
+{{/changes}}
@@ -0,0 +1,145 @@
+"""
+    Compiled wordlists. Wordlist text files (one plugin or theme per line) are
+    compiled once into a binary file, which is then memory-mapped read-only.
+    The mapping is shared by all threads in the process, and by worker
+    processes forked after it has been loaded, so that getting the first N
+    names costs no file I/O.
+
+    Compiled file layout:
+        - header: magic, line count, source size, source mtime, source md5.
+        - offsets: count + 1 unsigned 32 bit integers, relative to the data.
+        - data: every stripped line, concatenated.
+"""
+from array import array
+from common import cache_dir
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = 'DSWL0001'
+HEADER = struct.Struct('<8sIQd16s')
+OFFSET = struct.Struct('<I')
+OFFSET_PAIR = struct.Struct('<II')
+
+_wordlists = {}
+_lock = threading.Lock()
+
+def wordlist_get(filename):
+    """
+        Returns the compiled wordlist for filename, compiling it first if the
+        compiled file is missing or out of date. Wordlists are loaded once per
+        process.
+        @param filename path to a wordlist text file.
+        @return a Wordlist.
+    """
+    path = os.path.abspath(filename)
+    with _lock:
+        if path not in _wordlists:
+            _wordlists[path] = Wordlist.load(path)
+
+        return _wordlists[path]
+
+def compiled_path(filename):
+    key = hashlib.md5(os.path.abspath(filename)).hexdigest()
+    return os.path.join(cache_dir('wordlists'), key + '.dsw')
+
+def compile_wordlist(filename, out_filename):
+    """
+        Compiles the wordlist at filename into out_filename. The file is
+        written under a temporary name and then renamed, so that concurrent
+        readers never see a partially written file.
+    """
+    stat = os.stat(filename)
+    with open(filename, 'rb') as f:
+        contents = f.read()
+
+    lines = contents.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+
+    words = [line.strip() for line in lines]
+    offsets = array('I', [0])
+    for word in words:
+        offsets.append(offsets[-1] + len(word))
+
+    header = HEADER.pack(MAGIC, len(words), stat.st_size, stat.st_mtime,
+            hashlib.md5(contents).digest())
+
+    tmp_filename = '%s.%s.%s.tmp' % (out_filename, os.getpid(),
+            threading.current_thread().ident)
+    with open(tmp_filename, 'wb') as f:
+        f.write(header)
+        f.write(struct.pack('<%sI' % len(offsets), *offsets))
+        f.write(''.join(words))
+
+    os.rename(tmp_filename, out_filename)
+
+class Wordlist():
+    """
+        A read-only, memory-mapped compiled wordlist.
+    """
+
+    def __init__(self, filename):
+        """
+            @param filename path to a compiled wordlist.
+        """
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, self.source_size, self.source_mtime, \
+                self.checksum = HEADER.unpack_from(self.mmap, 0)
+
+        if magic != MAGIC:
+            raise ValueError("'%s' is not a compiled wordlist." % filename)
+
+        self.offsets_start = HEADER.size
+        self.data_start = self.offsets_start + OFFSET.size * (self.count + 1)
+
+    @classmethod
+    def load(cls, source_filename):
+        """
+            Loads the compiled version of source_filename, compiling it if
+            necessary.
+        """
+        filename = compiled_path(source_filename)
+        try:
+            wordlist = cls(filename)
+            if wordlist.is_current(source_filename):
+                return wordlist
+        except (IOError, ValueError, struct.error, mmap.error):
+            pass
+
+        compile_wordlist(source_filename, filename)
+        return cls(filename)
+
+    def is_current(self, source_filename):
+        """
+            @return whether the source file is unchanged since compilation.
+        """
+        stat = os.stat(source_filename)
+        return stat.st_size == self.source_size and \
+                stat.st_mtime == self.source_mtime
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+
+        if not 0 <= i < self.count:
+            raise IndexError('Wordlist index out of range.')
+
+        start, end = OFFSET_PAIR.unpack_from(self.mmap, self.offsets_start +
+                OFFSET.size * i)
+
+        return self.mmap[self.data_start + start:self.data_start + end]
+
+    def head(self, amount):
+        """
+            @return a generator over the first amount words.
+        """
+        for i in xrange(min(int(amount), self.count)):
+            yield self[i]
@@ -0,0 +1,194 @@
+"""
+    Work queue which allows a scan to be split between several workers,
+    possibly on different machines sharing a filesystem. Hosts are kept in a
+    SQLite database; workers lease them, scan them and store the results,
+    which the coordinator outputs in the order in which hosts were queued.
+"""
+from contextlib import contextmanager
+import json
+import sqlite3
+import time
+
+class State():
+    queued = 'queued'
+    leased = 'leased'
+    done = 'done'
+    failed = 'failed'
+
+class WorkQueue():
+    """
+        A SQLite backed queue of hosts. Every method opens its own
+        connection, so that a WorkQueue may be used from several threads and
+        processes at once.
+    """
+    # Numbers hosts in the order in which they finish.
+    next_seq_sql = 'SELECT COALESCE(MAX(finished_seq), 0) + 1 FROM hosts'
+
+    def __init__(self, filename, lease_time=600, max_attempts=3):
+        """
+            @param filename the SQLite database, which is created if needed.
+            @param lease_time seconds after which a host leased by a worker
+                which didn't complete it can be leased by another worker.
+            @param max_attempts number of leases after which a host which
+                keeps failing is marked as failed.
+        """
+        self.filename = filename
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS hosts (
+                position INTEGER PRIMARY KEY AUTOINCREMENT,
+                host TEXT UNIQUE NOT NULL,
+                state TEXT NOT NULL,
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                finished_seq INTEGER)""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS hosts_state ON
+                hosts (state, position)""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS hosts_finished ON
+                hosts (finished_seq)""")
+
+    @contextmanager
+    def _connect(self):
+        """
+            Yields a connection within a transaction which holds the write
+            lock from the start, so that two workers can't lease the same
+            host.
+        """
+        conn = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def enqueue(self, hosts):
+        """
+            Adds hosts to the queue. Hosts which were already queued, in this
+            or a previous run, are ignored.
+            @param hosts an iterable of URLs.
+            @return the number of hosts added.
+        """
+        with self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany("""INSERT OR IGNORE INTO hosts (host, state)
+                VALUES (?, ?)""", ((host, State.queued) for host in hosts))
+
+            return conn.total_changes - before
+
+    def lease(self, worker, amount=1):
+        """
+            Leases the next hosts to be scanned, including hosts whose lease
+            has expired.
+            @param worker an identifier for the worker.
+            @return a list of hosts, empty if there is nothing left to lease.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute("""SELECT position, host FROM hosts WHERE
+                state = ? OR (state = ? AND lease_expires < ?)
+                ORDER BY position LIMIT ?""", (State.queued, State.leased,
+                    now, amount)).fetchall()
+
+            for position, host in rows:
+                conn.execute("""UPDATE hosts SET state = ?, worker = ?,
+                    lease_expires = ?, attempts = attempts + 1 WHERE
+                    position = ?""", (State.leased, worker,
+                        now + self.lease_time, position))
+
+        return [host for position, host in rows]
+
+    def complete(self, host, worker, result):
+        """
+            Stores the result for a host leased by worker.
+            @param result a JSON serializable object.
+            @return False if the lease was lost to another worker, in which
+                case the result is discarded.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute("""UPDATE hosts SET state = ?, result = ?,
+                lease_expires = NULL, finished_seq = (%s) WHERE host = ? AND
+                worker = ? AND state = ?""" % self.next_seq_sql, (State.done,
+                    json.dumps(result), host, worker, State.leased))
+
+            return cursor.rowcount == 1
+
+    def fail(self, host, worker, error):
+        """
+            Records that scanning a host leased by worker failed. The host is
+            queued again unless it has failed max_attempts times.
+            @param error a description of the error, such as a traceback.
+        """
+        with self._connect() as conn:
+            conn.execute("""UPDATE hosts SET state = CASE WHEN attempts >= ?
+                THEN ? ELSE ? END, finished_seq = CASE WHEN attempts >= ?
+                THEN (%s) END, result = ?, lease_expires = NULL WHERE
+                host = ? AND worker = ? AND state = ?""" % self.next_seq_sql,
+                (self.max_attempts, State.failed, State.queued,
+                    self.max_attempts, json.dumps(error), host, worker,
+                    State.leased))
+
+    def finished_since(self, cursor=0):
+        """
+            Returns the hosts which are done or failed, and finished after
+            those returned by the call which returned cursor, so that polling
+            doesn't read every result again.
+            @param cursor 0, or a cursor returned by a previous call.
+            @return (a cursor for the next call, a list of (position, host,
+                state, result) in the order in which hosts finished).
+        """
+        with self._connect() as conn:
+            rows = conn.execute("""SELECT finished_seq, position, host, state,
+                result FROM hosts WHERE finished_seq > ? ORDER BY
+                finished_seq""", (cursor,)).fetchall()
+
+        if rows:
+            cursor = rows[-1][0]
+
+        return cursor, [(position, host, state, json.loads(result)) for
+                seq, position, host, state, result in rows]
+
+    def leases_live(self):
+        """
+            @return the number of hosts leased by a worker whose lease hasn't
+                expired.
+        """
+        with self._connect() as conn:
+            row = conn.execute("""SELECT COUNT(*) FROM hosts WHERE state = ?
+                AND lease_expires >= ?""", (State.leased,
+                    time.time())).fetchone()
+
+        return row[0]
+
+    def positions_get(self, hosts):
+        """
+            @return a dict of host to its position in the queue.
+        """
+        positions = {}
+        with self._connect() as conn:
+            for host in hosts:
+                row = conn.execute("""SELECT position FROM hosts WHERE
+                    host = ?""", (host,)).fetchone()
+                if row:
+                    positions[host] = row[0]
+
+        return positions
+
+    def counts(self):
+        """
+            @return a dict of state to the number of hosts in that state.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("""SELECT state, COUNT(*) FROM hosts GROUP BY
+                state""").fetchall()
+
+        return dict(rows)
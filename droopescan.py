@@ -12,7 +12,7 @@ from __future__ import print_function
 from cement.core import backend, foundation, controller, handler
 from cement.utils.misc import init_defaults
 from common import template
-from plugins import AbstractArgumentController
+from common.plugin_loader import LazyPluginHandler
 import common, sys
 
 class DroopeScanBase(controller.CementBaseController):
@@ -31,14 +31,13 @@ class DroopeScan(foundation.CementApp):
     class Meta:
         label = 'droopescan'
         base_controller = DroopeScanBase
+        plugin_handler = LazyPluginHandler
 
 if __name__ == "__main__":
     ds = DroopeScan("DroopeScan",
             plugin_config_dir="./plugins.d",
             plugin_dir="./plugins")
 
-    handler.register(AbstractArgumentController)
-
     try:
         ds.setup()
         ds.run()
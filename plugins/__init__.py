@@ -1,14 +1,31 @@
 from cement.core import handler, controller
 from common import template, enum_list, dict_combine, base_url
-from common import Verb, ScanningMethod, Enumerate, VersionsFile, ProgressBar, \
-        StandardOutput, ValidOutputs, JsonOutput
-from concurrent.futures import ThreadPoolExecutor
+from common import Verb, ScanningMethod, Enumerate, ProgressBar, \
+        StandardOutput, ValidOutputs, JsonOutput, NdjsonOutput, Engine, \
+        FingerprintMode, StatsFormat, ProfileMode
+from common.engine import ThreadEngine, AsyncEngine
+from common.baseline import baseline_load, delta_get, full_scan_due
+from common.connections import PooledAdapter
+from common.fingerprint import fingerprint_get
+from common.journal import Journal
+from common.metrics import Metrics
+from common.profiler import Profiler
+from common.resultcache import ResultCache
+from common.workqueue import WorkQueue, State
+from common.scheduler import Scheduler, RETRY_EXCEPTIONS
+from common.wordlist import wordlist_get
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, \
+        FIRST_COMPLETED
 from datetime import datetime
 from distutils.util import strtobool
+from multiprocessing import Process, Queue
+from Queue import Empty
 from requests import Session
+from requests.exceptions import Timeout, RequestException
 import common, hashlib
 import requests
-import sys, tempfile, os, traceback
+import socket
+import sys, tempfile, os, time, traceback
 
 class AbstractArgumentController(controller.CementBaseController):
 
@@ -44,7 +61,13 @@ class AbstractArgumentController(controller.CementBaseController):
                 (['--themes-base-url'], dict(action='store', help='''Same as
                     above, but for themes.''')),
                 (['--threads', '-t'], dict(action='store', help='''Number of
-                    threads. Default 1.''', default=4, type=int)),
+                    threads. This is the maximum number of requests in flight
+                    across all hosts being scanned. Default 4.''', default=4,
+                    type=int)),
+                (['--host-threads'], dict(action='store', help='''Maximum
+                    number of requests in flight to any single host. Hosts are
+                    served round-robin when scanning a --url-file. Defaults to
+                    --threads.''', type=int)),
                 (['--verb'], dict(action='store', help="""The HTTP verb to use;
                     the default option is head, except for version enumeration
                     requests, which are always get because we need to get the hash
@@ -52,7 +75,97 @@ class AbstractArgumentController(controller.CementBaseController):
                     choices=enum_list(Verb))),
                 (['--timeout'], dict(action='store', help="""How long to wait
                     for an HTTP response before timing out (in seconds).""",
-                    default=15, type=int))
+                    default=15, type=int)),
+                (['--retries'], dict(action='store', help="""Number of times
+                    a request that timed out or got a 429, 502, 503 or 504
+                    response is retried, with exponential backoff and jitter.
+                    Default 2.""", default=2, type=int)),
+                (['--max-body-size'], dict(action='store', help="""Maximum
+                    size in bytes of the files downloaded for version
+                    fingerprinting. Larger responses are abandoned and treated
+                    as not matching any version. Default 5242880 (5 MiB).""",
+                    default=5242880, type=int)),
+                (['--engine'], dict(action='store', help="""The engine used
+                    to enumerate plugins and themes. 'thread' uses a pool of
+                    --threads workers; 'async' keeps --threads requests in
+                    flight from a single event loop, but does not honour proxy
+                    settings.""", default='thread',
+                    choices=enum_list(Engine))),
+                (['--fingerprint-mode'], dict(action='store', help="""How the
+                    version is fingerprinted. 'full' requests every file listed
+                    in versions.xml; 'adaptive' requests one file at a time,
+                    choosing the one which best narrows down the remaining
+                    versions, and stops once they can't be narrowed down any
+                    further.""", default='full',
+                    choices=enum_list(FingerprintMode))),
+                (['--journal'], dict(action='store', help="""A file in which
+                    the progress of the scan is recorded, host by host and
+                    phase by phase, so that it can be resumed with --resume.""")),
+                (['--resume'], dict(action='store_true', help="""Resume the
+                    scan recorded in --journal. Phases which were completed are
+                    not repeated, and hosts whose results were already output
+                    are skipped.""", default=False)),
+                (['--processes'], dict(action='store', help="""Number of
+                    processes to scan a --url-file with. Hosts are split
+                    between the processes, each with its own --threads, and
+                    results are output in the same order as the file. Default
+                    1.""", default=1, type=int)),
+                (['--queue'], dict(action='store', help="""A SQLite work
+                    queue shared with --worker processes, possibly on other
+                    machines. Without --worker, the hosts in --url-file are
+                    queued, and their results are output as workers complete
+                    them. Hosts already in the queue are not queued again.""")),
+                (['--worker'], dict(action='store_true', help="""Scan hosts
+                    from --queue until it is empty, instead of scanning
+                    --url or --url-file.""", default=False)),
+                (['--lease-time'], dict(action='store', help="""Seconds after
+                    which a host leased by a --worker which hasn't completed it
+                    is handed to another worker, and after which the
+                    coordinator gives up if no worker holds a lease. Default
+                    600.""", default=600,
+                    type=int)),
+                (['--stats-file'], dict(action='store', help="""A file to
+                    write scan metrics to once the scan is finished: time spent
+                    per phase, and requests by status code, bytes, latency and
+                    retries.""")),
+                (['--stats-format'], dict(action='store', help="""The
+                    format of --stats-file. Default json.""", default='json',
+                    choices=enum_list(StatsFormat))),
+                (['--profile'], dict(action='store', help="""Profile the
+                    scan and write the profile to this file, and a summary of
+                    the functions most time was spent in, for every phase, to
+                    the same file with a '.txt' extension appended.""")),
+                (['--profile-mode'], dict(action='store', help="""'cprofile'
+                    profiles every function call, and writes a profile which
+                    can be read with pstats. 'sampling' samples the stacks of
+                    the scanning threads every few milliseconds, which is
+                    cheaper and includes time spent waiting on the network, and
+                    writes collapsed stacks for flame graph tools. Default
+                    cprofile.""", default='cprofile',
+                    choices=enum_list(ProfileMode))),
+                (['--cache'], dict(action='store_true', help="""Reuse the
+                    results of previous scans of the same hosts. The scanning
+                    method is reused, and if the files which tell versions
+                    apart best are unchanged and every plugin and theme
+                    previously found is still there, the previous version,
+                    plugins and themes are reused too. Otherwise, the host is
+                    scanned in full. Plugins and themes installed since the
+                    previous scan are only found once the cached results
+                    expire or the host changes.""", default=False)),
+                (['--cache-ttl'], dict(action='store', help="""Seconds
+                    after which cached results are no longer used. Default
+                    2592000 (30 days).""", default=2592000, type=int)),
+                (['--baseline'], dict(action='store', help="""The output of a
+                    previous scan with '--output json'. Only the changes since
+                    that scan are output. The plugins and themes found by it
+                    are requested again, and if they are all still there and
+                    the version is unchanged, they are reused instead of
+                    enumerating every plugin and theme.""", default=None)),
+                (['--baseline-full-every'], dict(action='store', help="""With
+                    --baseline, hosts are still enumerated in full once every
+                    this many days, so that new plugins and themes are found.
+                    Hosts are spread evenly over the days. Default 7.""",
+                    default=7, type=int))
             ]
 
 class BasePluginInternal(controller.CementBaseController):
@@ -61,6 +174,24 @@ class BasePluginInternal(controller.CementBaseController):
     out = None
     DEFAULT_UA = 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.125 Safari/537.36'
     not_found_url = "misc/test/error/404/ispresent.html"
+    # requests kept in flight per thread while enumerating.
+    window_per_thread = 4
+    # size of the chunks in which fingerprinted files are read and hashed.
+    hash_chunk_size = 16384
+    # common.journal.Journal, if the scan is being journaled.
+    journal = None
+    # common.resultcache.ResultCache, if --cache is enabled.
+    result_cache = None
+    # phases whose cached result can be reused. Interesting URLs are few, so
+    # revalidating them would cost as much as requesting them again.
+    cache_reusable = ['plugins', 'themes', 'version']
+    # host -> result of the previous scan, if --baseline is set.
+    baseline = None
+    # whether plugins and themes are output as soon as they are found.
+    stream_finds = True
+
+    # hosts from a --url-file submitted per thread ahead of being scanned.
+    hosts_per_thread = 2
 
     class Meta:
         label = 'baseplugin'
@@ -80,11 +211,22 @@ class BasePluginInternal(controller.CementBaseController):
             except AttributeError:
                 return default
 
-    def _general_init(self, output=None, user_agent=None):
+    def _general_init(self, output=None, user_agent=None, threads=4,
+            host_threads=None, retries=2, max_body_size=5242880,
+            profile_mode=None):
         self.session = Session()
-
-        # http://stackoverflow.com/questions/23632794/in-requests-library-how-can-i-avoid-httpconnectionpool-is-full-discarding-con
-        a = requests.adapters.HTTPAdapter(pool_maxsize=5000)
+        self.metrics = Metrics()
+
+        # All requests for all hosts go through this scheduler.
+        self.threads = threads
+        self.host_threads = host_threads or threads
+
+        # One pool of keep-alive connections per host being scanned, which
+        # is as large as the number of requests the scheduler sends it at
+        # once.
+        a = PooledAdapter(pool_connections=max(10, threads *
+            self.hosts_per_thread), pool_maxsize=self.host_threads,
+            metrics=self.metrics)
         self.session.mount('http://', a)
         self.session.mount('https://', a)
 
@@ -94,6 +236,15 @@ class BasePluginInternal(controller.CementBaseController):
 
         self.session.headers['User-Agent'] = user_agent
 
+        self.session.hooks['response'].append(self.metrics.response_hook)
+        self.profiler = Profiler(profile_mode)
+
+        self.retries = retries
+        self.max_body_size = max_body_size
+        self.scheduler = Scheduler(self.threads, self.host_threads,
+                retries=retries, metrics=self.metrics, profiler=self.profiler)
+        self.engines = {}
+
         if not output:
             self.out = StandardOutput()
         else:
@@ -108,11 +259,30 @@ class BasePluginInternal(controller.CementBaseController):
             url = pargs.url
 
         threads = pargs.threads
+        host_threads = pargs.host_threads
         enumerate = pargs.enumerate
         verb = pargs.verb
         method = pargs.method
         output = pargs.output
         timeout = pargs.timeout
+        retries = pargs.retries
+        max_body_size = pargs.max_body_size
+        journal = pargs.journal
+        resume = pargs.resume
+        processes = pargs.processes
+        queue = pargs.queue
+        worker = pargs.worker
+        lease_time = pargs.lease_time
+        stats_file = pargs.stats_file
+        stats_format = pargs.stats_format
+        profile = pargs.profile
+        profile_mode = pargs.profile_mode
+        cache = pargs.cache
+        cache_ttl = pargs.cache_ttl
+        baseline = pargs.baseline
+        baseline_full_every = pargs.baseline_full_every
+        engine = pargs.engine
+        fingerprint_mode = pargs.fingerprint_mode
         number = pargs.number if not pargs.number == 'all' else 100000
 
         plugins_base_url = self.getattr(pargs, 'plugins_base_url')
@@ -134,7 +304,8 @@ class BasePluginInternal(controller.CementBaseController):
         kwargs_base = self._base_kwargs(opts)
         kwargs_plugins = dict_combine(kwargs_base, {
             'base_url': opts['plugins_base_url'],
-            'max_plugins': opts['number']
+            'max_plugins': opts['number'],
+            'engine': opts['engine']
         })
 
         kwargs_themes = dict(kwargs_plugins)
@@ -158,7 +329,8 @@ class BasePluginInternal(controller.CementBaseController):
                     'versions_file': self.versions_file,
                     'verb': opts['verb'],
                     'threads': opts['threads'],
-                    'timeout': opts['timeout']
+                    'timeout': opts['timeout'],
+                    'mode': opts['fingerprint_mode']
                 }
             },
             'interesting urls': {
@@ -210,54 +382,413 @@ class BasePluginInternal(controller.CementBaseController):
 
         if opts['output'] == 'json':
             output = JsonOutput()
+        elif opts['output'] == 'ndjson':
+            output = NdjsonOutput()
         else:
             output = StandardOutput()
 
-        self._general_init(output=output)
+        profile_mode = opts['profile_mode'] if opts['profile'] else None
+        self._general_init(output=output, threads=opts['threads'],
+                host_threads=opts['host_threads'], retries=opts['retries'],
+                max_body_size=opts['max_body_size'], profile_mode=profile_mode)
+        try:
+            if opts['journal']:
+                self.journal = Journal(opts['journal'], resume=opts['resume'])
+            elif opts['resume']:
+                self.out.fatal('--resume requires --journal.')
+
+            if opts['cache']:
+                self.result_cache = ResultCache(os.path.join(
+                    common.cache_dir('results'), 'results.db'),
+                    ttl=opts['cache_ttl'])
+
+            if opts['baseline']:
+                self.baseline = baseline_load(opts['baseline'])
+
+            if opts['profile'] and opts['processes'] > 1:
+                self.out.fatal('--profile can\'t be used with --processes.')
+
+            self.profiler.start()
+            try:
+                with self.profiler.phase('scan'):
+                    self._plugin_init(opts)
+            finally:
+                self.profiler.stop()
+        finally:
+            self._close()
+
+        if opts['profile']:
+            self.profiler.dump(opts['profile'])
+
+        elapsed = datetime.now() - time_start
+        if opts['stats_file']:
+            with open(opts['stats_file'], 'w') as f:
+                if opts['stats_format'] == StatsFormat.prometheus:
+                    f.write(self.metrics.prometheus(elapsed.total_seconds()))
+                else:
+                    f.write(self.metrics.json(elapsed.total_seconds()))
+
+        self.out.echo('\033[95m[+] Scan finished (%s elapsed)\033[0m' %
+                str(elapsed))
 
+    def _plugin_init(self, opts):
         functionality = self._functionality(opts)
         enabled_functionality = self._enabled_functionality(functionality, opts)
 
-        if 'url_file' in opts:
+        if opts['worker']:
+            if not opts['queue']:
+                self.out.fatal('--worker requires --queue.')
+
+            self._queue_worker(opts, functionality, enabled_functionality)
+        elif opts['queue']:
+            self._queue_coordinate(opts, functionality)
+        elif 'url_file' in opts and opts['processes'] > 1:
+            self._plugin_init_processes(opts, functionality,
+                    enabled_functionality)
+        elif 'url_file' in opts:
+            # Results are output as soon as each host completes, and only a
+            # few hosts per thread are read from the file ahead of time.
+            max_in_flight = opts['threads'] * self.hosts_per_thread
             with open(opts['url_file']) as url_file:
                 with ThreadPoolExecutor(max_workers=opts['threads']) as executor:
-                    results = []
+                    in_flight = {}
                     for url in url_file:
-                        args = [url, opts, functionality, enabled_functionality]
+                        if self._journal_has(url.rstrip('\n'), 'done'):
+                            continue
 
-                        future = executor.submit(self.url_scan, *args)
+                        if len(in_flight) >= max_in_flight:
+                            done, _ = wait(in_flight,
+                                    return_when=FIRST_COMPLETED)
+                            for future in done:
+                                self._result_output(future,
+                                        in_flight.pop(future), functionality)
 
-                        results.append({
-                            'future': future,
-                            'url': url.rstrip('\n'),
-                        })
+                        args = [url, opts, functionality, enabled_functionality]
+                        future = executor.submit(self.url_scan, *args)
+                        in_flight[future] = url.rstrip('\n')
 
-                    for result in results:
-                        try:
-                            output = result['future'].result()
-                            output['host'] = result['url']
-                            self.out.result(output, functionality)
-                        except:
-                            exc = traceback.format_exc()
-                            self.out.warn(exc)
+                    for future in as_completed(in_flight):
+                        self._result_output(future, in_flight[future],
+                                functionality)
 
         else:
             output = self.url_scan(opts['url'], opts, functionality,
                     enabled_functionality)
+            # Single URL results have no host, unless comparing them with the
+            # baseline or telling ndjson records apart needs one.
+            if self.baseline is not None or isinstance(self.out, NdjsonOutput):
+                output['host'] = opts['url']
 
-            self.out.result(output, functionality)
+            self._result_emit(output, functionality)
 
-        self.out.echo('\033[95m[+] Scan finished (%s elapsed)\033[0m' %
-                str(datetime.now() - time_start))
+    def _result_emit(self, output, functionality):
+        """
+            Outputs the result of a scan, or its changes since the baseline if
+            there is one.
+            @param output as returned by url_scan, with a 'host' key if there
+                is a baseline or the output is ndjson.
+        """
+        with self.profiler.phase('output'):
+            if self.baseline is not None:
+                previous = self.baseline.get(output['host'])
+                self.out.delta(delta_get(previous, output), functionality)
+            else:
+                self.out.result(output, functionality)
+
+    def _result_output(self, future, host, functionality):
+        """
+            Outputs the result of a url_scan future for host, or a warning if
+            it raised an exception.
+        """
+        try:
+            output = future.result()
+            output['host'] = host
+            self._result_emit(output, functionality)
+
+            self._journal_record(host, 'done')
+        except:
+            exc = traceback.format_exc()
+            self.out.warn(exc)
+
+    def _plugin_init_processes(self, opts, functionality,
+            enabled_functionality):
+        """
+            Scans opts['url_file'] with opts['processes'] forked processes.
+            Host number i in the file is scanned by process i % processes, and
+            results are output in file order as they become available.
+        """
+        # Loaded before forking so that the processes share them.
+        for filename in [self.plugins_file, self.themes_file]:
+            if filename:
+                wordlist_get(filename)
+        if self.versions_file:
+            fingerprint_get(self.versions_file)
+
+        nb_processes = opts['processes']
+        queue = Queue()
+        processes = []
+        for shard in range(nb_processes):
+            process = Process(target=self._process_shard, args=(shard,
+                nb_processes, queue, opts, functionality,
+                enabled_functionality))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+
+        results = {}
+        nb_metrics = 0
+        with open(opts['url_file']) as url_file:
+            for i, url in enumerate(url_file):
+                url = url.rstrip('\n')
+                if self._journal_has(url, 'done'):
+                    continue
+
+                while i not in results:
+                    try:
+                        nb, ok, output = queue.get(timeout=1)
+                    except Empty:
+                        # Results are flushed to the queue before exiting.
+                        process = processes[i % nb_processes]
+                        if not process.is_alive() and queue.empty():
+                            results[i] = (False, 'Process scanning %s exited'
+                                    ' unexpectedly.' % url)
+                        continue
+
+                    if nb is None:
+                        # Each process sends its metrics once it is done.
+                        self.metrics.merge(output)
+                        nb_metrics += 1
+                    else:
+                        results[nb] = (ok, output)
+
+                ok, output = results.pop(i)
+                if ok:
+                    output['host'] = url
+                    self._result_emit(output, functionality)
+
+                    self._journal_record(url, 'done')
+                else:
+                    self.out.warn(output)
+
+        while nb_metrics < nb_processes:
+            try:
+                nb, ok, output = queue.get(timeout=1)
+            except Empty:
+                alive = [p for p in processes if p.is_alive()]
+                if not alive and queue.empty():
+                    break
+                continue
+
+            if nb is None:
+                self.metrics.merge(output)
+                nb_metrics += 1
+
+        for process in processes:
+            process.join()
+
+    def _process_shard(self, shard, nb_processes, queue, opts, functionality,
+            enabled_functionality):
+        """
+            Runs in a forked process. Scans the hosts in shard, and puts
+            (number, ok, output or traceback) in queue for each of them.
+        """
+        # The parent process outputs results, in order.
+        self.stream_finds = False
+        # Threads and connections are not inherited by forked processes.
+        self._general_init(output=self.out, threads=opts['threads'],
+                host_threads=opts['host_threads'], retries=opts['retries'],
+                max_body_size=opts['max_body_size'])
+
+        def done(nb, future):
+            try:
+                queue.put((nb, True, future.result()))
+            except:
+                queue.put((nb, False, traceback.format_exc()))
+
+        try:
+            with open(opts['url_file']) as url_file:
+                with ThreadPoolExecutor(max_workers=opts['threads']) as executor:
+                    for i, url in enumerate(url_file):
+                        if i % nb_processes != shard or \
+                                self._journal_has(url.rstrip('\n'), 'done'):
+                            continue
+
+                        args = [url, opts, functionality, enabled_functionality]
+                        future = executor.submit(self.url_scan, *args)
+                        future.add_done_callback(lambda f, i=i: done(i, f))
+        finally:
+            self._close()
+            queue.put((None, True, self.metrics.report()))
+
+    def _queue_coordinate(self, opts, functionality, poll_interval=1):
+        """
+            Queues the hosts to scan in opts['queue'], and outputs the results
+            stored by workers, in the order in which hosts were queued. Gives
+            up once no worker has held a lease for opts['lease_time'] seconds,
+            as hosts would then only be scanned by workers started later.
+        """
+        if 'url_file' in opts:
+            with open(opts['url_file']) as url_file:
+                hosts = [url.rstrip('\n') for url in url_file]
+        else:
+            hosts = [opts['url']]
+
+        queue = WorkQueue(opts['queue'], lease_time=opts['lease_time'])
+        queue.enqueue(hosts)
+
+        pending = sorted(queue.positions_get(hosts).values())
+        finished = {}
+        cursor = 0
+        idle_since = time.time()
+        while pending:
+            cursor, rows = queue.finished_since(cursor)
+            for position, host, state, result in rows:
+                finished[position] = (host, state, result)
+
+            while pending and pending[0] in finished:
+                host, state, result = finished.pop(pending.pop(0))
+                if state == State.done:
+                    result['host'] = host
+                    self._result_emit(result, functionality)
+                else:
+                    self.out.warn(result)
+
+            if not pending:
+                break
+
+            if rows or queue.leases_live() > 0:
+                idle_since = time.time()
+            elif time.time() - idle_since > opts['lease_time']:
+                self.out.warn(('No worker has leased a host from %s for %s '
+                    'seconds, %s hosts were not scanned. Their results will be '
+                    'output if this is ran again once workers are.') %
+                    (opts['queue'], opts['lease_time'], len(pending)))
+                break
+
+            time.sleep(poll_interval)
+
+    def _queue_worker(self, opts, functionality, enabled_functionality):
+        """
+            Leases hosts from opts['queue'] and scans them on opts['threads']
+            threads, until there are no hosts left to lease.
+        """
+        queue = WorkQueue(opts['queue'], lease_time=opts['lease_time'])
+        worker = '%s:%s' % (socket.gethostname(), os.getpid())
+
+        def work():
+            while True:
+                hosts = queue.lease(worker)
+                if not hosts:
+                    break
+
+                host = hosts[0]
+                try:
+                    output = self.url_scan(host, opts, functionality,
+                            enabled_functionality)
+                except:
+                    queue.fail(host, worker, traceback.format_exc())
+                else:
+                    queue.complete(host, worker, output)
+
+        with ThreadPoolExecutor(max_workers=opts['threads']) as executor:
+            futures = [executor.submit(work) for _ in range(opts['threads'])]
+
+        for future in futures:
+            future.result()
+
+    def _close(self):
+        """
+            Waits for outstanding requests and releases the engines and the
+            scheduler created by _general_init.
+        """
+        for engine in self.engines.values():
+            engine.close()
+
+        self.engines = {}
+        self.scheduler.shutdown()
+        # Closes every connection, recording their reuse in self.metrics.
+        self.session.close()
+
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def _journal_has(self, host, phase):
+        return self.journal is not None and self.journal.has(host, phase)
+
+    def _journal_record(self, host, phase, result=None):
+        if self.journal:
+            self.journal.record(host, phase, result)
+
+    def _request(self, requests_verb, url, **kwargs):
+        """
+            Performs a request through the scheduler, so that it counts towards
+            the global and per-host limits on concurrent requests.
+            @param requests_verb e.g. self.session.head
+            @return the requests.Response
+        """
+        return self._request_async(requests_verb, url, **kwargs).result()
+
+    def _request_async(self, requests_verb, url, **kwargs):
+        """
+            Same as _request, without waiting for the response.
+            @return a concurrent.futures.Future for the requests.Response
+        """
+        return self.scheduler.submit(base_url(url), requests_verb, url,
+                **kwargs)
+
+    def _request_failed(self, url, exception):
+        """
+            Warns that a request which failed with one of RETRY_EXCEPTIONS
+            is being skipped, after having been retried.
+        """
+        if isinstance(exception, Timeout):
+            reason = 'timed out'
+        else:
+            reason = 'failed (%s)' % exception
+
+        self.out.warn('Request to %s %s after %s retries.' % (url, reason,
+            self.retries))
 
     def url_scan(self, url, opts, functionality, enabled_functionality):
+        supplied_url = url
         url = common.validate_url(url, self.out)
+        # Journal entries are keyed by the URL as supplied.
+        host = supplied_url.rstrip('\n')
+        self.out.event('host_started', host)
+
+        cached = None
+        if self.result_cache:
+            cached = self.result_cache.get(host, self._meta.label)
+
+        previous = None
+        if self.baseline is not None:
+            previous = self.baseline.get(host)
 
         if self.can_enumerate_plugins or self.can_enumerate_themes:
             scanning_method = opts['method']
             if not scanning_method:
-                scanning_method, url = self.determine_scanning_method(url,
-                        opts['verb'], opts['timeout'])
+                if self._journal_has(host, 'scanning_method'):
+                    scanning_method, url = self.journal.get(host,
+                            'scanning_method')
+                elif cached and cached['scanning_method']:
+                    scanning_method, url = cached['scanning_method'], \
+                            cached['url']
+                    self._journal_record(host, 'scanning_method',
+                            [scanning_method, url])
+                else:
+                    phase_start = time.time()
+                    with self.profiler.phase('scanning_method'):
+                        scanning_method, url = self.determine_scanning_method(
+                                url, opts['verb'], opts['timeout'])
+
+                    self.metrics.phase_record('scanning_method',
+                            time.time() - phase_start)
+                    self._journal_record(host, 'scanning_method',
+                            [scanning_method, url])
+
+            self.out.event('scanning_method', host, method=scanning_method,
+                    url=url)
 
         else:
             scanning_method = None
@@ -267,8 +798,21 @@ class BasePluginInternal(controller.CementBaseController):
             self.out.echo(common.template('scan_begin.tpl', {'noun': 'all', 'url':
                 url}))
 
+        unchanged = cached is not None and self._cache_revalidate(url,
+                cached, scanning_method, opts)
+        # hashes of the files fetched to identify the version.
+        hashes = cached['hashes'] if unchanged else {}
+
+        enumerates = list(enabled_functionality)
+        if previous:
+            # Whether the version changed decides whether plugins and themes
+            # are enumerated again.
+            enumerates.sort(key=lambda enumerate: enumerate != 'version')
+
+        # whether the plugins and themes in the baseline are still valid.
+        baseline_valid = None
         result = {}
-        for enumerate in enabled_functionality:
+        for enumerate in enumerates:
             if not enumerating_all:
                 self.out.echo(common.template('scan_begin.tpl', {'noun': enumerate,
                     'url': url}))
@@ -280,14 +824,182 @@ class BasePluginInternal(controller.CementBaseController):
             kwargs['url'] = url
             if enumerate in ['themes', 'plugins']:
                 kwargs['scanning_method'] = scanning_method
+                # With a baseline, only changes are output.
+                if self.stream_finds and self.baseline is None:
+                    kwargs['host'] = host
+
+            if self._journal_has(host, enumerate):
+                result[enumerate] = self.journal.get(host, enumerate)
+                continue
+
+            if unchanged and enumerate in self.cache_reusable and \
+                    enumerate in cached['finds']:
+                result[enumerate] = cached['finds'][enumerate]
+                self.out.event('phase_finished', host, phase=enumerate,
+                        elapsed=0, cached=True)
+                self._journal_record(host, enumerate, result[enumerate])
+                continue
+
+            if previous and enumerate in ['plugins', 'themes'] and \
+                    enumerate in previous:
+                if baseline_valid is None:
+                    baseline_valid = self._baseline_revalidate(host, url,
+                            previous, result, scanning_method, opts)
+
+                if baseline_valid:
+                    result[enumerate] = previous[enumerate]
+                    self.out.event('phase_finished', host, phase=enumerate,
+                            elapsed=0, baseline=True)
+                    self._journal_record(host, enumerate, result[enumerate])
+                    continue
+
+            if enumerate == 'version' and self.result_cache:
+                hashes = kwargs['hashes'] = {}
 
             # Call to the respective functions occurs here.
-            finds, is_empty = enum['func'](**kwargs)
+            phase_start = time.time()
+            with self.profiler.phase(enumerate):
+                finds, is_empty = enum['func'](**kwargs)
+
+            elapsed = time.time() - phase_start
+            self.metrics.phase_record(enumerate, elapsed)
+            self.out.event('phase_finished', host, phase=enumerate,
+                    elapsed=elapsed)
 
             result[enumerate] = {'finds': finds, 'is_empty': is_empty}
+            self._journal_record(host, enumerate, result[enumerate])
+
+        if self.result_cache:
+            self.result_cache.put(host, self._meta.label, {
+                'scanning_method': scanning_method,
+                'url': url,
+                'hashes': hashes,
+                'finds': result,
+            })
 
         return result
 
+    def _cache_revalidate(self, url, cached, scanning_method, opts):
+        """
+            Checks, with a few requests, whether a host seems unchanged since
+            its result was cached: the changelog and the file which best
+            tells versions apart have the same hashes, and every plugin and
+            theme found is still there.
+            @param cached a result from self.result_cache.
+            @return whether the cached finds can be reused.
+        """
+        if cached['scanning_method'] != scanning_method or \
+                cached['url'] != url:
+            return False
+
+        checks = []
+        hashes = cached['hashes']
+        if self.can_enumerate_version and 'version' in cached['finds']:
+            if not hashes:
+                return False
+
+            checks += self._version_checks(url, hashes, opts['timeout'])
+
+        checks += self._finds_checks(url, cached['finds'], scanning_method,
+                opts)
+
+        return self._checks_pass(checks)
+
+    def _baseline_revalidate(self, host, url, previous, result,
+            scanning_method, opts):
+        """
+            Checks whether the plugins and themes in the baseline can be
+            reused instead of enumerating them: the host isn't due a full
+            scan, its version is unchanged and every plugin and theme in the
+            baseline is still there.
+            @param previous the result of host in the baseline.
+            @param result the result of the current scan so far.
+            @return whether the baseline is still valid.
+        """
+        if full_scan_due(host, opts['baseline_full_every']):
+            return False
+
+        if 'version' in result:
+            previous_version = previous.get('version', {}).get('finds')
+            if result['version']['finds'] != previous_version:
+                return False
+
+        return self._checks_pass(self._finds_checks(url, previous,
+            scanning_method, opts))
+
+    def _version_checks(self, url, hashes, timeout):
+        """
+            Requests the changelog and the file which best tells versions
+            apart, if their hashes are in hashes.
+            @return a list of (future, function of its result, expected
+                value).
+        """
+        checks = []
+        vf = fingerprint_get(self.versions_file)
+        changelog_url = vf.changelog_get()
+        if changelog_url in hashes:
+            future = self.scheduler.submit(base_url(url),
+                    self.enumerate_file_hash, url, file_url=changelog_url,
+                    timeout=timeout)
+            checks.append((future, lambda h: h, hashes[changelog_url]))
+
+        file_url = vf.file_next(vf.versions, set())
+        if file_url not in hashes:
+            file_url = next((f for f in vf.files_get() if f in hashes), None)
+
+        if file_url:
+            future = self.scheduler.submit(base_url(url),
+                    self.enumerate_file_hash_sized, url, vf,
+                    file_url=file_url, timeout=timeout)
+            checks.append((future, lambda h: h, hashes[file_url]))
+
+        return checks
+
+    def _finds_checks(self, url, result, scanning_method, opts):
+        """
+            Requests every plugin and theme in result.
+            @param result a result as returned by url_scan.
+            @return a list of (future, function of its result, expected
+                value).
+        """
+        checks = []
+        if not scanning_method:
+            return checks
+
+        expected_status = common.scan_http_status(scanning_method)
+        if scanning_method == ScanningMethod.not_found:
+            # Finds are the URL of module_readme_file.
+            expected_status = 200
+
+        requests_verb = getattr(self.session, opts['verb'])
+        for enumerate in ['plugins', 'themes']:
+            previous = result.get(enumerate, {}).get('finds', [])
+            for find in previous:
+                future = self._request_async(requests_verb, find['url'],
+                        timeout=opts['timeout'])
+                checks.append((future, lambda r: r.status_code,
+                    expected_status))
+
+        return checks
+
+    def _checks_pass(self, checks):
+        """
+            @param checks as returned by _version_checks and _finds_checks.
+            @return whether every check got its expected value. Checks which
+                are still queued once one fails are cancelled.
+        """
+        try:
+            for future, value_get, expected in checks:
+                if value_get(future.result()) != expected:
+                    return False
+        except RequestException:
+            return False
+        finally:
+            for future, value_get, expected in checks:
+                future.cancel()
+
+        return True
+
     def determine_scanning_method(self, url, verb, timeout=15):
         """
             @param url the URL to determine scanning based on.
@@ -314,35 +1026,52 @@ class BasePluginInternal(controller.CementBaseController):
 
         return scanning_method, new_url
 
-    def _determine_ok_200(self, requests_verb, url, timeout):
-        if common.is_string(self.regular_file_url):
-            reg_url = url + self.regular_file_url
-            ok_resp = requests_verb(reg_url, timeout=timeout)
-            ok_200 = ok_resp.status_code == 200
-        else:
-            ok_200 = False
-            for path in self.regular_file_url:
-                reg_url = url + path
-                ok_resp = requests_verb(reg_url)
-                if ok_resp.status_code == 200:
-                    ok_200 = True
-                    break
+    def _determine_ok_200(self, futures):
+        """
+            @param futures the responses for each regular_file_url.
+            @return whether one of them is 200 OK, and the length of its
+                content, or otherwise of the last one's.
+        """
+        for future in as_completed(futures):
+            ok_resp = future.result()
+            if ok_resp.status_code == 200:
+                return True, len(ok_resp.content)
 
-        len_content = len(ok_resp.content)
+        return False, len(futures[-1].result().content)
 
-        return ok_200, len_content
-
-    def _determine_fake_200(self, requests_verb, url, timeout):
-        response = requests_verb(url + self.not_found_url,
-                    timeout=timeout)
+    def _determine_fake_200(self, future):
+        response = future.result()
 
         return response.status_code == 200, len(response.content)
 
     def _determine_scanning_method(self, url, verb, timeout=15):
         requests_verb = getattr(self.session, verb)
-        folder_resp = requests_verb(url + self.folder_url, timeout=timeout)
-        ok_200, reg_url_len = self._determine_ok_200(requests_verb, url, timeout)
-        fake_200, fake_200_len = self._determine_fake_200(requests_verb, url, timeout)
+        regular_file_urls = self.regular_file_url
+        if common.is_string(regular_file_urls):
+            regular_file_urls = [regular_file_urls]
+
+        # The probes don't depend on each other, so they are all sent at once.
+        probes = len(regular_file_urls) + 2
+        self.scheduler.controller_get(base_url(url)).limit_start(probes)
+        folder_future = self._request_async(requests_verb, url +
+                self.folder_url, timeout=timeout)
+        ok_futures = [self._request_async(requests_verb, url + path,
+            timeout=timeout) for path in regular_file_urls]
+        fake_future = self._request_async(requests_verb, url +
+                self.not_found_url, timeout=timeout)
+
+        try:
+            return self._determine_scanning_method_decide(url, folder_future,
+                    ok_futures, fake_future)
+        finally:
+            # Probes which weren't needed for the decision.
+            for future in [folder_future, fake_future] + ok_futures:
+                future.cancel()
+
+    def _determine_scanning_method_decide(self, url, folder_future,
+            ok_futures, fake_future):
+        ok_200, reg_url_len = self._determine_ok_200(ok_futures)
+        folder_resp = folder_future.result()
 
         # Detect redirects.
         folder_redirect = 300 <= folder_resp.status_code < 400
@@ -350,6 +1079,14 @@ class BasePluginInternal(controller.CementBaseController):
             redirect_url = folder_resp.headers['Location']
             return base_url(redirect_url)
 
+        if not ok_200:
+            # Not running the CMS, whether or not it responds with 200 for not
+            # found URLs.
+            self._error_determine_scanning(url, folder_resp, folder_redirect,
+                    ok_200)
+
+        fake_200, fake_200_len = self._determine_fake_200(fake_future)
+
         # Websites which return 200 for not found URLs.
         diff_lengths_above_threshold = abs(fake_200_len - reg_url_len) > 25
         if fake_200 and not diff_lengths_above_threshold:
@@ -382,26 +1119,15 @@ class BasePluginInternal(controller.CementBaseController):
         self.out.fatal('It is possible that ''%s'' is not running %s. If you disagree, please specify a --method.' % (url, self._meta.label))
 
     def plugins_get(self, amount=100000):
-        amount = int(amount)
-        with open(self.plugins_file) as f:
-            i = 0
-            for plugin in f:
-                if i >= amount:
-                    break
-                yield plugin.strip()
-                i += 1
+        return wordlist_get(self.plugins_file).head(amount)
 
     def themes_get(self, amount=100000):
-        amount = int(amount)
-        with open(self.themes_file) as f:
-            i = 0
-            for theme in f:
-                if i>= amount:
-                    break
-                yield theme.strip()
-                i +=1
+        return wordlist_get(self.themes_file).head(amount)
 
-    def enumerate(self, url, base_url_supplied, scanning_method, iterator_returning_method, max_iterator=500, threads=10, verb='head', timeout=15):
+    def enumerate(self, url, base_url_supplied, scanning_method,
+            iterator_returning_method, max_iterator=500, threads=10,
+            verb='head', timeout=15, engine=Engine.thread, host=None,
+            event=None):
         '''
             @param url base URL for the website.
             @param base_url_supplied Base url for themes, plugins. E.g. '%ssites/all/modules/%s/'
@@ -409,76 +1135,170 @@ class BasePluginInternal(controller.CementBaseController):
             @param iterator_returning_method a function which returns an
                 element that, when iterated, will return a full list of plugins
             @param max_iterator integer that will be passed unto iterator_returning_method
-            @param threads number of threads
+            @param threads number of threads. At most threads *
+                window_per_thread requests are queued or in flight at any
+                given time.
             @param verb what HTTP verb. Valid options are 'get' and 'head'.
             @param timeout the time, in seconds, that requests should wait
                 before throwing an exception.
+            @param engine see common.Engine
+            @param host the host as supplied by the user. If set, each find is
+                output with self.out.event(event, host, ...) as soon as it is
+                found.
+            @param event e.g. 'plugin'.
         '''
         if common.is_string(base_url_supplied):
             base_urls = [base_url_supplied]
         else:
             base_urls = base_url_supplied
 
-        requests_verb = getattr(self.session, verb)
-        futures = []
-        with ThreadPoolExecutor(max_workers=threads) as executor:
-            for base_url in base_urls:
-                plugins = iterator_returning_method(max_iterator)
-
-                if scanning_method == ScanningMethod.not_found:
-                    url_template = base_url + self.module_readme_file
-                    expected_status = 200
-                else:
-                    url_template = base_url
-                    expected_status = common.scan_http_status(scanning_method)
-
-                for plugin_name in plugins:
-                    plugin_url = url_template % (url, plugin_name)
-                    future = executor.submit(requests_verb, plugin_url,
-                            timeout=timeout)
-
-                    futures.append({
-                        'base_url': base_url,
-                        'future': future,
-                        'plugin_name': plugin_name,
-                        'plugin_url': plugin_url,
-                    })
-
-            p = ProgressBar(sys.stderr)
-            items_progressed = 0
-            items_total = len(base_urls) * int(max_iterator)
-
-            no_results = True
-            found = []
-            for future_array in futures:
-                items_progressed += 1
-                p.set(items_progressed, items_total)
-                r = future_array['future'].result()
-                if r.status_code == expected_status:
-                    plugin_url = future_array['plugin_url']
-                    plugin_name = future_array['plugin_name']
-
-                    no_results = False
-                    found.append({
+        if scanning_method == ScanningMethod.not_found:
+            expected_status = 200
+        else:
+            expected_status = common.scan_http_status(scanning_method)
+
+        window = threads * self.window_per_thread
+        http_engine = self._engine_get(engine)
+        p = ProgressBar(sys.stderr)
+        progress = {'items': 0, 'total': len(base_urls) * int(max_iterator)}
+
+        found = []
+        found_names = set()
+        for nb_base, base_url in enumerate(base_urls):
+            # Secondary locations are only checked for plugins that haven't
+            # been found yet, and only if the location seems to exist at all.
+            is_secondary = nb_base > 0
+            if is_secondary and not self._base_url_exists(url, base_url,
+                    scanning_method, verb, timeout):
+                progress['items'] += int(max_iterator)
+                continue
+
+            if scanning_method == ScanningMethod.not_found:
+                url_template = base_url + self.module_readme_file
+            else:
+                url_template = base_url
+
+            plugins = iterator_returning_method(max_iterator)
+            for nb, plugin_name, plugin_url, status_code in self._probe(
+                    http_engine, plugins, url, url_template, found_names,
+                    window, verb, timeout, p, progress):
+                if status_code == expected_status:
+                    found_names.add(plugin_name)
+                    find = {
                         'name': plugin_name,
                         'url': plugin_url
-                    })
-                elif r.status_code >= 500:
+                    }
+                    found.append(((nb_base, nb), find))
+                    if host:
+                        self.out.event(event, host, **find)
+                elif status_code >= 500:
                     self.out.warn('Got a 500 error. Is the server overloaded?')
 
-            p.hide()
+        p.hide()
+
+        # Finds complete out of order; report them in wordlist order.
+        found = [find for nb, find in sorted(found)]
 
-        return found, no_results
+        return found, len(found) == 0
+
+    def _probe(self, http_engine, plugins, url, url_template, skip_names,
+            window, verb, timeout, p, progress):
+        """
+            Requests a URL for each plugin, keeping at most `window` requests
+            in flight. Plugin names are pulled lazily from `plugins`.
+            @param skip_names plugin names that should not be requested.
+            @param p a ProgressBar, which is updated through `progress`.
+            @return a generator which yields (nb, plugin_name, plugin_url,
+                status_code) as requests complete. status_code is None if the
+                request timed out.
+        """
+        plugins = enumerate(plugins)
+        pending = {}
+        exhausted = False
+        while not exhausted or pending:
+            while not exhausted and len(pending) < window:
+                try:
+                    nb, plugin_name = next(plugins)
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                if plugin_name in skip_names:
+                    progress['items'] += 1
+                    continue
+
+                plugin_url = url_template % (url, plugin_name)
+                future = http_engine.submit(verb, plugin_url, timeout)
+                pending[future] = (nb, plugin_name, plugin_url)
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                nb, plugin_name, plugin_url = pending.pop(future)
+                progress['items'] += 1
+                p.set(progress['items'], progress['total'])
+
+                try:
+                    status_code = future.result()
+                except RETRY_EXCEPTIONS as e:
+                    self._request_failed(plugin_url, e)
+                    status_code = None
+
+                yield nb, plugin_name, plugin_url, status_code
 
-    def enumerate_plugins(self, url, base_url, scanning_method='forbidden', max_plugins=500, threads=10, verb='head', timeout=15):
+    def _base_url_exists(self, url, base_url, scanning_method, verb, timeout):
+        """
+            Determines, with a single request, whether a plugin location such
+            as '%ssites/default/modules/%s/' exists on the website.
+            @return False if the location is known not to exist, True
+                otherwise.
+        """
+        if scanning_method == ScanningMethod.not_found:
+            # Folders always respond with 404 Not Found, so there's no way to
+            # know without requesting the plugins themselves.
+            return True
+
+        folder_url = base_url[:base_url.rindex('%s')] % url
+        requests_verb = getattr(self.session, verb)
+        try:
+            r = self._request(requests_verb, folder_url, timeout=timeout)
+        except requests.exceptions.RequestException:
+            return True
+
+        return r.status_code != 404
+
+    def _engine_get(self, engine):
+        """
+            Engines are created once and shared by all hosts, so that they
+            honour the same limits as the scheduler.
+            @param engine see common.Engine
+            @return an engine, as defined in common.engine.
+        """
+        if engine not in self.engines:
+            if engine == Engine.async:
+                self.engines[engine] = AsyncEngine(self.scheduler,
+                        headers=self.session.headers)
+            else:
+                self.engines[engine] = ThreadEngine(self.session,
+                        self.scheduler)
+
+        return self.engines[engine]
+
+    def enumerate_plugins(self, url, base_url, scanning_method='forbidden',
+            max_plugins=500, threads=10, verb='head', timeout=15,
+            engine=Engine.thread, host=None):
         iterator = getattr(self, 'plugins_get')
         return self.enumerate(url, base_url, scanning_method, iterator,
-                max_plugins, threads, verb, timeout)
+                max_plugins, threads, verb, timeout, engine, host, 'plugin')
 
-    def enumerate_themes(self, url, base_url, scanning_method='forbidden', max_plugins=500, threads=10, verb='head', timeout=15):
+    def enumerate_themes(self, url, base_url, scanning_method='forbidden',
+            max_plugins=500, threads=10, verb='head', timeout=15,
+            engine=Engine.thread, host=None):
         iterator = getattr(self, 'themes_get')
         return self.enumerate(url, base_url, scanning_method, iterator,
-                max_plugins, threads, verb, timeout)
+                max_plugins, threads, verb, timeout, engine, host, 'theme')
 
     def enumerate_interesting(self, url, interesting_urls, threads=10,
             verb='head', timeout=15):
@@ -487,7 +1307,13 @@ class BasePluginInternal(controller.CementBaseController):
         found = []
         for path, description in interesting_urls:
             interesting_url = url + path
-            resp = requests_verb(interesting_url, timeout=timeout)
+            try:
+                resp = self._request(requests_verb, interesting_url,
+                        timeout=timeout)
+            except RETRY_EXCEPTIONS as e:
+                self._request_failed(interesting_url, e)
+                continue
+
             if resp.status_code == 200 or resp.status_code == 301:
                 found.append({
                     'url': interesting_url,
@@ -496,32 +1322,97 @@ class BasePluginInternal(controller.CementBaseController):
 
         return found, len(found) == 0
 
-    def enumerate_version(self, url, versions_file, threads=10, verb='head', timeout=15):
-        vf = VersionsFile(versions_file)
+    def enumerate_version(self, url, versions_file, threads=10, verb='head',
+            timeout=15, mode=FingerprintMode.full, hashes=None):
+        """
+            @param hashes if a dict, the hash of every file fetched is stored
+                in it, keyed by file url.
+        """
+        if hashes is None:
+            hashes = {}
+
+        vf = fingerprint_get(versions_file)
+        if mode == FingerprintMode.adaptive:
+            return self.enumerate_version_adaptive(url, vf, timeout, hashes)
 
-        hashes = {}
         futures = {}
         files = vf.files_get()
-        with ThreadPoolExecutor(max_workers=threads) as executor:
-            for file_url in files:
-                futures[file_url] = executor.submit(self.enumerate_file_hash,
-                        url, file_url=file_url, timeout=timeout)
+        for file_url in files:
+            futures[file_url] = self.scheduler.submit(base_url(url),
+                    self.enumerate_file_hash_sized, url, vf, file_url=file_url,
+                    timeout=timeout)
 
-            for file_url in futures:
+        for file_url in futures:
+            try:
                 hashes[file_url] = futures[file_url].result()
+            except RETRY_EXCEPTIONS as e:
+                # An unknown hash just doesn't match any version.
+                self._request_failed(url + file_url, e)
+                hashes[file_url] = None
 
         version = vf.version_get(hashes)
 
         # Narrow down using changelog, if accurate.
         if vf.has_changelog():
-            version = self.enumerate_version_changelog(url, version, vf, timeout)
+            version = self.enumerate_version_changelog(url, version, vf,
+                    timeout, hashes)
 
         return version, len(version) == 0
 
-    def enumerate_version_changelog(self, url, versions_estimated, vf, timeout=15):
+    def enumerate_version_adaptive(self, url, vf, timeout=15, hashes=None):
+        """
+            Requests one file at a time, choosing the file which best narrows
+            down the candidate versions, until they can't be narrowed down
+            any further. Files whose hash doesn't match any candidate, e.g.
+            because they were modified, are ignored.
+            @param vf a common.fingerprint.FingerprintIndex
+            @param hashes see enumerate_version.
+        """
+        if hashes is None:
+            hashes = {}
+
+        candidates = vf.versions
+        fetched = set()
+        matched = False
+        while True:
+            file_url = vf.file_next(candidates, fetched, must_split=matched)
+            if file_url is None:
+                break
+
+            fetched.add(file_url)
+            try:
+                file_hash = self.scheduler.submit(base_url(url),
+                        self.enumerate_file_hash_sized, url, vf,
+                        file_url=file_url, timeout=timeout).result()
+            except RETRY_EXCEPTIONS as e:
+                self._request_failed(url + file_url, e)
+                continue
+
+            hashes[file_url] = file_hash
+            narrowed = vf.versions_with(file_url, file_hash) & candidates
+            if narrowed:
+                candidates = narrowed
+                matched = True
+
+        version = sorted(candidates) if matched else []
+        if len(version) > 1 and vf.has_changelog():
+            version = self.enumerate_version_changelog(url, version, vf,
+                    timeout, hashes)
+
+        return version, len(version) == 0
+
+    def enumerate_version_changelog(self, url, versions_estimated, vf,
+            timeout=15, hashes=None):
         ch_url = vf.changelog_get()
-        ch_hash = self.enumerate_file_hash(url, file_url=ch_url,
-                timeout=timeout)
+        try:
+            ch_hash = self.scheduler.submit(base_url(url),
+                    self.enumerate_file_hash, url, file_url=ch_url,
+                    timeout=timeout).result()
+        except RETRY_EXCEPTIONS:
+            return versions_estimated
+
+        if hashes is not None:
+            hashes[ch_url] = ch_hash
 
         ch_version = vf.changelog_identify(ch_hash)
 
@@ -531,8 +1422,74 @@ class BasePluginInternal(controller.CementBaseController):
             return versions_estimated
 
     def enumerate_file_hash(self, url, file_url, timeout=15):
-        r = self.session.get(url + file_url, timeout=timeout)
-        return hashlib.md5(r.content).hexdigest()
+        """
+            Downloads url + file_url and hashes its body as it is received,
+            so that the body is never held in memory as a whole.
+            @return the md5 of the body, or None if it was larger than
+                self.max_body_size.
+        """
+        r = self.session.get(url + file_url, timeout=timeout, stream=True)
+        try:
+            length = r.headers.get('content-length')
+            if length and length.isdigit() and int(length) > self.max_body_size:
+                return self._body_too_large(url + file_url)
+
+            md5 = hashlib.md5()
+            received = 0
+            for chunk in r.iter_content(self.hash_chunk_size):
+                received += len(chunk)
+                if received > self.max_body_size:
+                    return self._body_too_large(url + file_url)
+
+                md5.update(chunk)
+
+            return md5.hexdigest()
+        finally:
+            r.close()
+
+    def _body_too_large(self, file_url):
+        self.out.warn('Response from %s is larger than %s bytes, ignoring it.'
+                % (file_url, self.max_body_size))
+        return None
+
+    def enumerate_file_hash_sized(self, url, vf, file_url, timeout=15):
+        """
+            Same as enumerate_file_hash, but if vf records the size of
+            file_url for every version, a HEAD request is made first. The file
+            is only downloaded when its size doesn't tell which hash it has.
+            @param vf a common.fingerprint.FingerprintIndex
+            @return the md5 of the file, or None if its size doesn't match
+                any known version.
+        """
+        if vf.has_sizes(file_url):
+            size = self.enumerate_file_size(url, file_url, timeout)
+            if size is not None:
+                hashes = vf.hashes_with_size(file_url, size)
+                if len(hashes) == 0:
+                    return None
+                elif len(hashes) == 1:
+                    return hashes[0]
+
+        return self.enumerate_file_hash(url, file_url=file_url, timeout=timeout)
+
+    def enumerate_file_size(self, url, file_url, timeout=15):
+        """
+            @return the size of the file according to the Content-Length of a
+                HEAD request, or None if the server didn't respond with the
+                uncompressed size of an existing file.
+        """
+        r = self.session.head(url + file_url, timeout=timeout,
+                headers={'Accept-Encoding': 'identity'})
+
+        encoding = r.headers.get('content-encoding', 'identity')
+        length = r.headers.get('content-length')
+        if r.status_code != 200 or encoding != 'identity' or length is None:
+            return None
+
+        try:
+            return int(length)
+        except ValueError:
+            return None
 
 class BasePlugin(BasePluginInternal):
     '''
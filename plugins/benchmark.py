@@ -0,0 +1,199 @@
+from cement.core import handler, controller
+from common.benchmark import MockSite, SiteBehaviour, percentile
+from common import enum_list
+from common.wordlist import wordlist_get
+from plugins import HumanBasePlugin
+from plugins.drupal import Drupal
+from plugins.silverstripe import SilverStripe
+from subprocess import Popen, PIPE
+import json
+import os
+import random
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+class Benchmark(HumanBasePlugin):
+    """
+        Scans mock CMS sites served from this machine with droopescan, and
+        reports the throughput and memory use of the scan.
+    """
+
+    cms_plugins = {
+        'drupal': Drupal,
+        'silverstripe': SilverStripe,
+    }
+
+    class Meta:
+        label = 'benchmark'
+        stacked_on = 'base'
+        stacked_type = 'nested'
+        hide = True
+
+        arguments = [
+                (['--cms'], dict(action='store', help="""The CMS to
+                    benchmark. Default is all of them.""",
+                    choices=['drupal', 'silverstripe'])),
+                (['--hosts'], dict(action='store', help="""Number of mock
+                    sites to scan. Default 20.""", default=20, type=int)),
+                (['--latency'], dict(action='store', help="""Seconds every
+                    mock site waits before responding. Default 0.01.""",
+                    default=0.01, type=float)),
+                (['--behaviours'], dict(action='store', help="""Comma
+                    separated SiteBehaviours, assigned to the sites in turn.
+                    Default all of them.""",
+                    default=','.join(enum_list(SiteBehaviour)))),
+                (['--installed'], dict(action='store', help="""Number of
+                    plugins and themes installed on every site. Default 5.""",
+                    default=5, type=int)),
+                (['--number', '-n'], dict(action='store', help="""Passed on
+                    to the scan. Default 1000.""", default=1000, type=int)),
+                (['--threads', '-t'], dict(action='store', help="""Passed on
+                    to the scan. Default 4.""", default=4, type=int)),
+                (['--scan-args'], dict(action='store', help="""Other
+                    arguments for the scan, e.g. '--engine async'.""",
+                    default='')),
+                (['--seed'], dict(action='store', help="""Seed for choosing
+                    the installed plugins and themes. Default 0.""", default=0,
+                    type=int)),
+            ]
+
+    @controller.expose(help='', hide=True)
+    def default(self):
+        pargs = self.app.pargs
+        behaviours = pargs.behaviours.split(',')
+        for behaviour in behaviours:
+            if behaviour not in enum_list(SiteBehaviour):
+                self.error("Unknown behaviour '%s'." % behaviour)
+
+        labels = [pargs.cms] if pargs.cms else sorted(self.cms_plugins)
+        for label in labels:
+            sites, extra_sites = self.sites_create(self.cms_plugins[label],
+                    behaviours, pargs)
+            try:
+                report = self.run(label, sites, extra_sites, pargs)
+            finally:
+                for site in sites + extra_sites:
+                    site.stop()
+
+            self.report_print(label, report)
+
+    def sites_create(self, plugin, behaviours, pargs):
+        """
+            @return the sites to scan, and the sites which are only redirected
+                to.
+        """
+        rand = random.Random(pargs.seed)
+        plugin_names = list(wordlist_get(plugin.plugins_file).head(pargs.number))
+        theme_names = list(wordlist_get(plugin.themes_file).head(pargs.number))
+
+        sites = []
+        extra_sites = []
+        for i in range(pargs.hosts):
+            behaviour = behaviours[i % len(behaviours)]
+            plugins = rand.sample(plugin_names, min(pargs.installed,
+                len(plugin_names)))
+            themes = rand.sample(theme_names, min(pargs.installed,
+                len(theme_names)))
+
+            redirect_to = None
+            if behaviour == SiteBehaviour.redirect:
+                target = MockSite(plugin, SiteBehaviour.forbidden, plugins,
+                        themes, pargs.latency)
+                target.start()
+                extra_sites.append(target)
+                redirect_to = target.url
+
+            site = MockSite(plugin, behaviour, plugins, themes, pargs.latency,
+                    redirect_to=redirect_to)
+            site.start()
+            sites.append(site)
+
+        return sites, extra_sites
+
+    def run(self, label, sites, extra_sites, pargs):
+        """
+            Scans sites in a separate process.
+            @param extra_sites sites which are not scanned directly, but
+                whose requests are counted.
+            @return a dict with the results of the benchmark.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            url_file = os.path.join(tmp_dir, 'hosts.txt')
+            with open(url_file, 'w') as f:
+                for site in sites:
+                    f.write(site.url + '\n')
+
+            stats_file = os.path.join(tmp_dir, 'stats.json')
+            args = [sys.executable, 'droopescan', 'scan', label, '--url-file',
+                    url_file, '-n', str(pargs.number), '-t',
+                    str(pargs.threads), '--output', 'ndjson', '--stats-file',
+                    stats_file]
+
+            args += shlex.split(pargs.scan_args)
+
+            start = time.time()
+            with open(os.devnull, 'w') as devnull:
+                process = Popen(args, stdout=PIPE, stderr=devnull)
+                output = process.stdout.read()
+                # Reaped here rather than by Popen, for the child's resource
+                # use.
+                pid, status, rusage = os.wait4(process.pid, 0)
+                process.returncode = os.WEXITSTATUS(status)
+
+            elapsed = time.time() - start
+            try:
+                with open(stats_file) as f:
+                    connections = json.load(f)['connections']
+            except (IOError, ValueError):
+                connections = None
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        finished = 0
+        host_times = []
+        for line in output.splitlines():
+            record = json.loads(line)
+            if record['type'] == 'host_finished':
+                finished += 1
+                # None for hosts started by another process, e.g. with
+                # --processes.
+                if record['elapsed'] is not None:
+                    host_times.append(record['elapsed'])
+
+        requests = sum([site.requests for site in sites + extra_sites])
+        return {
+            'status': process.returncode,
+            'hosts': len(sites),
+            'finished': finished,
+            'elapsed': elapsed,
+            'requests': requests,
+            'requests_per_second': requests / elapsed,
+            'p50': percentile(host_times, 50),
+            'p99': percentile(host_times, 99),
+            'connections': connections,
+
+            # In kilobytes on Linux.
+            'peak_rss': rusage.ru_maxrss,
+        }
+
+    def report_print(self, label, report):
+        print '%s: %s hosts, %s scanned in %.2fs (exit status %s)' % (label,
+                report['hosts'], report['finished'], report['elapsed'],
+                report['status'])
+        print '    requests: %s (%.1f/s)' % (report['requests'],
+                report['requests_per_second'])
+        if report['p50'] is not None:
+            print '    host scan time: p50 %.2fs, p99 %.2fs' % (report['p50'],
+                    report['p99'])
+        if report['connections']:
+            print '    connections: %s opened, %s reuses' % (
+                    report['connections']['opened'],
+                    report['connections']['reused'])
+        print '    peak RSS: %.1f MiB' % (report['peak_rss'] / 1024.0)
+
+def load():
+    handler.register(Benchmark)
@@ -1,6 +1,9 @@
 """
-    A sample base plugin. Do not forget to add an init file in plugins.d
+    A sample base plugin. Do not forget to add an init file in plugins.d, with
+    the command which runs it, e.g. 'command = scan example', so that it is
+    only loaded when that command is run.
 """
+
 from cement.core import handler, controller
 from plugins import BasePlugin
 import common
@@ -0,0 +1,5 @@
+from cement.core import handler
+from plugins import AbstractArgumentController
+
+def load():
+    handler.register(AbstractArgumentController)
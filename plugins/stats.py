@@ -1,6 +1,7 @@
 from cement.core import handler, controller
-from common.plugins_util import Plugin, plugins_get
+from common.capabilities import capabilities_get, time_ago
 from common import template
+import time
 
 class Stats(controller.CementBaseController):
 
@@ -9,10 +10,27 @@ class Stats(controller.CementBaseController):
 
     @controller.expose(help='shows scanner status & capabilities')
     def stats(self):
-       plugins = plugins_get()
-       for plugin in plugins:
+       labels = self.app.plugin.plugins_under('scan')
+       now = time.time()
+       for plugin in capabilities_get(labels, self.plugins_load):
+           for key in ['plugins_mtime', 'themes_mtime']:
+               if plugin[key]:
+                   plugin[key] = time_ago(plugin[key], now)
+
            print template('stats_plugin.tpl', {'plugin': plugin})
 
+    def plugins_load(self, labels):
+        """
+            Loads the scanning plugins with labels, which aren't loaded for
+            this command unless the capability index needs to be rebuilt.
+            @return their classes.
+        """
+        loaded = self.app.plugin.get_loaded_plugins()
+        for label in labels:
+            if label not in loaded:
+                self.app.plugin.load_plugin(label)
+
+        return [handler.get('controller', label) for label in labels]
+
 def load():
     handler.register(Stats)
-
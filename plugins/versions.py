@@ -29,6 +29,14 @@ class VersionGetterBase():
         """
         raise ReferenceError("Parent class should override 'newer_get' method.")
 
+    def process_selection(self, versions_string):
+        """
+            @param versions_string versions separated by comma, e.g. 7.23,7.24
+            @return the download urls of those versions, in the same format as
+                self.newer_get
+        """
+        raise ReferenceError("Parent class should override 'process_selection' method.")
+
     def download(self, newer, location):
         """
             Download files that are new.
@@ -72,6 +80,20 @@ class VersionGetterBase():
 
         return sums
 
+    def sizes_get(self, extracted, files_to_hash):
+        sizes = {}
+        for version, directory in extracted:
+            sizes[version] = {}
+            for filename in files_to_hash:
+                try:
+                    sizes[version][filename] = os.path.getsize(directory +
+                            filename)
+                except OSError:
+                    # file doesn't exist.
+                    pass
+
+        return sizes
+
 class DrupalVersions(VersionGetterBase):
     update_majors = ['6', '7']
 
@@ -132,12 +154,48 @@ class SSVersions(VersionGetterBase):
         """
             @see VersionGetterBase.newer_get
         """
+        newer = {}
+        for version, major, dl_url in self.releases_get():
+            if not major in majors:
+                continue
+
+            if not version_gt(version, majors[major]):
+                continue
+
+            if not major in newer:
+                newer[major] = []
+
+            newer[major].append((version, dl_url))
+
+        return newer
+
+    def process_selection(self, versions_string):
+        """
+            @see VersionGetterBase.process_selection
+        """
+        versions = versions_string.split(",")
+
+        ret = {}
+        for version, major, dl_url in self.releases_get():
+            if version in versions:
+                if not major in ret:
+                    ret[major] = []
+
+                ret[major].append((version, dl_url))
+
+        return ret
+
+    def releases_get(self):
+        """
+            @return (version, major, download url) for every release in the
+                release archive, except for release candidates.
+        """
         base_url = 'http://www.silverstripe.org/software/download/release-archive/'
         resp = requests.get(base_url)
         soup = BeautifulSoup(resp.text)
 
         download_links = soup.select('ul.download-links.list-unstyled a')
-        newer = {}
+        releases = []
         assert len(download_links) > 0
         for dl_link in download_links:
             url = dl_link.get('href')
@@ -155,19 +213,10 @@ class SSVersions(VersionGetterBase):
                 is_release_candidate = '-' in version
 
                 if not is_release_candidate:
-                    if not major in majors:
-                        continue
+                    releases.append((version, major,
+                        'http://www.silverstripe.org' + url))
 
-                    if not version_gt(version, majors[major]):
-                        continue
-
-                    if not major in newer:
-                        newer[major] = []
-
-                    newer[major].append((version, 'http://www.silverstripe.org'
-                        + url))
-
-        return newer
+        return releases
 
 
 class Versions(HumanBasePlugin):
@@ -182,7 +231,10 @@ class Versions(HumanBasePlugin):
                     help='Which CMS to generate the XML for', choices=['drupal',
                         'ss'])),
                 (['--selection', '-s'], dict(action='store',
-                    help='Comma separated list of versions for drupal_select.'))
+                    help='Comma separated list of versions for drupal_select.')),
+                (['--sizes'], dict(action='store_true', help='''Download the
+                    versions already in the XML which have files without a
+                    recorded size, and record their sizes.'''))
             ]
 
     def download_append(self, vg, versions_file, **additional_params):
@@ -215,8 +267,9 @@ class Versions(HumanBasePlugin):
             dl_files = vg.download(new, base_folder)
             extracted_dirs = vg.extract(dl_files, base_folder)
             file_sums = vg.sums_get(extracted_dirs, versions.files_get())
+            file_sizes = vg.sizes_get(extracted_dirs, versions.files_get())
 
-            versions.update(file_sums)
+            versions.update(file_sums, file_sizes)
             xml = versions.str_pretty()
 
             # Final sanity checks.
@@ -259,6 +312,14 @@ class Versions(HumanBasePlugin):
             vg = SSVersions()
             versions_file = SilverStripe.versions_file
 
+        if self.app.pargs.sizes:
+            missing = VersionsFile(versions_file).sizes_missing()
+            if len(missing) == 0:
+                self.error("Sizes are recorded for every version.")
+
+            additional_params['override_newer'] = vg.process_selection(
+                    ','.join(missing))
+
         self.download_append(vg, versions_file, **additional_params)
 
 def load():
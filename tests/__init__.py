@@ -1,12 +1,17 @@
 from cement.core import controller, foundation, backend, handler
 from cement.utils import test
+from common.benchmark import MockSite
 from common.testutils import decallmethods
 from droopescan import DroopeScan
 from mock import patch, MagicMock
 from plugins.drupal import Drupal
-from plugins import AbstractArgumentController
+from tempfile import mkdtemp
+import os
 import responses
 
+# Keep compiled and cached data out of the user's cache directory.
+os.environ['DROOPESCAN_CACHE'] = mkdtemp()
+
 class BaseTest(test.CementTestCase):
     app_class = DroopeScan
     scanner = None
@@ -30,17 +35,47 @@ class BaseTest(test.CementTestCase):
         self.app = DroopeScan(argv=[],
             plugin_config_dir="./plugins.d",
             plugin_dir="./plugins")
-        handler.register(AbstractArgumentController)
         self.app.testing = True
         self.app.setup()
+        self.sites = []
 
     def _init_scanner(self):
         self.scanner = Drupal()
         self.scanner._general_init()
 
     def tearDown(self):
+        for site in self.sites:
+            site.stop()
+
         self.app.close()
 
+    def site_start(self, behaviour, **kwargs):
+        """
+            Starts a mock Drupal site, which is stopped on tearDown.
+            @param behaviour a common.benchmark.SiteBehaviour.
+            @param kwargs passed to MockSite, e.g. plugins=['views'].
+            @return the MockSite.
+        """
+        site = MockSite(Drupal, behaviour, **kwargs)
+        site.start()
+        self.sites.append(site)
+        return site
+
+    def scan_opts(self, url, **kwargs):
+        """
+            @param url the URL to scan.
+            @param kwargs options to override, e.g. baseline_full_every=7.
+            @return options for self.scanner.url_scan, as parsed from the
+                command line, enumerating everything.
+        """
+        opts = {'url': url, 'method': None, 'verb': 'head', 'timeout': 15,
+                'enumerate': 'a', 'threads': 4, 'number': 100,
+                'engine': 'thread', 'fingerprint_mode': 'full',
+                'plugins_base_url': self.scanner.plugins_base_url,
+                'themes_base_url': self.scanner.themes_base_url}
+        opts.update(kwargs)
+        return opts
+
     def mock_controller(self, plugin_label, method, return_value = None, side_effect = None):
         """
             Mocks controller by label. Can only be used to test controllers
@@ -1,15 +1,24 @@
 from cement.utils import test
 from common import file_len, base_url
+from common.baseline import delta_get
+from common.benchmark import SiteBehaviour
+from common.engine import ThreadEngine
+from common.journal import Journal
+from common.resultcache import ResultCache
+from common.workqueue import WorkQueue
 from common.testutils import decallmethods
 from concurrent.futures import ThreadPoolExecutor
-from mock import patch
+from mock import patch, MagicMock
 from plugins.drupal import Drupal
 from plugins import ScanningMethod, Verb, Enumerate
 from requests.exceptions import ConnectionError
+from tempfile import mkdtemp
 from tests import BaseTest
 import common
+import json
 import requests
 import responses
+import time
 
 @decallmethods(responses.activate)
 class BaseHttpTests(BaseTest):
@@ -38,6 +47,20 @@ class BaseHttpTests(BaseTest):
         assert result == expected_result, "Should have detected the \
                 'supermodule' module."
 
+    @patch.object(Drupal, 'plugins_get', return_value=["nonexistant1",
+        "nonexistant2", "supermodule"])
+    @patch.object(common.StandardOutput, 'event')
+    def test_plugins_streamed(self, event, m):
+        self.respond_several(self.base_url + "sites/all/modules/%s/", {403: ["supermodule"],
+            404: ["nonexistant1", "nonexistant2"]})
+
+        self.scanner.enumerate_plugins(self.base_url,
+                "%ssites/all/modules/%s/", ScanningMethod.forbidden,
+                host='example')
+
+        event.assert_called_once_with('plugin', 'example', name='supermodule',
+                url=self.base_url + 'sites/all/modules/supermodule/')
+
     @patch.object(Drupal, 'plugins_get', return_value=["nonexistant1",
         "nonexistant2", "supermodule"])
     def test_plugins_ok(self, m):
@@ -96,6 +119,63 @@ class BaseHttpTests(BaseTest):
         assert result == expected_result, "Should have detected the \
                 'supermodule' module."
 
+    @patch.object(Drupal, 'plugins_get', return_value=["nonexistant1",
+        "supermodule", "supermodule2"])
+    def test_plugins_secondary_base_url_only_missing(self, m):
+        base_1 = self.base_url + "sites/all/modules/%s/"
+        base_2 = self.base_url + "sites/default/modules/%s/"
+        self.respond_several(base_1, {403: ["supermodule"],
+            404: ["nonexistant1", "supermodule2"]})
+        # 'supermodule' is not mocked for base_2, and requesting it would fail.
+        self.respond_several(base_2, {403: ["supermodule2"], 404:
+            ["nonexistant1"]})
+        self.respond_several(self.base_url + "%s", {403:
+            ["sites/default/modules/"]})
+
+        result, empty = self.scanner.enumerate_plugins(self.base_url,
+                self.scanner.plugins_base_url, ScanningMethod.forbidden)
+
+        assert result == [{'url': base_1 % 'supermodule', 'name': 'supermodule'},
+            {'url': base_2 % 'supermodule2', 'name': 'supermodule2'}]
+
+    @patch.object(Drupal, 'plugins_get', return_value=["nonexistant1",
+        "supermodule"])
+    def test_plugins_secondary_base_url_skipped(self, m):
+        base_1 = self.base_url + "sites/all/modules/%s/"
+        self.respond_several(base_1, {403: ["supermodule"],
+            404: ["nonexistant1"]})
+        # No plugins are mocked for sites/default/modules/.
+        self.respond_several(self.base_url + "%s", {404:
+            ["sites/default/modules/"]})
+
+        result, empty = self.scanner.enumerate_plugins(self.base_url,
+                self.scanner.plugins_base_url, ScanningMethod.forbidden)
+
+        assert result == [{'url': base_1 % 'supermodule', 'name': 'supermodule'}]
+
+    def test_plugins_bounded_window(self):
+        pulled = []
+        def plugins_get(amount):
+            for i in range(50):
+                pulled.append(i)
+                yield 'plugin%s' % i
+
+        pulled_at_call = []
+        def status_get(requests_verb, url, timeout):
+            pulled_at_call.append(len(pulled))
+            return 404
+
+        self.scanner.window_per_thread = 2
+        with patch.object(ThreadEngine, '_status_get', side_effect=status_get):
+            result, empty = self.scanner.enumerate(self.base_url,
+                    "%ssites/all/modules/%s/", ScanningMethod.forbidden,
+                    plugins_get, 50, threads=1)
+
+        assert empty
+        assert len(pulled_at_call) == 50
+        for nb, pulled_nb in enumerate(pulled_at_call):
+            assert pulled_nb <= nb + 2, "Wordlist should be read lazily."
+
     def test_gets_modules(self):
         # unwrap the generator
         plugins_generator = self.scanner.plugins_get()
@@ -328,6 +408,19 @@ class BaseHttpTests(BaseTest):
         assert not empty
         assert found == expected_result
 
+    @patch('common.scheduler.retry_delay', return_value=0)
+    @patch.object(common.StandardOutput, 'warn')
+    def test_interesting_skips_connection_errors(self, warn, m):
+        path = self.scanner.interesting_urls[0][0]
+        # The second url isn't registered, so it raises ConnectionError.
+        self.respond_several(self.base_url + "%s", {200: [path]})
+
+        found, empty = self.scanner.enumerate_interesting(self.base_url,
+                self.scanner.interesting_urls[:2])
+
+        assert [f['url'] for f in found] == [self.base_url + path]
+        assert warn.called
+
     def test_calls_enumerate_interesting(self):
         self.add_argv(self.param_interesting)
         self.add_argv(["--method", "forbidden"])
@@ -453,6 +546,140 @@ class BaseHttpTests(BaseTest):
 
         assert ev.call_count == 3
 
+    def test_url_file_resume(self):
+        with open(self.valid_file) as f:
+            hosts = [url.rstrip('\n') for url in f]
+
+        # A scan which was stopped half way through the second host.
+        journal_file = mkdtemp() + '/journal'
+        journal = Journal(journal_file)
+        finds = {'finds': [], 'is_empty': True}
+        for phase in ['scanning_method', 'plugins', 'themes', 'version',
+                'interesting urls', 'done']:
+            journal.record(hosts[0], phase, finds)
+        journal.record(hosts[1], 'scanning_method', ['forbidden', hosts[1]])
+        journal.record(hosts[1], 'plugins', finds)
+        journal.f.write('{"host": "trunc')
+        journal.close()
+
+        self.add_argv(['--url-file', self.valid_file, '-n', '0',
+            '--journal', journal_file, '--resume'])
+        ep, et, ei, ev = self.mock_all_enumerate('drupal')
+        self.mock_all_url_file(self.valid_file)
+        self.app.run()
+
+        assert ep.call_count == 1
+        assert et.call_count == 2
+        assert ev.call_count == 2
+
+        journal = Journal(journal_file, resume=True)
+        for host in hosts:
+            assert journal.has(host, 'done')
+            assert not journal.has(host, 'plugins')
+
+        # The results of hosts which are done aren't kept.
+        assert journal.phases == {}
+        journal.close()
+
+    @patch('common.StandardOutput.result')
+    def test_url_file_processes(self, result):
+        with open(self.valid_file) as f:
+            hosts = [url.rstrip('\n') for url in f]
+
+        self.add_argv(['--url-file', self.valid_file, '-n', '0',
+            '--processes', '2'])
+        self.mock_all_enumerate('drupal')
+        self.mock_all_url_file(self.valid_file)
+        self.app.run()
+
+        output_hosts = [args[0]['host'] for args, kwargs in
+                result.call_args_list]
+        assert output_hosts == hosts
+        for args, kwargs in result.call_args_list:
+            assert args[0]['plugins'] == {'finds': {'a': []}, 'is_empty': True}
+
+    def test_url_file_processes_stats_file(self):
+        stats_file = mkdtemp() + '/stats.json'
+        self.add_argv(['--url-file', self.valid_file, '-n', '0',
+            '--processes', '2', '--stats-file', stats_file])
+        self.mock_all_enumerate('drupal')
+        self.mock_all_url_file(self.valid_file)
+        self.app.run()
+
+        with open(stats_file) as f:
+            stats = json.load(f)
+
+        # Metrics from both processes are merged.
+        assert stats['phases']['plugins']['count'] == 3
+        assert stats['phases']['scanning_method']['count'] == 3
+        assert stats['elapsed'] > 0
+
+    def test_url_file_profile(self):
+        profile_file = mkdtemp() + '/profile'
+        self.add_argv(['--url-file', self.valid_file, '-n', '0',
+            '--profile', profile_file])
+        self.mock_all_enumerate('drupal')
+        self.mock_all_url_file(self.valid_file)
+        self.app.run()
+
+        with open(profile_file + '.txt') as f:
+            summary = f.read()
+
+        for phase in ['scan', 'scanning_method', 'plugins', 'version',
+                'output']:
+            assert '== %s ==' % phase in summary
+
+    def test_queue_worker_and_coordinator(self):
+        with open(self.valid_file) as f:
+            hosts = [url.rstrip('\n') for url in f]
+
+        queue_file = mkdtemp() + '/queue.db'
+        WorkQueue(queue_file).enqueue(hosts)
+
+        self.add_argv(['--queue', queue_file, '--worker', '-n', '0'])
+        self.mock_all_enumerate('drupal')
+        self.mock_all_url_file(self.valid_file)
+        self.app.run()
+
+        assert WorkQueue(queue_file).counts() == {'done': 3}
+
+        opts = {'url_file': self.valid_file, 'queue': queue_file,
+                'lease_time': 600}
+        self.scanner.out.result = result = MagicMock()
+        self.scanner._queue_coordinate(opts, {})
+
+        output_hosts = [args[0]['host'] for args, kwargs in
+                result.call_args_list]
+        assert output_hosts == hosts
+
+    @patch('common.StandardOutput.warn')
+    def test_queue_coordinator_without_workers(self, warn):
+        opts = {'url_file': self.valid_file, 'queue': mkdtemp() +
+                '/queue.db', 'lease_time': 0.05}
+        self.scanner._queue_coordinate(opts, {}, poll_interval=0.01)
+
+        assert warn.called
+        assert WorkQueue(opts['queue']).counts() == {'queued': 3}
+
+    @patch('common.StandardOutput.result')
+    def test_url_file_completion_order(self, result):
+        with open(self.valid_file) as f:
+            hosts = [url.rstrip('\n') for url in f]
+
+        def url_scan(url, *args):
+            if url.rstrip('\n') == hosts[0]:
+                time.sleep(0.2)
+            return {}
+
+        self.add_argv(['--url-file', self.valid_file, '-t', '3'])
+        self.mock_controller('drupal', 'url_scan', side_effect=url_scan)
+        self.app.run()
+
+        output_hosts = [args[0]['host'] for args, kwargs in
+                result.call_args_list]
+        assert sorted(output_hosts[:2]) == sorted(hosts[1:])
+        assert output_hosts[2] == hosts[0], "Slow hosts shouldn't block output."
+
     def test_url_file_exceptions_are_caught(self):
         self.add_argv(['--url-file', 'tests/resources/url_file_invalid.txt'])
 
@@ -506,3 +733,92 @@ class BaseHttpTests(BaseTest):
 
         for mock in all_mocks:
             self.assert_called_contains(mock, 'timeout', 5)
+
+class LocalHttpTests(BaseTest):
+    """
+        Generic tests that involve HTTP requests to the mock sites in
+        common.benchmark, which responses would intercept.
+    """
+    def setUp(self):
+        super(LocalHttpTests, self).setUp()
+        self._init_scanner()
+
+    def test_scanning_method_probes_concurrent(self):
+        site = self.site_start(SiteBehaviour.forbidden, latency=0.3)
+
+        start = time.time()
+        method, url = self.scanner.determine_scanning_method(site.url, 'head')
+        elapsed = time.time() - start
+
+        assert method == ScanningMethod.forbidden
+        assert site.requests == 3
+        # Sent in more than one round, they would take at least 0.6s.
+        assert elapsed < 0.45
+
+    def test_result_cache_reused_until_host_changes(self):
+        site = self.site_start(SiteBehaviour.forbidden, plugins=['views',
+            'token'])
+        self.scanner.result_cache = ResultCache(mkdtemp() + '/results.db')
+        opts = self.scan_opts(site.url)
+        functionality = self.scanner._functionality(opts)
+
+        def scan():
+            before = site.requests
+            result = self.scanner.url_scan(site.url, opts, functionality,
+                    functionality)
+            plugins = [f['name'] for f in result['plugins']['finds']]
+            return sorted(plugins), site.requests - before
+
+        plugins, nb_requests = scan()
+        assert plugins == ['token', 'views']
+        assert nb_requests > 200
+
+        # Changelog, a version file, two plugins and two interesting urls.
+        plugins, nb_requests = scan()
+        assert plugins == ['token', 'views']
+        assert nb_requests == 6
+
+        site.folders.remove('/sites/all/modules/token/')
+        plugins, nb_requests = scan()
+        assert plugins == ['views']
+        assert nb_requests > 200
+
+    def test_baseline_reused_until_full_scan_due(self):
+        site = self.site_start(SiteBehaviour.forbidden, plugins=['views'])
+        opts = self.scan_opts(site.url, baseline_full_every=7)
+        functionality = self.scanner._functionality(opts)
+
+        def scan():
+            before = site.requests
+            result = self.scanner.url_scan(site.url, opts, functionality,
+                    functionality)
+            result['host'] = site.url
+            return result, site.requests - before
+
+        previous, nb_requests = scan()
+        self.scanner.baseline = {site.url: previous}
+        site.folders.add('/sites/all/modules/token/')
+        site.files.add('/sites/all/modules/token/README.txt')
+
+        with patch('plugins.full_scan_due', return_value=False):
+            result, nb_requests_baseline = scan()
+
+        assert nb_requests_baseline < nb_requests / 2
+        assert delta_get(previous, result) == {'host': site.url}
+
+        with patch('plugins.full_scan_due', return_value=True):
+            result, _ = scan()
+
+        delta = delta_get(previous, result)
+        assert [f['name'] for f in delta['plugins']['added']] == ['token']
+
+    def test_connections_reused(self):
+        site = self.site_start(SiteBehaviour.forbidden, plugins=['views'])
+        self.scanner.enumerate_plugins(site.url,
+                self.scanner.plugins_base_url, ScanningMethod.forbidden,
+                max_plugins=100)
+        self.scanner.session.close()
+
+        connections = self.scanner.metrics.report()['connections']
+        assert 0 < connections['opened'] <= self.scanner.host_threads
+        assert connections['opened'] + connections['reused'] > 100
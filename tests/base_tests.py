@@ -1,16 +1,29 @@
 from __future__ import print_function
 from cement.utils import test
-from common import file_len, ProgressBar, JsonOutput, StandardOutput
+from common import file_len, ProgressBar, JsonOutput, StandardOutput, \
+        NdjsonOutput, template
+from common.baseline import baseline_load, delta_get, full_scan_due
+from common.capabilities import capabilities_get, time_ago
+from common.plugin_loader import plugins_needed
+from common.profiler import Profiler
+from common.resultcache import ResultCache
 from common.testutils import decallmethods, MockBuffer
+from common.wordlist import Wordlist
+from common.workqueue import WorkQueue
 from contextlib import contextmanager
 from mock import patch
 from plugins.drupal import Drupal
-from requests.exceptions import ConnectionError
 from requests import Session
 from StringIO import StringIO
+from tempfile import mkdtemp
 from tests import BaseTest
+import json
+import os
+import pstats
 import responses
 import sys
+import threading
+import time
 
 @contextmanager
 def capture_sys_output():
@@ -66,22 +79,27 @@ class BaseTests(BaseTest):
             self.add_argv(self.param_plugins + ['--method', 'derpo'])
             self.app.run()
 
-    @test.raises(ConnectionError)
-    def test_calls_plugin(self):
+    @patch('common.scheduler.retry_delay', return_value=0)
+    @patch.object(StandardOutput, 'warn')
+    def test_calls_plugin(self, warn, m):
         self.add_argv(['scan', 'drupal'])
         self.add_argv(self.param_plugins)
         self.add_argv(['--method', 'forbidden'])
 
+        # with no mocked calls, every HTTP req fails and is warned about.
         self.app.run()
+        assert warn.called
 
-    @test.raises(ConnectionError)
-    def test_calls_theme(self):
+    @patch('common.scheduler.retry_delay', return_value=0)
+    @patch.object(StandardOutput, 'warn')
+    def test_calls_theme(self, warn, m):
         self.add_argv(['scan', 'drupal'])
         self.add_argv(self.param_themes)
 
         self.add_argv(['--method', 'forbidden'])
 
         self.app.run()
+        assert warn.called
 
     def test_calls_all(self):
         self.add_argv(['scan', 'drupal'])
@@ -112,7 +130,9 @@ class BaseTests(BaseTest):
             'threads': 'a',
             'verb': 'a',
             'enumerate': 'p',
-            'timeout': 15
+            'timeout': 15,
+            'engine': 'thread',
+            'fingerprint_mode': 'full'
         }
         opts_t = dict(opts_p)
         opts_t['enumerate'] = 't'
@@ -166,6 +186,18 @@ class BaseTests(BaseTest):
         args, kwargs = m.call_args
         assert isinstance(kwargs['output'], JsonOutput)
 
+    @patch.object(JsonOutput, 'result')
+    def test_json_output_single_url_no_host(self, result):
+        self.add_argv(['scan', 'drupal'])
+        self.add_argv(self.param_all)
+        self.add_argv(['--method', 'forbidden', '--output', 'json'])
+        self.mock_all_enumerate('drupal')
+
+        self.app.run()
+
+        args, kwargs = result.call_args
+        assert 'host' not in args[0]
+
     def test_output_defaults(self):
         jo = JsonOutput()
         so = StandardOutput()
@@ -173,6 +205,57 @@ class BaseTests(BaseTest):
         assert jo.errors_display == False
         assert so.errors_display == True
 
+    def test_template_cached(self):
+        variables = {'noun': 'plugins', 'url': self.base_url}
+        first = template('scan_begin.tpl', variables)
+
+        assert variables == {'noun': 'plugins', 'url': self.base_url}
+        assert self.base_url in first
+        with patch('__builtin__.open', side_effect=IOError):
+            assert template('scan_begin.tpl', variables) == first
+
+    def test_ndjson_output(self):
+        stream = StringIO()
+        out = NdjsonOutput(stream)
+        out.event('host_started', 'http://a/')
+        out.event('scanning_method', 'http://a/', method='forbidden',
+                url='http://a/')
+        out.echo('not a record')
+        out.result({
+            'host': 'http://a/',
+            'plugins': {'finds': [{'name': 'views', 'url': 'http://a/v/'},
+                {'name': 'ctools', 'url': 'http://a/c/'}], 'is_empty': False},
+            'version': {'finds': ['7.26', '7.27'], 'is_empty': False},
+        })
+
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        types = [record['type'] for record in records]
+
+        assert types == ['host_started', 'scanning_method', 'plugin', 'plugin',
+                'version', 'host_finished']
+        for record in records:
+            assert record['host'] == 'http://a/'
+
+        plugins = [r['name'] for r in records if r['type'] == 'plugin']
+        assert plugins == ['views', 'ctools']
+        assert records[-1]['elapsed'] >= 0
+
+    def test_ndjson_output_streamed_finds(self):
+        stream = StringIO()
+        out = NdjsonOutput(stream)
+        out.event('plugin', 'http://a/', name='views', url='http://a/v/')
+        out.result({
+            'host': 'http://a/',
+            'plugins': {'finds': [{'name': 'views', 'url': 'http://a/v/'}],
+                'is_empty': False},
+            'themes': {'finds': [{'name': 'zen', 'url': 'http://a/z/'}],
+                'is_empty': False},
+        })
+
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [(r['type'], r.get('name')) for r in records] == [
+                ('plugin', 'views'), ('theme', 'zen'), ('host_finished', None)]
+
     @patch('__builtin__.print')
     def test_no_output_when_error_display_false(self, mock_print):
         jo = JsonOutput()
@@ -181,3 +264,264 @@ class BaseTests(BaseTest):
 
         assert mock_print.called == False
 
+    @patch('common.workqueue.time.time', return_value=1000)
+    def test_work_queue(self, now):
+        queue = WorkQueue(mkdtemp() + '/queue.db', lease_time=60,
+                max_attempts=2)
+
+        assert queue.enqueue(['http://a/', 'http://b/', 'http://a/']) == 2
+        assert queue.enqueue(['http://b/', 'http://c/']) == 1
+
+        assert queue.lease('w1', 2) == ['http://a/', 'http://b/']
+        assert queue.lease('w2', 2) == ['http://c/']
+        assert queue.lease('w2') == []
+        assert queue.complete('http://c/', 'w2', {})
+
+        # w1 crashes, and its lease expires.
+        now.return_value = 1061
+        assert queue.lease('w2', 5) == ['http://a/', 'http://b/']
+        assert not queue.complete('http://a/', 'w1', {})
+        assert queue.complete('http://a/', 'w2', {'version': []})
+
+        queue.fail('http://b/', 'w2', 'error')
+        assert queue.counts() == {'done': 2, 'failed': 1}
+        cursor, rows = queue.finished_since()
+        assert [row[1:] for row in rows] == [
+                ('http://c/', 'done', {}),
+                ('http://a/', 'done', {'version': []}),
+                ('http://b/', 'failed', 'error')]
+        assert queue.finished_since(cursor) == (cursor, [])
+
+        queue.enqueue(['http://d/'])
+        assert queue.lease('w2') == ['http://d/']
+        assert queue.leases_live() == 1
+        assert queue.complete('http://d/', 'w2', {})
+        assert queue.finished_since(cursor) == (cursor + 1, [(6,
+            'http://d/', 'done', {})])
+
+    @patch('time.time')
+    def test_result_cache(self, now):
+        now.return_value = 1000
+        cache = ResultCache(mkdtemp() + '/results.db', ttl=100, max_entries=2)
+        cache.put('http://a/', 'drupal', {'scanning_method': 'forbidden'})
+        cache.put('http://a/', 'silverstripe', {'scanning_method': 'ok'})
+
+        assert cache.get('http://a/', 'drupal') == {'scanning_method':
+                'forbidden'}
+        assert cache.get('http://b/', 'drupal') == None
+
+        # The least recently used entry is evicted.
+        now.return_value = 1010
+        cache.get('http://a/', 'drupal')
+        cache.put('http://b/', 'drupal', {})
+        assert cache.count() == 2
+        assert cache.get('http://a/', 'silverstripe') == None
+
+        # Expired entries aren't used.
+        now.return_value = 1105
+        assert cache.get('http://a/', 'drupal') == None
+        assert cache.get('http://b/', 'drupal') == {}
+
+    def test_baseline_delta(self):
+        filename = mkdtemp() + '/previous.json'
+        previous = {'host': 'http://a/', 'version': {'finds': ['7.1'],
+            'is_empty': False}, 'plugins': {'finds': [{'name': 'views',
+                'url': 'http://a/sites/all/modules/views/'}], 'is_empty':
+                False}}
+        with open(filename, 'w') as f:
+            f.write(json.dumps(previous) + '\n')
+            f.write('Not a result.\n')
+            f.write(json.dumps({'host': 'http://b/', 'plugins': {'added': [],
+                'removed': []}}) + '\n')
+            f.write(json.dumps({'host': 'http://c/'}) + '\n')
+
+        baseline = baseline_load(filename)
+        assert list(baseline) == ['http://a/']
+
+        result = {'host': 'http://a/', 'version': {'finds': ['7.2'],
+            'is_empty': False}, 'plugins': {'finds': [{'name': 'views', 'url':
+                'http://a/sites/all/modules/views/'}, {'name': 'token', 'url':
+                    'http://a/sites/all/modules/token/'}], 'is_empty': False}}
+        delta = delta_get(baseline['http://a/'], result)
+        assert delta == {'host': 'http://a/', 'version': {'added': ['7.2'],
+            'removed': ['7.1']}, 'plugins': {'added':
+                [result['plugins']['finds'][1]], 'removed': []}}
+
+        # Hosts not in the baseline are new in full.
+        assert delta_get(None, result)['plugins']['added'] == \
+                result['plugins']['finds']
+
+        with capture_sys_output() as (stdout, stderr):
+            StandardOutput().delta(delta, {})
+            StandardOutput().delta({'host': 'http://a/'}, {})
+
+        output = stdout.getvalue()
+        assert 'Plugins added to http://a/' in output and 'token' in output
+        assert 'Version removed from http://a/' in output and '7.1' in output
+        assert 'No changes to http://a/ since the baseline.' in output
+
+    def test_baseline_full_scan_spread(self):
+        hosts = ['http://%s/' % i for i in range(700)]
+        days = [0, 1, 2, 3, 4, 5, 6]
+        due = [len([h for h in hosts if full_scan_due(h, 7, day * 86400)]) for
+                day in days]
+
+        assert sum(due) == len(hosts)
+        assert min(due) > 50
+        assert all([full_scan_due(h, 1) for h in hosts[:10]])
+
+    def test_plugins_needed(self):
+        enabled = ['drupal', 'release', 'scan', 'silverstripe', 'thirdparty']
+        configs = {
+            'drupal': {'command': 'scan drupal'},
+            'scan': {'command': 'scan'},
+            'silverstripe': {'command': 'scan silverstripe'},
+            'release': {'command': 'release', 'requires': 'scan'},
+        }
+
+        def needed(argv):
+            return plugins_needed(enabled, configs, argv)
+
+        assert needed(['scan', 'drupal', '--url', 'http://a/']) == ['drupal',
+                'scan', 'thirdparty']
+        assert needed(['--debug', 'scan', '-h']) == ['drupal', 'scan',
+                'silverstripe', 'thirdparty']
+        assert needed(['release']) == enabled
+        assert needed([]) == enabled
+        assert needed(['unknown']) == enabled
+
+    def test_capability_index_rebuilt_when_sources_change(self):
+        tmp = mkdtemp()
+        plugins_file = tmp + '/plugins.txt'
+        with open(plugins_file, 'w') as f:
+            f.write('views\nctools\n')
+
+        class Cms(Drupal):
+            can_enumerate_themes = False
+        Cms.plugins_file = plugins_file
+
+        loads = []
+        def plugins_load(labels):
+            loads.append(labels)
+            return [Cms]
+
+        def get(labels=['cms']):
+            return capabilities_get(labels, plugins_load, tmp + '/index.json')
+
+        plugin = get()[0]
+        assert plugin['name'] == 'Cms'
+        assert plugin['plugins_wordlist_size'] == 2
+        assert plugin['version_highest'] == '7.32'
+        assert len(loads) == 1
+
+        # Touched, but unchanged.
+        os.utime(plugins_file, (1000, 1000))
+        get()
+        get()
+        assert len(loads) == 1
+
+        with open(plugins_file, 'w') as f:
+            f.write('views\nctools\ntoken\n')
+        get()
+        assert len(loads) == 2
+
+        get(['cms', 'other'])
+        assert len(loads) == 3
+
+    def test_time_ago(self):
+        now = 1000000000
+        assert time_ago(now - 30, now) == '30 seconds ago'
+        assert time_ago(now - 60 * 60, now) == '60 minutes ago'
+        assert time_ago(now - 3 * 86400, now) == '3 days ago'
+        assert time_ago(now - 21 * 86400, now) == '3 weeks ago'
+        assert time_ago(now - 400 * 86400, now) == '1 year, 1 month ago'
+
+    def test_wordlist_compiled(self):
+        filename = mkdtemp() + '/wordlist.txt'
+        with open(filename, 'w') as f:
+            f.write('views\n ctools \r\n\ntoken\n')
+
+        wordlist = Wordlist.load(filename)
+        with open(filename) as f:
+            expected = [line.strip() for line in f]
+
+        assert list(wordlist.head(100)) == expected
+        assert list(wordlist.head(2)) == ['views', 'ctools']
+        assert len(wordlist) == 4
+        assert wordlist[-1] == 'token'
+
+    def test_wordlist_recompiled_on_change(self):
+        filename = mkdtemp() + '/wordlist.txt'
+        with open(filename, 'w') as f:
+            f.write('views\n')
+        Wordlist.load(filename)
+
+        with open(filename, 'w') as f:
+            f.write('views\nctools\n')
+
+        assert list(Wordlist.load(filename).head(100)) == ['views', 'ctools']
+
+    def test_profiler_sampling_follows_phase_to_threads(self):
+        def busy():
+            end = time.time() + 0.2
+            while time.time() < end:
+                pass
+
+        profiler = Profiler('sampling', interval=0.001)
+        profiler.start()
+        with profiler.phase('version'):
+            worker = threading.Thread(target=profiler.wrap(busy))
+
+        worker.start()
+        worker.join()
+        profiler.stop()
+
+        filename = mkdtemp() + '/profile'
+        profiler.dump(filename)
+
+        assert profiler.samples.keys() == ['version']
+        with open(filename) as f:
+            for line in f:
+                assert line.startswith('version;')
+                assert 'busy (base_tests.py:' in line
+
+        with open(filename + '.txt') as f:
+            summary = f.read()
+
+        assert summary.startswith('== version (')
+        assert 'busy (base_tests.py:' in summary
+
+    def test_profiler_cprofile_nested_phases(self):
+        def hashing():
+            return sum(range(1000))
+
+        profiler = Profiler('cprofile')
+        with profiler.phase('scan'):
+            with profiler.phase('version'):
+                hashing()
+            len('scan')
+
+        filename = mkdtemp() + '/profile'
+        profiler.dump(filename)
+
+        functions = lambda phase: [f[2] for f in profiler.stats[phase].stats]
+        assert 'hashing' in functions('version')
+        assert 'hashing' not in functions('scan')
+        assert "<len>" in functions('scan')
+
+        merged = pstats.Stats(filename)
+        assert 'hashing' in [f[2] for f in merged.stats]
+        with open(filename + '.txt') as f:
+            summary = f.read()
+
+        assert '== scan ==' in summary
+        assert '== version ==' in summary
+
+    def test_profiler_disabled(self):
+        profiler = Profiler()
+        fn = lambda: None
+        with profiler.phase('version'):
+            assert profiler.wrap(fn) is fn
+
+        assert not profiler
+        assert profiler.stats == {}
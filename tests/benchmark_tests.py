@@ -0,0 +1,60 @@
+from cement.utils import test
+from common.benchmark import SiteBehaviour, percentile
+from plugins import ScanningMethod
+from tests import BaseTest
+
+class BenchmarkTests(BaseTest):
+    '''
+        Tests for the mock CMS sites in common.benchmark, scanned for real
+        over HTTP.
+    '''
+
+    def setUp(self):
+        super(BenchmarkTests, self).setUp()
+        self._init_scanner()
+
+    def test_scanning_methods(self):
+        for behaviour, expected in [
+                (SiteBehaviour.forbidden, ScanningMethod.forbidden),
+                (SiteBehaviour.not_found, ScanningMethod.not_found),
+                (SiteBehaviour.ok, ScanningMethod.ok)]:
+            site = self.site_start(behaviour)
+            method, url = self.scanner.determine_scanning_method(site.url,
+                    'head')
+
+            assert method == expected
+            assert url == site.url
+
+    def test_redirect(self):
+        target = self.site_start(SiteBehaviour.forbidden)
+        site = self.site_start(SiteBehaviour.redirect, redirect_to=target.url)
+
+        method, url = self.scanner.determine_scanning_method(site.url, 'head')
+
+        assert method == ScanningMethod.forbidden
+        assert url == target.url
+
+    @test.raises(RuntimeError)
+    def test_fake_200(self):
+        site = self.site_start(SiteBehaviour.fake_200)
+        self.scanner.determine_scanning_method(site.url, 'head')
+
+    def test_installed_plugins_found(self):
+        for behaviour in [SiteBehaviour.forbidden, SiteBehaviour.not_found]:
+            site = self.site_start(behaviour, plugins=['views', 'token'])
+            method, url = self.scanner.determine_scanning_method(site.url,
+                    'head')
+
+            finds, is_empty = self.scanner.enumerate_plugins(url,
+                    self.scanner.plugins_base_url, method,
+                    max_plugins=100)
+
+            assert sorted([f['name'] for f in finds]) == ['token', 'views']
+            assert site.requests > 100
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3]
+        assert percentile(values, 50) == 3
+        assert percentile(values, 99) == 5
+        assert percentile(values, 0) == 1
+        assert percentile([], 50) == None
@@ -0,0 +1,329 @@
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from cement.utils import test
+from common.benchmark import MockSite, SiteBehaviour
+from common.engine import AsyncEngine
+from common.metrics import Metrics
+from common.scheduler import FairQueue, Scheduler, HostController
+from mock import patch
+from plugins import ScanningMethod
+from plugins.drupal import Drupal
+from requests.exceptions import ConnectionError, Timeout
+from SocketServer import ThreadingMixIn
+from tests import BaseTest
+import socket
+import threading
+import time
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """
+        Responds with 403 for the folders in `forbidden`, and with 404 for
+        everything else. Requests to /slow/ never receive a response in time.
+    """
+    forbidden = ['/sites/all/modules/supermodule/']
+
+    def do_HEAD(self):
+        if self.path.startswith('/slow/'):
+            time.sleep(1)
+
+        status = 403 if self.path in self.forbidden else 404
+        self.send_response(status)
+        self.end_headers()
+
+    def do_GET(self):
+        self.do_HEAD()
+        self.wfile.write('body')
+
+    def handle(self):
+        try:
+            BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            # The engine may close the connection early.
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class EngineTests(BaseTest):
+    '''
+        Tests for the HTTP engines in common.engine, against a local server.
+    '''
+
+    def setUp(self):
+        super(EngineTests, self).setUp()
+        self._init_scanner()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StatusHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.local_url = 'http://127.0.0.1:%s/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(EngineTests, self).tearDown()
+
+    def test_async_status(self):
+        with AsyncEngine(Scheduler(10)) as engine:
+            found = engine.submit('head', self.local_url +
+                    'sites/all/modules/supermodule/')
+            not_found = engine.submit('get', self.local_url + 'nonexistant/')
+
+            assert found.result() == 403
+            assert not_found.result() == 404
+
+    @test.raises(Timeout)
+    def test_async_timeout(self):
+        with AsyncEngine(Scheduler(10, retries=0)) as engine:
+            engine.submit('head', self.local_url + 'slow/', timeout=0.2).result()
+
+    @test.raises(ConnectionError)
+    @patch('common.engine.retry_delay', return_value=0)
+    def test_async_connection_error(self, m):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        closed_port = s.getsockname()[1]
+        s.close()
+
+        closed_url = 'http://127.0.0.1:%s/' % closed_port
+        scheduler = Scheduler(10, retries=2)
+        with AsyncEngine(scheduler) as engine:
+            try:
+                engine.submit('head', closed_url).result()
+            finally:
+                controller = scheduler.controller_get(closed_url)
+                assert controller.connection_errors == 3
+
+    def test_async_connections_reused(self):
+        site = MockSite(Drupal, SiteBehaviour.forbidden, plugins=['views'])
+        site.start()
+        metrics = Metrics()
+        try:
+            with AsyncEngine(Scheduler(4, metrics=metrics)) as engine:
+                for verb in ['head', 'get'] * 5:
+                    assert engine.submit(verb, site.url +
+                            'sites/all/modules/views/').result() == 403
+
+                # The server closes the idle connection.
+                site.server.connections_close()
+                time.sleep(0.1)
+                assert engine.submit('head', site.url).result() == 404
+        finally:
+            site.stop()
+
+        assert metrics.report()['connections'] == {'opened': 2, 'reused': 9}
+
+    def test_async_shares_scheduler_limits(self):
+        scheduler = Scheduler(1)
+        release = threading.Event()
+        scheduler.submit('http://a/', release.wait)
+        with AsyncEngine(scheduler) as engine:
+            status = engine.submit('head', self.local_url + 'a/')
+            time.sleep(0.2)
+            assert not status.done(), "The only slot is taken."
+
+            release.set()
+            assert status.result() == 404
+
+        scheduler.shutdown()
+
+    def test_async_enumerate_same_result(self):
+        plugins = ['nonexistant1', 'supermodule', 'nonexistant2']
+        result, empty = self.scanner.enumerate(self.local_url,
+                '%ssites/all/modules/%s/', ScanningMethod.forbidden,
+                lambda amount: iter(plugins), 3, threads=2, engine='async')
+
+        expected = [{'name': 'supermodule', 'url': self.local_url +
+            'sites/all/modules/supermodule/'}]
+
+        assert result == expected
+        assert not empty
+
+    def test_fair_queue_round_robin(self):
+        q = FairQueue(10)
+        for i in range(3):
+            q.push('a', 'a%s' % i)
+        q.push('b', 'b0')
+        q.push('c', 'c0')
+
+        order = [q.pop()[1] for i in range(5)]
+
+        assert order == ['a0', 'b0', 'c0', 'a1', 'a2']
+        assert q.pop() is None
+
+    def test_fair_queue_limits(self):
+        q = FairQueue(3, host_max_running=2)
+        for i in range(3):
+            q.push('a', 'a%s' % i)
+
+        assert q.pop() == ('a', 'a0')
+        assert q.pop() == ('a', 'a1')
+        assert q.pop() is None, "Per-host limit should be honoured."
+
+        q.push('b', 'b0')
+        q.push('b', 'b1')
+        assert q.pop() == ('b', 'b0')
+        assert q.pop() is None, "Global limit should be honoured."
+
+        q.done('a')
+        assert q.pop() == ('a', 'a2')
+
+    def test_scheduler_host_limit(self):
+        lock = threading.Lock()
+        running = {'now': 0, 'max': 0}
+        def task():
+            with lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+            time.sleep(0.01)
+            with lock:
+                running['now'] -= 1
+
+        scheduler = Scheduler(8, host_max_workers=2)
+        futures = [scheduler.submit('http://a/', task) for i in range(20)]
+        for future in futures:
+            future.result()
+        scheduler.shutdown()
+
+        assert running['max'] == 2
+
+    def test_host_controller_aimd(self):
+        controller = HostController(16)
+        assert controller.limit_get() == 8
+
+        for i in range(200):
+            controller.record(0.1, 404)
+        assert controller.limit_get() == 16
+
+        controller.record(0.1, 503)
+        assert controller.limit_get() == 8
+        controller.record(timed_out=True)
+        assert controller.limit_get() == 8, "Only halve once per window."
+
+        for i in range(8):
+            controller.record(0.1, 404)
+        controller.record(0.1, 429)
+        assert controller.limit_get() == 4
+        assert controller.timeouts == 1
+        assert controller.throttled == 1
+        assert controller.errors == 1
+
+        for i in range(40):
+            controller.record(0.01, 503)
+        assert controller.limit_get() == 1
+
+        for i in range(2000):
+            controller.record(0.01, 404)
+        assert controller.limit_get() == 16
+
+    def test_host_controller_limit_start(self):
+        controller = HostController(4)
+        controller.limit_start(3)
+        assert controller.limit_get() == 3
+        controller.limit_start(10)
+        assert controller.limit_get() == 4
+
+        controller = HostController(4)
+        controller.record(0.1, 404)
+        controller.limit_start(4)
+        assert controller.limit_get() == 2, "Only before the first response."
+
+    @patch.object(HostController, 'latency_min', 0.05)
+    def test_scheduler_latency_status_only(self):
+        def task(result, delay=0):
+            time.sleep(delay)
+            return result
+
+        scheduler = Scheduler(8)
+        scheduler.submit('http://a/', task, 404).result()
+        controller = scheduler.controller_get('http://a/')
+        limit = controller.limit
+
+        scheduler.submit('http://a/', task, 'a file hash', 0.3).result()
+        assert controller.limit > limit, "Downloads aren't compared."
+
+        scheduler.submit('http://a/', task, 404, 0.3).result()
+        assert controller.limit < limit
+
+        scheduler.shutdown()
+
+    @patch('common.scheduler.retry_delay', return_value=0)
+    def test_scheduler_retries(self, m):
+        responses = [503, Timeout(), ConnectionError(), 200]
+        def task():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        scheduler = Scheduler(2, retries=3)
+        assert scheduler.submit('http://a/', task).result() == 200
+        controller = scheduler.queue.controller_get('http://a/')
+        assert controller.timeouts == 1
+        assert controller.connection_errors == 1
+        scheduler.shutdown()
+
+    @test.raises(Timeout)
+    @patch('common.scheduler.retry_delay', return_value=0)
+    def test_scheduler_retries_exhausted(self, m):
+        def task():
+            raise Timeout()
+
+        scheduler = Scheduler(2, retries=1)
+        try:
+            scheduler.submit('http://a/', task).result()
+        finally:
+            scheduler.shutdown()
+
+    def test_async_metrics(self):
+        metrics = Metrics()
+        with AsyncEngine(Scheduler(10, retries=0, metrics=metrics)) as engine:
+            engine.submit('head', self.local_url + 'a/').result()
+            engine.submit('get', self.local_url +
+                    'sites/all/modules/supermodule/').result()
+            try:
+                engine.submit('head', self.local_url + 'slow/',
+                        timeout=0.2).result()
+            except Timeout:
+                pass
+
+        report = metrics.report()
+        assert report['requests']['total'] == 3
+        assert report['requests']['by_status'] == {'403': 1, '404': 1,
+                'timeout': 1}
+        assert sum(report['requests']['latency']['counts']) == 2
+
+    def test_metrics_merge_and_prometheus(self):
+        metrics = Metrics()
+        metrics.phase_record('plugins', 1.5)
+        metrics.request_record(200, 0.07, 100)
+        metrics.request_record(404, 20)
+        metrics.retry_record()
+
+        other = Metrics()
+        other.phase_record('plugins', 0.5)
+        other.request_record(200, 0.01, 50)
+        metrics.merge(other.report())
+
+        report = metrics.report()
+        assert report['phases'] == {'plugins': {'count': 2, 'seconds': 2.0}}
+        assert report['requests']['by_status'] == {'200': 2, '404': 1}
+        assert report['requests']['bytes'] == 150
+        assert report['requests']['retries'] == 1
+
+        text = metrics.prometheus(3.0)
+        assert 'droopescan_scan_seconds 3.0\n' in text
+        assert 'droopescan_phase_seconds_total{phase="plugins"} 2.0\n' in text
+        assert 'droopescan_requests_total{status="200"} 2\n' in text
+        assert 'droopescan_request_latency_seconds_bucket{le="0.05"} 1\n' in text
+        assert 'droopescan_request_latency_seconds_bucket{le="0.1"} 2\n' in text
+        assert 'droopescan_request_latency_seconds_bucket{le="+Inf"} 3\n' in text
+        assert 'droopescan_request_latency_seconds_count 3\n' in text
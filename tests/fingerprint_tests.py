@@ -1,11 +1,11 @@
 from cement.utils import test
 from common.testutils import decallmethods, xml_validate
 from common import VersionsFile
+from common.fingerprint import FingerprintIndex
 from glob import glob
 from lxml import etree
 from mock import patch, MagicMock
 from plugins.drupal import Drupal
-from requests.exceptions import ConnectionError
 from tests import BaseTest
 import hashlib
 import requests
@@ -18,6 +18,7 @@ class FingerprintTests(BaseTest):
     '''
 
     xml_file_changelog = 'tests/resources/versions_with_changelog.xml'
+    xml_file_sizes = 'tests/resources/versions_with_sizes.xml'
 
     class MockHash():
         files = None
@@ -71,23 +72,29 @@ class FingerprintTests(BaseTest):
                     if ch_nb == version_to_mock:
                         files[ch_url] = ch_version.get('md5')
 
+                if not ch_url in files:
+                    files[ch_url] = '5d41402abc4b2a76b9719d911017c592'
+
         mock_hash = self.MockHash()
         mock_hash.files = files
         mock = MagicMock(side_effect=mock_hash.mock_func)
 
         return mock
 
-    @patch('common.VersionsFile.files_get', return_value=['misc/drupal.js'])
+    @patch('common.fingerprint.FingerprintIndex.files_get',
+            return_value=['misc/drupal.js'])
     def test_calls_version(self, m):
         responses.add(responses.GET, self.base_url + 'misc/drupal.js')
         responses.add(responses.GET, self.base_url + 'CHANGELOG.txt')
         # with no mocked calls, any HTTP req will cause a ConnectionError.
         self.app.run()
 
-    @test.raises(ConnectionError)
-    def test_calls_version_no_mock(self):
-        # with no mocked calls, any HTTP req will cause a ConnectionError.
+    @patch('common.scheduler.retry_delay', return_value=0)
+    @patch('common.StandardOutput.warn')
+    def test_calls_version_no_mock(self, warn, m):
+        # with no mocked calls, every HTTP req fails and is warned about.
         self.app.run()
+        assert warn.called
 
     def test_xml_validates_all(self):
         for xml_path in glob('plugins/*/versions.xml'):
@@ -111,6 +118,54 @@ class FingerprintTests(BaseTest):
         assert real_version in returned_version
         assert is_empty == False
 
+    def test_determines_version_adaptive(self):
+        xml_file = self.scanner.versions_file
+        vf = VersionsFile(xml_file)
+        for real_version in vf.files_per_version():
+            self.scanner.enumerate_file_hash = self.mock_xml(xml_file,
+                    real_version)
+            full, _ = self.scanner.enumerate_version(self.base_url, xml_file)
+            full_calls = self.scanner.enumerate_file_hash.call_count
+
+            self.scanner.enumerate_file_hash = m = self.mock_xml(xml_file,
+                    real_version)
+            adaptive, is_empty = self.scanner.enumerate_version(self.base_url,
+                    xml_file, mode='adaptive')
+
+            assert adaptive == full, real_version
+            assert real_version in adaptive
+            assert not is_empty
+            assert m.call_count < full_calls
+
+    def test_size_prefilter(self):
+        xml_validate(self.xml_file_sizes, self.versions_xsd)
+
+        # drupal.js is never downloaded, as its size identifies its hash.
+        responses.add(responses.HEAD, self.base_url + 'misc/drupal.js',
+                adding_headers={'Content-Length': '10'})
+        responses.add(responses.HEAD, self.base_url + 'misc/ajax.js',
+                adding_headers={'Content-Length': '20'})
+        responses.add(responses.GET, self.base_url + 'misc/ajax.js',
+                body='ajax-7.27-aaaaaaaaaa')
+
+        version, is_empty = self.scanner.enumerate_version(self.base_url,
+                self.xml_file_sizes)
+
+        assert version == ['7.27']
+        assert len(responses.calls) == 3
+
+    def test_size_prefilter_no_match(self):
+        responses.add(responses.HEAD, self.base_url + 'misc/drupal.js',
+                adding_headers={'Content-Length': '11'})
+        responses.add(responses.HEAD, self.base_url + 'misc/ajax.js',
+                adding_headers={'Content-Length': '12'})
+
+        version, is_empty = self.scanner.enumerate_version(self.base_url,
+                self.xml_file_sizes)
+
+        assert version == []
+        assert is_empty
+
     def test_enumerate_hash(self):
         file_url = '/misc/drupal.js'
         body = 'zjyzjy2076'
@@ -122,7 +177,25 @@ class FingerprintTests(BaseTest):
 
         assert md5 == actual_md5
 
-    @patch('common.VersionsFile.files_get', return_value=['misc/drupal.js'])
+    def test_enumerate_hash_too_large(self):
+        file_url = 'misc/drupal.js'
+        responses.add(responses.GET, self.base_url + file_url,
+                body='a' * 100)
+        responses.add(responses.GET, self.base_url + 'misc/ajax.js',
+                body='a' * 100, adding_headers={'Content-Length': '100'})
+        self.scanner.max_body_size = 99
+        self.scanner.hash_chunk_size = 10
+
+        assert self.scanner.enumerate_file_hash(self.base_url, file_url) is None
+        assert self.scanner.enumerate_file_hash(self.base_url,
+                'misc/ajax.js') is None
+
+        self.scanner.max_body_size = 100
+        assert self.scanner.enumerate_file_hash(self.base_url, file_url) == \
+                hashlib.md5('a' * 100).hexdigest()
+
+    @patch('common.fingerprint.FingerprintIndex.files_get',
+            return_value=['misc/drupal.js'])
     def test_fingerprint_correct_verb(self, patch):
         # this needs to be a get, otherwise, how are going to get the request body?
         responses.add(responses.GET, self.base_url + 'misc/drupal.js')
@@ -192,6 +265,26 @@ class FingerprintTests(BaseTest):
         assert highest['6'] == '6.33'
         assert highest['7'] == '7.31'
 
+    def test_update_backfills_sizes(self):
+        sums = {}
+        sizes = {}
+        for file in self.v.root.iter('file'):
+            for version in file.findall('version'):
+                nb = version.attrib['nb']
+                sums.setdefault(nb, {})[file.attrib['url']] = \
+                        version.attrib['md5']
+                sizes.setdefault(nb, {})[file.attrib['url']] = 100
+
+        nb_versions = len(self.v.root.findall('./files/file/version'))
+        assert self.v.sizes_missing() == sorted(sums)
+        assert not FingerprintIndex(self.v).has_sizes('misc/drupal.js')
+
+        self.v.update(sums, sizes)
+
+        assert self.v.sizes_missing() == []
+        assert len(self.v.root.findall('./files/file/version')) == nb_versions
+        assert FingerprintIndex(self.v).has_sizes('misc/drupal.js')
+
     def test_equal_number_per_major(self):
         """
             Drupal fails hard after updating with auto updater of versions.xml
@@ -278,4 +371,30 @@ class FingerprintTests(BaseTest):
         # Changelog is possibly outdated, can't rely on it.
         assert result == mock_versions
 
+    def test_fingerprint_index_same_result(self):
+        xml_files = glob('plugins/*/versions.xml') + [self.xml_file,
+                self.xml_file_changelog]
+        for xml_path in xml_files:
+            vf = VersionsFile(xml_path)
+            index = FingerprintIndex.load(xml_path)
+            cached = FingerprintIndex.load(xml_path)
+
+            assert index.files_get() == vf.files_get()
+            assert cached.hashes == index.hashes
+            assert index.has_changelog() == vf.has_changelog()
+            for version in vf.files_per_version():
+                url_hash = {}
+                for file in vf.root.iter('file'):
+                    for file_version in file.findall('version'):
+                        if file_version.attrib['nb'] == version:
+                            url_hash[file.attrib['url']] = \
+                                    file_version.attrib['md5']
+
+                assert index.version_get(url_hash) == vf.version_get(url_hash)
 
+        v_changelog = VersionsFile(self.xml_file_changelog)
+        index = FingerprintIndex.load(self.xml_file_changelog)
+        for version in v_changelog.root.findall('./files/changelog/version'):
+            md5 = version.attrib['md5']
+            assert index.changelog_identify(md5) == \
+                    v_changelog.changelog_identify(md5)